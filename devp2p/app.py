@@ -15,6 +15,7 @@ class BaseApp(object):
 
     default_config = dict(client_version_string='pydevp2p {}'.format(__version__),
                           deactivated_services=[])
+    node_identity = None  # crypto.NodeIdentity, see NodeIdentity.of_app
 
     def __init__(self, config=default_config):
         self.config = utils.update_config_with_defaults(config, self.default_config)
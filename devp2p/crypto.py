@@ -23,13 +23,17 @@ if 'pyelliptic' not in dir() or not CIPHERNAMES.issubset(set(pyelliptic.Cipher.g
         print('> brew install openssl / > sudo port install openssl')
     sys.exit(1)
 
+import collections
+import gevent
+import gevent.monkey
 import bitcoin
 from Crypto.Hash import keccak
-from rlp.utils import str_to_bytes, safe_ord, ascii_chr
+from rlp.utils import str_to_bytes, safe_ord, ascii_chr, decode_hex
 sha3_256 = lambda x: keccak.new(digest_bits=256, data=str_to_bytes(x))
 from hashlib import sha256
 import struct
 from coincurve import PrivateKey, PublicKey
+from repoze.lru import ExpiringLRUCache
 
 hmac_sha256 = pyelliptic.hmac_sha256
 
@@ -48,6 +52,16 @@ class ECCx(pyelliptic.ECC):
     curve = 'secp256k1'
     ecies_encrypt_overhead_length = 113
 
+    # ECDH secrets of long lived (static) keys, shared by all instances,
+    # see get_cached_ecdh_key. hits and misses are counted by the cache.
+    ecdh_cache_size = 1024
+    ecdh_cache_ttl = 3600.
+    ecdh_cache = ExpiringLRUCache(ecdh_cache_size, ecdh_cache_ttl)
+    # the cache is used from the hub and from the OS threads of a HandshakeWorkerPool.
+    # its own lock is a gevent lock if threading was monkey patched before, which can't
+    # be shared between threads, so all accesses hold this unpatched lock
+    _ecdh_cache_lock = gevent.monkey.get_original('threading', 'Lock')()
+
     def __init__(self, raw_pubkey=None, raw_privkey=None):
         if raw_privkey:
             assert not raw_pubkey
@@ -97,6 +111,32 @@ class ECCx(pyelliptic.ECC):
         assert len(key) == 32
         return key
 
+    def get_cached_ecdh_key(self, raw_pubkey):
+        "like get_ecdh_key, the secret is cached for ecdh_cache_ttl seconds"
+        assert self.raw_privkey
+        if self.ecdh_cache is None:  # disabled
+            return self.get_ecdh_key(raw_pubkey)
+        key = (self.raw_privkey, raw_pubkey)
+        cache = self.ecdh_cache
+        with self._ecdh_cache_lock:
+            secret = cache.get(key)
+        if secret is None:
+            secret = self.get_ecdh_key(raw_pubkey)  # not holding the lock
+            with self._ecdh_cache_lock:
+                cache.put(key, secret)
+        return secret
+
+    @classmethod
+    def setup_ecdh_cache(cls, size=None, ttl=None):
+        "replaces the ECDH cache shared by all instances in the process, size 0 disables it"
+        if size is not None:
+            cls.ecdh_cache_size = size
+        if ttl is not None:
+            cls.ecdh_cache_ttl = ttl
+        cls.ecdh_cache = None
+        if cls.ecdh_cache_size:
+            cls.ecdh_cache = ExpiringLRUCache(cls.ecdh_cache_size, cls.ecdh_cache_ttl)
+
     @property
     def raw_privkey(self):
         if self.privkey:
@@ -132,7 +172,7 @@ class ECCx(pyelliptic.ECC):
 
         """
         # 1) generate r = random value
-        ephem = ECCx()
+        ephem = ephemeral_keys.get()
 
         # 2) generate shared-secret = kdf( ecdhAgree(r, P) )
         key_material = ephem.raw_get_ecdh_key(pubkey_x=raw_pubkey[:32], pubkey_y=raw_pubkey[32:])
@@ -223,6 +263,96 @@ class ECCx(pyelliptic.ECC):
         return ecdsa_verify(self.raw_pubkey, signature, message)
 
 
+class EphemeralKeyPool(object):
+
+    """
+    Bounded pool of pregenerated ephemeral keypairs for RLPx handshakes and ECIES.
+
+    Every key is handed out only once. Taking a key starts a background greenlet
+    which refills the pool, generating one key at a time when the hub is idle,
+    so connection setup only pays for key generation when the pool ran dry.
+    """
+    size = 16  # 0 disables the pool
+
+    def __init__(self, size=None):
+        if size is not None:
+            self.size = size
+        self.keys = collections.deque()
+        self.num_hits = 0
+        self.num_misses = 0
+        self._refill = None
+
+    def get(self):
+        "returns an unused ECCx keypair"
+        if self.keys:
+            self.num_hits += 1
+            key = self.keys.popleft()
+        else:
+            self.num_misses += 1
+            key = ECCx()
+        self.start()
+        return key
+
+    def start(self):
+        "starts refilling the pool in the background"
+        if len(self.keys) < self.size and not self._refill:
+            self._refill = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._refill:
+            self._refill.kill()
+
+    def _run(self):
+        try:
+            while len(self.keys) < self.size:
+                gevent.idle()  # yield to all other greenlets which are ready
+                self.keys.append(ECCx())
+        finally:
+            self._refill = None
+
+
+# process-wide, used by the handshakes and ECIES of all sessions, sized by PeerManager.start
+ephemeral_keys = EphemeralKeyPool()
+
+
+class NodeIdentity(object):
+
+    """
+    The static keypair of this node.
+
+    Derived once from config['node']['privkey_hex'] and shared by the peer
+    manager, discovery and all RLPx sessions, so the public key and the ECC
+    context are not recomputed per connection.
+    """
+
+    def __init__(self, raw_privkey):
+        assert len(raw_privkey) == 32
+        self.raw_privkey = raw_privkey
+        self.privkey = PrivateKey(raw_privkey)
+        self.raw_pubkey = self.privkey.public_key.format(compressed=False)[1:]
+        self._ecc = None
+
+    @classmethod
+    def of_app(cls, app):
+        "returns the identity of app, created on first use and stored as app.node_identity"
+        raw_privkey = decode_hex(app.config['node']['privkey_hex'])
+        identity = getattr(app, 'node_identity', None)
+        if identity is None or identity.raw_privkey != raw_privkey:
+            identity = cls(raw_privkey)
+            app.node_identity = identity
+        return identity
+
+    @property
+    def ecc(self):
+        "ECCx of the static key, it only holds immutable key data and can be shared"
+        if self._ecc is None:
+            self._ecc = ECCx(raw_privkey=self.raw_privkey)
+        return self._ecc
+
+    def sign(self, msghash):
+        return self.privkey.sign_recoverable(msghash, hasher=None)
+
+
 def lzpad32(x):
     return '\x00' * (32 - len(x)) + x
 
@@ -258,6 +388,15 @@ def ecdsa_recover(message, signature):
 recover = ecdsa_recover
 
 
+def is_valid_pubkey(raw_pubkey):
+    "checks that the 64 byte raw_pubkey is a point on the curve"
+    try:
+        PublicKey(b'\x04' + raw_pubkey)
+    except ValueError:
+        return False
+    return len(raw_pubkey) == 64
+
+
 def sha3(seed):
     return sha3_256(seed).digest()
 
@@ -267,7 +406,7 @@ def mk_privkey(seed):
 
 
 def privtopub(raw_privkey):
-    raw_pubkey = bitcoin.encode_pubkey(bitcoin.privtopub(raw_privkey), 'bin_electrum')
+    raw_pubkey = PrivateKey(raw_privkey).public_key.format(compressed=False)[1:]
     assert len(raw_pubkey) == 64
     return raw_pubkey
 
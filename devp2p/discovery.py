@@ -8,7 +8,7 @@ import gevent
 import gevent.socket
 import ipaddress
 import rlp
-from rlp.utils import decode_hex, is_integer, str_to_bytes, bytes_to_str, safe_ord
+from rlp.utils import is_integer, str_to_bytes, bytes_to_str, safe_ord
 from gevent.server import DatagramServer
 
 from devp2p import slogging
@@ -211,8 +211,9 @@ class DiscoveryProtocol(kademlia.WireInterface):
     def __init__(self, app, transport):
         self.app = app
         self.transport = transport
-        self.privkey = decode_hex(app.config['node']['privkey_hex'])
-        self.pubkey = crypto.privtopub(self.privkey)
+        self.node_identity = crypto.NodeIdentity.of_app(app)
+        self.privkey = self.node_identity.raw_privkey
+        self.pubkey = self.node_identity.raw_pubkey
         self.nodes = LRUCache(2048)   # nodeid->Node,  fixme should be loaded
         self.this_node = Node(self.pubkey, self.transport.address)
         self.kademlia = KademliaProtocolAdapter(self.this_node, wire=self)
@@ -242,7 +243,7 @@ class DiscoveryProtocol(kademlia.WireInterface):
             // implementation w/MCD
         """
         msg = crypto.sha3(msg)
-        return crypto.sign(msg, self.privkey)
+        return self.node_identity.sign(msg)
 
     def pack(self, cmd_id, payload):
         """
@@ -280,7 +281,7 @@ class DiscoveryProtocol(kademlia.WireInterface):
         expiration = self.encoders['expiration'](int(time.time() + self.expiration))
         encoded_data = rlp.encode(payload + [expiration])
         signed_data = crypto.sha3(cmd_id + encoded_data)
-        signature = crypto.sign(signed_data, self.privkey)
+        signature = self.node_identity.sign(signed_data)
         # assert crypto.verify(self.pubkey, signature, signed_data)
         # assert self.pubkey == crypto.ecdsa_recover(signed_data, signature)
         # assert crypto.verify(self.pubkey, signature, signed_data)
@@ -0,0 +1,103 @@
+"""
+Encoding and decoding of RLPx frame headers without a pyrlp round-trip.
+
+header: frame-size || header-data || padding
+frame-size: 3-byte integer size of frame, big endian encoded
+header-data:
+    normal: rlp.list(protocol-type[, sequence-id])
+    chunked-0: rlp.list(protocol-type, sequence-id, total-packet-size)
+    chunked-n: rlp.list(protocol-type, sequence-id)
+padding: zero-fill to 16-byte boundary
+
+header-data holds at most three integers < 2**32, so the rlp list is at most
+16 bytes long and can be built from a table of small integer encodings.
+The results are byte-for-byte identical to rlp.encode/rlp.decode with header_data_sedes.
+"""
+import struct
+import rlp
+from rlp.utils import ascii_chr
+
+header_size = 16
+
+# reference sedes the codec is compatible with
+header_data_sedes = rlp.sedes.List([rlp.sedes.big_endian_int] * 3, strict=False)
+
+_small_ints = tuple(rlp.encode(i) for i in range(256))
+_padding = tuple(b'\x00' * (header_size - i) for i in range(header_size + 1))
+_list_prefixes = tuple(ascii_chr(0xc0 + i) for i in range(56))
+
+
+def encode_int(value):
+    "rlp encodes an integer < 2**32"
+    if value < 256:
+        return _small_ints[value]
+    elif value < 2**16:
+        return b'\x82' + struct.pack('>H', value)
+    elif value < 2**24:
+        return b'\x83' + struct.pack('>I', value)[1:]
+    assert value < 2**32
+    return b'\x84' + struct.pack('>I', value)
+
+
+def encode_header_data(protocol_id, sequence_id=None, total_payload_size=None):
+    assert protocol_id < 2**16
+    data = encode_int(protocol_id)
+    if sequence_id is not None:
+        assert sequence_id < 2**16
+        data += encode_int(sequence_id)
+        if total_payload_size is not None:
+            data += encode_int(total_payload_size)
+    else:
+        assert total_payload_size is None
+    return _list_prefixes[len(data)] + data
+
+
+def encode_header(body_size, protocol_id, sequence_id=None, total_payload_size=None):
+    "returns the padded (unencrypted) 16 byte frame header"
+    assert body_size < 256**3
+    header = struct.pack('>I', body_size)[1:] + \
+        encode_header_data(protocol_id, sequence_id, total_payload_size)
+    return header + _padding[len(header)]
+
+
+def decode_header_data(data):
+    """
+    decodes header-data into a tuple of up to three integers,
+    trailing data (i.e. padding) is ignored.
+
+    raises rlp.DecodingError for all data rlp.decode(data, header_data_sedes, strict=False)
+    rejects, and also for truncated or nested lists which pyrlp silently accepts.
+    """
+    b = bytearray(data)
+    if not b or not 0xc0 <= b[0] < 0xc0 + 56:
+        raise rlp.DecodingError('header-data is not a short list', data)
+    end = 1 + b[0] - 0xc0
+    if end > len(b):
+        raise rlp.DecodingError('header-data list exceeds header', data)
+    values = []
+    pos = 1
+    while pos < end:
+        prefix = b[pos]
+        if prefix < 0x80:  # single byte
+            if prefix == 0:  # zero is encoded as empty string
+                raise rlp.DecodingError('Invalid serialization (not minimal length)', data)
+            values.append(prefix)
+            pos += 1
+            continue
+        if prefix >= 0x80 + 56:
+            raise rlp.DecodingError('header-data must only contain short strings', data)
+        length = prefix - 0x80
+        pos += 1
+        if pos + length > end:
+            raise rlp.DecodingError('header-data item exceeds list', data)
+        if length == 1 and b[pos] < 0x80:
+            raise rlp.DecodingError('Encoded as short string although single byte was possible',
+                                    data)
+        if length and b[pos] == 0:
+            raise rlp.DecodingError('Invalid serialization (not minimal length)', data)
+        value = 0
+        for i in range(pos, pos + length):
+            value = value << 8 | b[i]
+        values.append(value)
+        pos += length
+    return tuple(values[:3])
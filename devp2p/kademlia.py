@@ -14,6 +14,7 @@ the idle bucket-refresh interval is 3600 seconds.
 Aside from the previously described exclusions, node discovery closely follows system
 and protocol described by Maymounkov and Mazieres.
 """
+import heapq
 import operator
 import random
 import time
@@ -98,6 +99,7 @@ class KBucket(object):
         self.nodes = []
         self.replacement_cache = []
         self.last_updated = time.time()
+        self._min_id = self._max_id = None  # id range of the nodes, see depth
 
     @property
     def range(self):
@@ -113,6 +115,11 @@ class KBucket(object):
     def id_distance(self, id):
         return self.midpoint ^ id
 
+    def min_id_distance(self, id):
+        "smallest distance of id to the ids in range, buckets cover all ids with a common prefix"
+        free_bits = (self.start ^ self.end).bit_length()
+        return (self.start ^ id) >> free_bits << free_bits
+
     def nodes_by_id_distance(self, id):
         assert is_integer(id)
         return sorted(self.nodes, key=operator.methodcaller('id_distance', id))
@@ -143,6 +150,9 @@ class KBucket(object):
         if node not in self.nodes:
             return
         self.nodes.remove(node)
+        if node.id in (self._min_id, self._max_id):
+            ids = [n.id for n in self.nodes]
+            self._min_id, self._max_id = (min(ids), max(ids)) if ids else (None, None)
 
     def in_range(self, node):
         return self.start <= node.id <= self.end
@@ -173,6 +183,10 @@ class KBucket(object):
             self.nodes.append(node)
         elif len(self) < self.k:  # add if fewer than k entries
             self.nodes.append(node)
+            if self._min_id is None or node.id < self._min_id:
+                self._min_id = node.id
+            if self._max_id is None or node.id > self._max_id:
+                self._max_id = node.id
         else:  # bucket is full
             return self.head
 
@@ -192,18 +206,10 @@ class KBucket(object):
         depth is the prefix shared by all nodes in bucket
         i.e. the number of shared leading bits
         """
-        def to_binary(x):  # left padded bit representation
-            b = bin(x)[2:]
-            return '0' * (k_id_size - len(b)) + b
-
         if len(self.nodes) < 2:
             return k_id_size
-
-        bits = [to_binary(n.id) for n in self.nodes]
-        for i in range(k_id_size):
-            if len(set(b[:i] for b in bits)) != 1:
-                return i - 1
-        raise Exception
+        # all ids share the prefix which the smallest and the largest one share
+        return k_id_size - (self._min_id ^ self._max_id).bit_length()
 
     def __contains__(self, node):
         return node in self.nodes
@@ -214,15 +220,28 @@ class KBucket(object):
 
 class RoutingTable(object):
 
+    use_id_store = False  # keep the ids in a NodeIdStore for vectorized queries, needs numpy
+
     def __init__(self, node):
         self.this_node = node
         self.buckets = [KBucket(0, k_max_node_id)]
+        self._index = dict()  # pubkey -> (node, bucket) of the nodes in the buckets
+        self.id_store = None
+        if self.use_id_store:
+            try:  # numpy is optional, so it is only imported if needed
+                from .nodeidstore import NodeIdStore
+            except ImportError:
+                raise ImportError('the id store requires numpy')
+            self.id_store = NodeIdStore()
 
     def split_bucket(self, bucket):
         a, b = bucket.split()
         index = self.buckets.index(bucket)
         self.buckets[index] = a
         self.buckets.insert(index + 1, b)
+        for new_bucket in (a, b):
+            for node in new_bucket.nodes:
+                self._index[node.pubkey] = node, new_bucket
 
     @property
     def idle_buckets(self):
@@ -234,13 +253,31 @@ class RoutingTable(object):
         return [b for b in self.buckets if len(b) < k_bucket_size]
 
     def remove_node(self, node):
-        self.bucket_by_node(node).remove_node(node)
+        node, bucket = self._index.pop(node.pubkey, (node, None))
+        if bucket:
+            bucket.remove_node(node)
+            if self.id_store is not None:
+                self.id_store.remove(node.pubkey)
+
+    def get_node(self, pubkey):
+        "returns the node with pubkey if it is in the table"
+        entry = self._index.get(pubkey)
+        return entry[0] if entry else None
+
+    def _add_to_bucket(self, bucket, node):
+        "returns the eviction candidate if the bucket is full"
+        eviction_candidate = bucket.add_node(node)
+        if not eviction_candidate:  # added or moved to the tail
+            self._index[node.pubkey] = node, bucket
+            if self.id_store is not None:
+                self.id_store.add(node)
+        return eviction_candidate
 
     def add_node(self, node):
         assert node != self.this_node
         # log.debug('add_node', node=node)
         bucket = self.bucket_by_node(node)
-        eviction_candidate = bucket.add_node(node)
+        eviction_candidate = self._add_to_bucket(bucket, node)
         if eviction_candidate:  # bucket is full
             # log.debug('bucket is full', node=node, eviction_candidate=eviction_candidate)
             # split if the bucket has the local node in its range
@@ -270,10 +307,10 @@ class RoutingTable(object):
         return self.buckets_by_id_distance(node.id)
 
     def __contains__(self, node):
-        return node in self.bucket_by_node(node)
+        return node.pubkey in self._index
 
     def __len__(self):
-        return sum(len(b) for b in self.buckets)
+        return len(self._index)
 
     def __iter__(self):
         for b in self.buckets:
@@ -282,30 +319,85 @@ class RoutingTable(object):
 
     def neighbours(self, node, k=k_bucket_size):
         """
-        sorting by bucket.midpoint does not work in edge cases
-        build a short list of k * 2 nodes and sort and shorten it
+        returns the k nodes closest to node (or an id), closest first
+
+        buckets are visited in the order of the smallest distance an id in their
+        range can have. once k nodes were found and the next bucket can only
+        hold more distant ones, the closest nodes are known.
         """
         assert isinstance(node, Node) or is_integer(node)
         if isinstance(node, Node):
             node = node.id
-        nodes = []
-        for bucket in self.buckets_by_id_distance(node):
-            for n in bucket.nodes_by_id_distance(node):
-                if n is not node:
-                    nodes.append(n)
-                    if len(nodes) == k * 2:
-                        break
-        return sorted(nodes, key=operator.methodcaller('id_distance', node))[:k]
+        buckets = [(b.min_id_distance(node), i) for i, b in enumerate(self.buckets) if b.nodes]
+        heapq.heapify(buckets)
+        closest = []  # heap of the k closest nodes found so far as (-distance, node)
+        while buckets:
+            min_distance, i = heapq.heappop(buckets)
+            if len(closest) == k and min_distance > -closest[0][0]:
+                break
+            for n in self.buckets[i].nodes:
+                distance = n.id ^ node
+                if len(closest) < k:
+                    heapq.heappush(closest, (-distance, n))
+                elif distance < -closest[0][0]:
+                    heapq.heapreplace(closest, (-distance, n))
+        return [n for _, n in sorted(closest, reverse=True)]
 
     def neighbours_within_distance(self, id, distance):
         """
         naive correct version simply compares all nodes
         """
         assert is_integer(id)
+        if self.id_store is not None:
+            return self.id_store.within_distance(id, distance)
         nodes = list(n for n in self if n.id_distance(id) <= distance)
         return sorted(nodes, key=operator.methodcaller('id_distance', id))
 
 
+class LogDistanceRoutingTable(RoutingTable):
+
+    """
+    Buckets indexed by the log distance of their nodes to this_node, i.e. the
+    bit_length of the xor of the ids, so bucket_by_node is an array lookup.
+
+    The bucket at distance d holds the ids sharing the first k_id_size - d bits
+    with this_node and differing in the next one, which is a contiguous id range,
+    so KBucket and its eviction work as in RoutingTable. Buckets are never split.
+    A bucket is only created once a node at its distance is seen, as most of the
+    near distances can't be populated, and idle bucket refresh and the checks of
+    not full buckets only consider the created ones. Unlike in RoutingTable
+    buckets which don't cover this_node are not split down to a depth of a
+    multiple of k_b, i.e. each distance holds at most k nodes.
+    """
+
+    def __init__(self, node):
+        RoutingTable.__init__(self, node)
+        self._buckets_by_distance = [None] * (k_id_size + 1)
+        self.buckets = []  # the created buckets, ordered by id range like RoutingTable.buckets
+
+    def _new_bucket(self, distance):
+        this_id = self.this_node.id
+        if distance == 0:
+            return KBucket(this_id, this_id)
+        bit = 1 << (distance - 1)
+        start = (this_id >> distance << distance) | (~this_id & bit)
+        return KBucket(start, start | (bit - 1))
+
+    def add_node(self, node):
+        assert node != self.this_node
+        # returns the head of a full bucket as eviction candidate
+        return self._add_to_bucket(self.bucket_by_node(node), node)
+
+    def bucket_by_node(self, node):
+        distance = (self.this_node.id ^ node.id).bit_length()
+        bucket = self._buckets_by_distance[distance]
+        if bucket is None:
+            bucket = self._buckets_by_distance[distance] = self._new_bucket(distance)
+            self.buckets.append(bucket)
+            self.buckets.sort(key=operator.attrgetter('start'))
+        return bucket
+
+
 class WireInterface(object):
 
     """
@@ -352,12 +444,14 @@ class FindNodeTask(object):
 
 class KademliaProtocol(object):
 
+    routing_table_class = RoutingTable  # or LogDistanceRoutingTable
+
     def __init__(self, node, wire):
         assert isinstance(node, Node)  # the local node
         assert isinstance(wire, WireInterface)
         self.this_node = node
         self.wire = wire
-        self.routing = RoutingTable(node)
+        self.routing = self.routing_table_class(node)
         self._expected_pongs = dict()  # pingid -> (timeout, node, replacement_node)
         self._find_requests = dict()  # nodeid -> timeout
         self._deleted_pingids = set()
@@ -532,11 +626,11 @@ class KademliaProtocol(object):
         assert remote != self.this_node
         pingid = self._mkpingid(echoed, remote)
         log.debug('recv pong', remote=remote, pingid=encode_hex(pingid)[:8], local=self.this_node)
-        # update address (clumsy fixme)
+        # update address
         if hasattr(remote, 'address'):  # not available in tests
-            nnodes = self.routing.neighbours(remote)
-            if nnodes and nnodes[0] == remote:
-                nnodes[0].address = remote.address  # updated tcp address
+            node = self.routing.get_node(remote.pubkey)
+            if node:
+                node.address = remote.address  # updated tcp address
         # update rest
         self.update(remote, pingid)
 
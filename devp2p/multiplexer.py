@@ -1,14 +1,11 @@
 from gevent.queue import Queue
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import rlp
 from rlp.utils import str_to_bytes, is_integer
 import struct
-import sys
-
-sys.setrecursionlimit(10000)  # frames are generated recursively
-
-# chunked-0: rlp.list(protocol-type, sequence-id, total-packet-size)
-header_data_sedes = rlp.sedes.List([rlp.sedes.big_endian_int] * 3, strict=False)
+import time
+from . import frameheader
+from .scheduler import DeficitRoundRobinScheduler
 
 
 def ceil16(x):
@@ -33,6 +30,104 @@ class FormatError(MultiplexerError):
     pass
 
 
+class DecodeBuffer(object):
+
+    """
+    Buffer for incoming data which tracks a read offset.
+
+    Decoded frames are consumed by advancing the offset, so no data is copied per frame.
+    The consumed head of the buffer is only discarded when new data is added and it
+    makes up at least half of the buffer, which keeps the copying amortized O(1) per byte.
+    Memoryviews returned by view() must not be kept across calls to extend().
+    """
+
+    def __init__(self, data=b''):
+        self._buffer = bytearray(data)
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def extend(self, data):
+        if self._offset and self._offset * 2 >= len(self._buffer):
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer.extend(data)
+
+    def view(self):
+        "returns a memoryview of the unconsumed data"
+        return memoryview(self._buffer)[self._offset:]
+
+    def locate(self, offset=0):
+        "returns (bytearray, position) of the unconsumed data at offset, for reading in place"
+        return self._buffer, self._offset + offset
+
+    def consume(self, size):
+        assert 0 <= size <= len(self)
+        self._offset += size
+
+
+class ChunkedBuffer(object):
+
+    """
+    Reassembles the payload of a chunked packet.
+
+    The payload is preallocated to the size announced by the chunked-0 frame
+    and filled in place as the chunked-n frames arrive.
+    For a PacketStream the chunks are passed on instead and nothing is allocated.
+    """
+
+    def __init__(self, packet, sequence_id, total_payload_size):
+        self.packet = packet
+        self.sequence_id = sequence_id
+        self.total_payload_size = total_payload_size
+        self.is_stream = isinstance(packet, PacketStream)
+        if not self.is_stream:
+            self._payload = bytearray(total_payload_size)
+            self._view = memoryview(self._payload)
+        self.size = 0  # bytes received so far
+        self.last_update = time.time()
+
+    @property
+    def reserved_size(self):
+        "bytes counted against the reassembly budget"
+        return 0 if self.is_stream else self.total_payload_size
+
+    @property
+    def is_complete(self):
+        return self.size == self.total_payload_size
+
+    def _check_size(self, size):
+        if size > self.total_payload_size - self.size:
+            raise MultiplexerError('too much data for chunked buffer %d of protocol %d' %
+                                   (self.sequence_id, self.packet.protocol_id))
+
+    def reserve(self, size):
+        "returns (payload, offset) for writing the next size bytes in place, see added"
+        assert not self.is_stream
+        self._check_size(size)
+        return self._payload, self.size
+
+    def add(self, chunk):
+        self._check_size(len(chunk))
+        if self.is_stream:
+            self.packet.feed(chunk)
+        else:
+            self._view[self.size:self.size + len(chunk)] = chunk
+        self.added(len(chunk))
+
+    def added(self, size):
+        "to be called once size bytes were written to the space returned by reserve"
+        self.size += size
+        self.last_update = time.time()
+        if self.is_complete:
+            if self.is_stream:
+                self.packet.close()
+            else:
+                self.packet.payload = self._view
+                self._view = None
+
+
 class FrameCipherBase(object):
     mac_len = 16
     header_len = 32
@@ -86,6 +181,7 @@ class Frame(object):
     total_payload_size = None  # only used with chunked_0
     frame_cipher = None
     cipher_called = False
+    _header = None
 
     def __init__(self, protocol_id, cmd_id, payload, sequence_id, window_size,
                  is_chunked_n=False, frames=None, frame_cipher=None):
@@ -97,31 +193,58 @@ class Frame(object):
         self.payload = payload
         if frame_cipher:
             self.frame_cipher = frame_cipher
-        self.frames = frames or []
+        self.frames = frames if frames is not None else []
         assert protocol_id < 2**16
         self.protocol_id = protocol_id
         assert sequence_id is None or sequence_id < 2**16
         self.sequence_id = sequence_id
         self.is_chunked_n = is_chunked_n
+        if is_chunked_n:
+            self.enc_cmd_id = b''
+        else:
+            self.enc_cmd_id = frameheader.encode_int(cmd_id)  # unsigned byte
         self.frames.append(self)
 
         # chunk payloads resulting in frames exceeding window_size
-        fs = self.frame_size()
-        if fs > window_size:
-            if not is_chunked_n:
-                self.is_chunked_0 = True
-                self.total_payload_size = self.body_size()
-            # chunk payload
-            self.payload = payload[:window_size - fs]
-            assert self.frame_size() <= window_size
-            remain = payload[len(self.payload):]
-            assert len(remain) + len(self.payload) == len(payload)
-            Frame(protocol_id, cmd_id, remain, sequence_id, window_size,
-                  is_chunked_n=True,
-                  frames=self.frames,
-                  frame_cipher=frame_cipher)
+        if self.frame_size() > window_size:
+            self._chunk(window_size)
         assert self.frame_size() <= window_size
 
+    def _chunk(self, window_size):
+        """
+        Splits the payload into frames of at most window_size bytes with a PacketFramer,
+        like the Multiplexer does, so this frame becomes the chunked-0 frame.
+        """
+        assert not self.is_chunked_n  # chunked-n frames are only cut by PacketFramer
+        framer = PacketFramer(Packet(self.protocol_id, self.cmd_id, self.payload),
+                              self.sequence_id, frame_cipher=self.frame_cipher)
+        first = framer.pop_frame(window_size)
+        self.payload = first.payload
+        self.is_chunked_0 = True
+        self.total_payload_size = first.total_payload_size
+        while not framer.is_done:
+            frame = framer.pop_frame(window_size)
+            frame.frames = self.frames
+            self.frames.append(frame)
+
+    @classmethod
+    def _new(cls, protocol_id, cmd_id, payload, sequence_id, is_chunked_n=False,
+             enc_cmd_id=None, frame_cipher=None):
+        "creates a single frame without the checks and chunking done by __init__"
+        frame = cls.__new__(cls)
+        frame.cmd_id = cmd_id
+        frame.payload = payload
+        frame.frame_cipher = frame_cipher
+        frame.frames = [frame]
+        frame.protocol_id = protocol_id
+        frame.sequence_id = sequence_id
+        frame.is_chunked_n = is_chunked_n
+        if is_chunked_n:
+            frame.enc_cmd_id = b''
+        else:
+            frame.enc_cmd_id = enc_cmd_id or frameheader.encode_int(cmd_id)
+        return frame
+
     def __repr__(self):
         return '<Frame(%s, len=%d sid=%r)>' % \
             (self._frame_type(), self.frame_size(), self.sequence_id)
@@ -161,33 +284,26 @@ class Frame(object):
                 total-packet-size: < 2**32
         padding: zero-fill to 16-byte boundary
         """
+        if self._header is None:
+            self._header = self._encode_header()
+        return self._header
+
+    def _encode_header(self):
         assert self.protocol_id < 2**16
         assert self.sequence_id is None or self.sequence_id < 2**16
-        l = [self.protocol_id]
-        if self.is_chunked_0:
-            assert self.sequence_id is not None
-            l.append(self.sequence_id)
-            l.append(self.total_payload_size)
-        elif self.sequence_id is not None:  # normal, chunked_n
-            l.append(self.sequence_id)
-        header_data = rlp.encode(l, sedes=header_data_sedes)
-        assert tuple(l) == rlp.decode(header_data, sedes=header_data_sedes, strict=False)
         # write body_size to header
         # frame-size: 3-byte integer size of frame, big endian encoded (excludes padding)
         # frame relates to body w/o padding w/o mac
-        body_size = self.body_size()
-        assert body_size < 256**3
-        header = struct.pack('>I', body_size)[1:] + header_data
-        header = rzpad16(header)  # padding
+        if self.is_chunked_0:
+            assert self.sequence_id is not None
+            header = frameheader.encode_header(self.body_size(), self.protocol_id,
+                                               self.sequence_id, self.total_payload_size)
+        else:  # normal, chunked_n
+            header = frameheader.encode_header(self.body_size(), self.protocol_id,
+                                               self.sequence_id)
         assert len(header) == self.header_size
         return header
 
-    @property
-    def enc_cmd_id(self):
-        if not self.is_chunked_n:
-            return rlp.encode(self.cmd_id, sedes=rlp.sedes.big_endian_int)  # unsigned byte
-        return b''
-
     @property
     def body(self):
         """
@@ -250,6 +366,178 @@ class Packet(object):
         return len(self.payload)
 
 
+class PacketStream(Packet):
+
+    """
+    A chunked packet which is delivered as soon as its first frame is decoded.
+
+    Iterating over the stream yields the payload in chunks as the frames arrive,
+    blocking until the next one is decoded. payload stays empty.
+    Iteration raises MultiplexerError if the packet is dropped before it is complete.
+    """
+
+    _discarded = False
+
+    def __init__(self, protocol_id, cmd_id, total_payload_size, on_consume=None):
+        super(PacketStream, self).__init__(protocol_id, cmd_id)
+        self.total_payload_size = total_payload_size
+        self._chunks = Queue()
+        self._on_consume = on_consume  # called with the size of each chunk taken
+
+    def feed(self, chunk):
+        if self._discarded:
+            self._consumed(chunk)
+        else:
+            self._chunks.put(chunk)
+
+    def _consumed(self, chunk):
+        if self._on_consume:
+            self._on_consume(len(chunk))
+
+    def discard(self):
+        "drops the chunks not consumed so far and the ones still to arrive"
+        self._discarded = True
+        while not self._chunks.empty():
+            chunk = self._chunks.get_nowait()
+            if isinstance(chunk, bytes):
+                self._consumed(chunk)
+
+    def close(self, error=None):
+        "ends the stream, error is raised by the consumer instead of ending iteration"
+        self._chunks.put(error)
+
+    def __iter__(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            self._consumed(chunk)
+            yield chunk
+
+
+class StreamSource(object):
+
+    """
+    Payload of a packet which is read lazily while the packet is sent.
+
+    source is an iterator of byte strings, a file object or an mmap
+    and must provide exactly size bytes.
+    """
+
+    def __init__(self, source, size):
+        self.size = size
+        self.remaining = size
+        if hasattr(source, 'read'):  # file object or mmap
+            self._read = source.read
+        else:
+            self._chunks = iter(source)
+            self._rest = b''
+            self._read = self._read_chunks
+
+    def __len__(self):
+        return self.size
+
+    def _read_chunks(self, size):
+        parts, num_bytes = [self._rest], len(self._rest)
+        while num_bytes < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            num_bytes += len(chunk)
+        data = b''.join(parts)
+        self._rest = data[size:]
+        return data[:size]
+
+    def _read_source(self, size):
+        try:
+            return self._read(size)
+        except Exception as e:  # e.g. an IOError of a file, the packet can't be completed
+            raise MultiplexerError('stream source failed: %r' % e)
+
+    def read(self, size):
+        """
+        returns the next min(size, remaining) bytes.
+        raises MultiplexerError if the source fails or ends early
+        """
+        size = min(size, self.remaining)
+        data = self._read_source(size)
+        while len(data) < size:  # short reads, e.g. from pipes
+            more = self._read_source(size - len(data))
+            if not more:
+                raise MultiplexerError('stream source ended %d bytes before its declared size' %
+                                       (self.remaining - len(data)))
+            data += more
+        self.remaining -= size
+        return data
+
+
+class PacketFramer(object):
+
+    """
+    Cuts the frames of a queued packet one at a time, when they are about to be sent.
+
+    Each frame is sized by the window size at the time it is cut, so a packet is
+    only chunked if it exceeds the window when it is sent. The frame payloads are
+    slices of the packet payload or, for a StreamSource, only then read from the source.
+    """
+
+    def __init__(self, packet, sequence_id, frame_cipher=None):
+        self.packet = packet
+        self.sequence_id = sequence_id
+        self.frame_cipher = frame_cipher
+        if isinstance(packet.payload, StreamSource):
+            self.source = packet.payload
+        else:
+            self.source = None
+            self._view = memoryview(packet.payload)
+        self.payload_size = len(packet.payload)
+        self.offset = 0  # payload bytes framed so far
+        self.enc_cmd_id = frameheader.encode_int(packet.cmd_id)
+        self.total_payload_size = len(self.enc_cmd_id) + self.payload_size
+        self.num_frames = 0  # frames cut so far
+
+    @property
+    def is_done(self):
+        return self.num_frames > 0 and self.offset == self.payload_size
+
+    @property
+    def buffered_size(self):
+        "payload bytes held in memory until they are framed"
+        return 0 if self.source is not None else self.payload_size - self.offset
+
+    def _body_size(self, window_size):
+        max_body_size = window_size - Frame.header_size - 2 * Frame.mac_size
+        assert max_body_size > len(self.enc_cmd_id)
+        if self.num_frames:
+            return min(self.payload_size - self.offset, max_body_size)
+        return min(self.total_payload_size, max_body_size)
+
+    def next_frame_size(self, window_size):
+        return Frame.header_size + 2 * Frame.mac_size + ceil16(self._body_size(window_size))
+
+    def pop_frame(self, window_size):
+        assert not self.is_done
+        body_size = self._body_size(window_size)
+        is_chunked_n = self.num_frames > 0
+        size = body_size if is_chunked_n else body_size - len(self.enc_cmd_id)
+        if self.source is not None:
+            payload = memoryview(self.source.read(size))
+        else:
+            payload = self._view[self.offset:self.offset + size]
+        self.offset += size
+        frame = Frame._new(self.packet.protocol_id, self.packet.cmd_id, payload,
+                           self.sequence_id, is_chunked_n=is_chunked_n,
+                           enc_cmd_id=self.enc_cmd_id, frame_cipher=self.frame_cipher)
+        if not is_chunked_n and body_size < self.total_payload_size:
+            frame.is_chunked_0 = True
+            frame.total_payload_size = self.total_payload_size
+        self.num_frames += 1
+        return frame
+
+
 class Multiplexer(object):
 
     """
@@ -273,33 +561,54 @@ class Multiplexer(object):
         normal
         chunked
 
-    protocols are queried round robin
+    protocols are queried round robin, the bytes sent per turn are determined by
+    the scheduler (weighted deficit round robin by default, see scheduler.py)
 
     """
 
     max_window_size = 8 * 1024
     max_priority_frame_size = 1024
     max_payload_size = 10 * 1024**2
+    # limits for the reassembly of received chunked packets
+    max_reassembly_size = 32 * 1024**2  # announced bytes of all incomplete packets
+    max_chunked_buffers = 16  # concurrent incomplete packets
+    chunked_buffer_timeout = 60.  # seconds without a frame before a packet is dropped
+    # optional callable(protocol_id, cmd_id), True if chunked packets of the command
+    # are delivered as PacketStream
+    stream_filter = None
     frame_cipher = None
     _cached_decode_header = None
 
-    def __init__(self, frame_cipher=None):
+    def __init__(self, frame_cipher=None, scheduler=None):
         if frame_cipher:
             # assert isinstance(frame_cipher, FrameCipherBase)
             self.frame_cipher = frame_cipher
+        self.scheduler = scheduler or DeficitRoundRobinScheduler()
         self.queues = OrderedDict()  # protocol_id : dict(normal=queue, chunked=queue, prio=queue)
         self.sequence_id = dict() # protocol_id : counter
-        self.last_protocol = None  # last protocol, which sent data to the buffer
-        self.chunked_buffers = dict()  # decode: protocol_id: dict(sequence_id: buffer)
-        self._decode_buffer = bytearray()
+        self.chunked_buffers = dict()  # decode: protocol_id: dict(sequence_id: ChunkedBuffer)
+        self.num_chunked_buffers = 0
+        self.reassembly_size = 0  # sum of total_payload_size of the chunked buffers
+        # (protocol_id, sequence_id) of evicted chunked packets:
+        # [payload bytes still to drop, time of the eviction or the last dropped frame]
+        self.evicted_chunked_buffers = OrderedDict()
+        self._decode_buffer = DecodeBuffer()
+        # scheduler bookkeeping, maintained on every enqueue and dequeue
+        self._num_queued_packets = dict()  # protocol_id : number of packets in its queues
+        self._num_active_protocols = 0
+        # ring of the active protocols in the order they are served. drained protocols
+        # are removed once they are reached, so it may contain inactive ones
+        self._active_protocols = deque()
+        self._ring_members = set()  # protocol_ids in self._active_protocols
+        self.num_queued_bytes = 0  # payload bytes of the queued packets not yet framed
 
     @property
     def num_active_protocols(self):
         "A protocol is considered active if it's queue contains one or more packets."
-        return sum(1 for p_id in self.queues if self.is_active_protocol(p_id))
+        return self._num_active_protocols
 
     def is_active_protocol(self, protocol_id):
-        return True if sum(q.qsize() for q in self.queues[protocol_id].values()) else False
+        return self._num_queued_packets[protocol_id] > 0
 
     def protocol_window_size(self, protocol_id=None):
         """
@@ -312,47 +621,74 @@ class Multiplexer(object):
             s = self.max_window_size // max(1, self.num_active_protocols)
         return s - s % 16  # should be a multiple of padding size
 
-    def add_protocol(self, protocol_id):
+    def add_protocol(self, protocol_id, weight=1, max_bandwidth=None):
+        """
+        weight: share of the bandwidth relative to the other protocols
+        max_bandwidth: optional cap in bytes per second
+        """
         assert protocol_id not in self.queues
         self.queues[protocol_id] = dict(normal=Queue(),
                                         chunked=Queue(),
                                         priority=Queue())
         self.sequence_id[protocol_id] = 0
         self.chunked_buffers[protocol_id] = dict()
-        self.last_protocol = protocol_id
+        self._num_queued_packets[protocol_id] = 0
+        self.scheduler.add_protocol(protocol_id, weight, max_bandwidth)
 
-    @property
-    def next_protocol(self):
-        protocols = tuple(self.queues.keys())
-        if self.last_protocol == protocols[-1]:
-            next_protocol = protocols[0]
-        else:
-            next_protocol = protocols[protocols.index(self.last_protocol) + 1]
-        self.last_protocol = next_protocol
-        return next_protocol
+    def iter_active_protocols(self):
+        """
+        yields the active protocols in round robin order.
+        each one is moved to the end of the ring before it is yielded, so the next
+        call starts with its successor and consuming all of them keeps the order.
+        """
+        ring = self._active_protocols
+        for i in range(len(ring)):
+            p = ring[0]
+            ring.rotate(-1)
+            if self._num_queued_packets[p]:
+                yield p
+            else:
+                ring.pop()
+                self._ring_members.remove(p)
+
+    def _put_packet(self, protocol_id, queue_name, framer):
+        if not self._num_queued_packets[protocol_id]:
+            self._num_active_protocols += 1
+            if protocol_id not in self._ring_members:
+                self._active_protocols.append(protocol_id)
+                self._ring_members.add(protocol_id)
+        self._num_queued_packets[protocol_id] += 1
+        self.num_queued_bytes += framer.buffered_size
+        self.queues[protocol_id][queue_name].put(framer)
+
+    def _remove_packet(self, protocol_id, queue):
+        self._num_queued_packets[protocol_id] -= 1
+        if not self._num_queued_packets[protocol_id]:
+            self._num_active_protocols -= 1
+        framer = queue.get()
+        self.num_queued_bytes -= framer.buffered_size
 
     def add_packet(self, packet):
+        """
+        queues the packet, it is framed when it is sent (see pop_frames_for_protocol)
+        """
         #protocol_id, cmd_id, rlp_data, prioritize=False
         sid = self.sequence_id[packet.protocol_id]
         self.sequence_id[packet.protocol_id] = (sid + 1) % 2**16
-        frames = Frame(packet.protocol_id, packet.cmd_id, packet.payload,
-                       sequence_id=sid,
-                       window_size=self.protocol_window_size(packet.protocol_id),
-                       frame_cipher=self.frame_cipher
-                       ).frames
-        queues = self.queues[packet.protocol_id]
+        framer = PacketFramer(packet, sid, frame_cipher=self.frame_cipher)
+        frame_size = Frame.header_size + 2 * Frame.mac_size + ceil16(framer.total_payload_size)
         if packet.prioritize:
-            assert len(frames) == 1
-            assert frames[0].frame_size() <= self.max_priority_frame_size
-            queues['priority'].put(frames[0])
-        elif len(frames) == 1:
-            queues['normal'].put(frames[0])
+            assert frame_size <= self.max_priority_frame_size
+            self._put_packet(packet.protocol_id, 'priority', framer)
+        elif frame_size <= self.protocol_window_size(packet.protocol_id):
+            self._put_packet(packet.protocol_id, 'normal', framer)
         else:
-            for f in frames:
-                queues['chunked'].put(f)
+            self._put_packet(packet.protocol_id, 'chunked', framer)
 
-    def pop_frames_for_protocol(self, protocol_id):
+    def pop_frames_for_protocol(self, protocol_id, max_size=None):
         """
+        Returns frames of up to max_size bytes (default: protocol window size).
+
         If priority packet and normal packet exist:
             send up to pws/2 bytes from each (priority first!)
         else if priority packet and chunked-frame exist:
@@ -364,21 +700,35 @@ class Multiplexer(object):
 
         If there are bytes leftover -- for example, if the bytes sent is < pws,
             then repeat the cycle.
+
+        Frames are cut from the queued packets here, sized by the current protocol
+        window size (priority packets are never chunked). A priority frame is always
+        returned if it is the first frame, as it may exceed a small window size.
         """
 
-        pws = self.protocol_window_size()
+        window_size = self.protocol_window_size()
+        pws = window_size if max_size is None else max_size
         queues = self.queues[protocol_id]
         frames = []
-        # size = lambda:
         size = 0
         while size < pws:
             frames_added = 0
             for qn in ('priority', 'normal', 'chunked'):
                 q = queues[qn]
                 if q.qsize():
-                    fs = q.peek().frame_size()
-                    if size + fs <= pws:
-                        frames.append(q.get())
+                    framer = q.peek()
+                    ws = self.max_priority_frame_size if qn == 'priority' else window_size
+                    fs = framer.next_frame_size(ws)
+                    if size + fs <= pws or (qn == 'priority' and not frames):
+                        buffered_size = framer.buffered_size
+                        try:
+                            frames.append(framer.pop_frame(ws))
+                        except MultiplexerError:
+                            self._remove_packet(protocol_id, q)  # drop the packet
+                            raise
+                        self.num_queued_bytes -= buffered_size - framer.buffered_size
+                        if framer.is_done:
+                            self._remove_packet(protocol_id, q)
                         size += fs
                         frames_added += 1
                 # add no more than two in order to send normal and priority first
@@ -387,24 +737,13 @@ class Multiplexer(object):
             # empty queues
             if frames_added == 0:
                 break
-        # the following can not be guaranteed, as pws might have been different
-        # at the time where packets were framed and added to the queues
-        # assert sum(f.frame_size() for f in frames) <= pws
         return frames
 
     def pop_frames(self):
         """
-        returns the frames for the next protocol up to protocol window size bytes
+        returns the frames for the next protocol selected by the scheduler
         """
-        protocols = tuple(self.queues.keys())
-        idx = protocols.index(self.next_protocol)
-        protocols = protocols[idx:] + protocols[:idx]
-        assert len(protocols) == len(self.queues.keys())
-        for p in protocols:
-            frames = self.pop_frames_for_protocol(p)
-            if frames:
-                return frames
-        return []
+        return self.scheduler.pop_frames(self)
 
     def pop_all_frames(self):
         frames = []
@@ -429,42 +768,23 @@ class Multiplexer(object):
             header = buffer[:Frame.header_size].tobytes()
         return header
 
-    def decode_body(self, buffer, header=None):
+    def decode_body(self, buffer, header):
         """
-        w/o encryption
-        peak into buffer for body_size
+        decodes the frame at the head of the DecodeBuffer buffer, which holds the complete
+        frame, header is the decoded frame header.
 
-        return None if buffer is not long enough to decode frame
-        """
-        assert isinstance(buffer, memoryview)
-        if len(buffer) < Frame.header_size:
-            return None, buffer
-
-        if not header:
-            header = self.decode_header(buffer[:Frame.header_size + Frame.mac_size].tobytes())
+        The body is read (and decrypted) in place: chunked-n bodies go directly into the
+        reassembly buffer, all other bodies into a new bytearray which the payload is a
+        memoryview of.
 
+        returns the completed packet or None
+        """
         body_size = struct.unpack('>I', b'\x00' + header[:3])[0]
 
-        if self.frame_cipher:
-            body = self.frame_cipher.decrypt_body(buffer[Frame.header_size + Frame.mac_size:].tobytes(),
-                                                  body_size)
-            assert len(body) == body_size
-            bytes_read = Frame.header_size + Frame.mac_size + ceil16(len(body)) + Frame.mac_size
-        else:
-            # header: frame-size || header-data || padding
-            header = buffer[:Frame.header_size].tobytes()
-            # frame-size: 3-byte integer size of frame, big endian encoded (excludes padding)
-            # frame relates to body w/o padding w/o mac
-            body_offset = Frame.header_size + Frame.mac_size
-            body = buffer[body_offset:body_offset + body_size].tobytes()
-            assert len(body) == body_size
-            bytes_read = ceil16(body_offset + body_size + Frame.mac_size)
-        assert bytes_read % Frame.padding == 0
-
         # normal, chunked-n: rlp.list(protocol-type[, sequence-id])
         # chunked-0: rlp.list(protocol-type, sequence-id, total-packet-size)
         try:
-            header_data = rlp.decode(header[3:], sedes=header_data_sedes, strict=False)
+            header_data = frameheader.decode_header_data(header[3:])
         except rlp.RLPException:
             raise DeserializationError('invalid rlp data')
 
@@ -490,61 +810,170 @@ class Multiplexer(object):
         if protocol_id not in self.chunked_buffers:
             raise MultiplexerError('unknown protocol_id %d' % (protocol_id))
         chunkbuf = self.chunked_buffers[protocol_id]
+        if sequence_id is not None and self._drop_evicted(protocol_id, sequence_id,
+                                                          chunked_0, body_size):
+            # chunked-n frame of an evicted packet, still read to keep the cipher in sync
+            self._read_body(buffer, body_size)
+            return
         if sequence_id in chunkbuf:
             # body chunked-n: packet-data || padding
-            packet = chunkbuf[sequence_id]
             if chunked_0:
                 raise MultiplexerError('received chunked_0 frame for existing buffer %d of protocol %d' %
                                        (sequence_id, protocol_id))
-            if len(body) > packet.total_payload_size - len(packet.payload):
-                raise MultiplexerError('too much data for chunked buffer %d of protocol %d' %
-                                       (sequence_id, protocol_id))
-            # all good
-            packet.payload += body
-            if packet.total_payload_size == len(packet.payload):
-                del packet.total_payload_size
-                del chunkbuf[sequence_id]
-                return packet
+            buf = chunkbuf[sequence_id]
+            if buf.is_stream:  # accounted for before a discarded stream releases it
+                self._stream_buffered(body_size)
+                buf.add(bytes(self._read_body(buffer, body_size)))
+            else:
+                payload, offset = buf.reserve(body_size)
+                self._read_body(buffer, body_size, payload, offset)
+                buf.added(body_size)
+            if buf.is_complete:
+                self._remove_chunked_buffer(protocol_id, sequence_id)
+                if not buf.is_stream:  # streams are returned with the first frame
+                    return buf.packet
         else:
             # body normal, chunked-0: rlp(packet-type) [|| rlp(packet-data)] || padding
-            item, end = rlp.codec.consume_item(body, 0)
-            cmd_id = rlp.sedes.big_endian_int.deserialize(item)
-            if chunked_0:
-                payload = bytearray(body[end:])
-                total_payload_size -= end
-            else:
-                payload = body[end:]
-
+            body = self._read_body(buffer, body_size)
+            try:
+                item, end = rlp.codec.consume_item(body, 0)
+                cmd_id = rlp.sedes.big_endian_int.deserialize(item)
+            except rlp.RLPException:
+                raise DeserializationError('invalid rlp data')
+            payload = memoryview(body)[end:]
             packet = Packet(protocol_id=protocol_id, cmd_id=cmd_id, payload=payload)
             if chunked_0:
+                total_payload_size -= end
                 if total_payload_size < len(payload):
                     raise MultiplexerError('total payload size smaller than initial chunk')
                 if total_payload_size == len(payload):
                     return packet # shouldn't have been chunked, whatever
                 assert sequence_id is not None
-                packet.total_payload_size = total_payload_size
-                chunkbuf[sequence_id] = packet
+                if self.stream_filter and self.stream_filter(protocol_id, cmd_id):
+                    packet = PacketStream(protocol_id, cmd_id, total_payload_size,
+                                          on_consume=lambda size: self._stream_buffered(-size))
+                buf = self._add_chunked_buffer(packet, sequence_id, total_payload_size)
+                if buf.is_stream:
+                    self._stream_buffered(len(payload))
+                    buf.add(payload.tobytes())
+                    return packet
+                buf.add(payload)
             else:
                 return packet # normal (non-chunked)
 
+    def _read_body(self, buffer, body_size, out=None, offset=0):
+        """
+        reads the body of the frame at the head of the DecodeBuffer buffer into the
+        bytearray out at offset, decrypting it if there is a frame cipher.
+        allocates out if it is None, returns out.
+        """
+        data, pos = buffer.locate(Frame.header_size + Frame.mac_size)
+        if out is None:
+            out, offset = bytearray(body_size), 0
+        if self.frame_cipher:
+            self.frame_cipher.decrypt_body_into(data, pos, body_size, out, offset)
+        else:
+            memoryview(out)[offset:offset + body_size] = memoryview(data)[pos:pos + body_size]
+        return out
+
+    def _stream_buffered(self, size):
+        "called with the size of chunks added to (positive) or taken from streams"
+        pass
+
+    def _add_chunked_buffer(self, packet, sequence_id, total_payload_size):
+        "checks the announced size against the reassembly budget and allocates a buffer"
+        if total_payload_size > self.max_payload_size:
+            raise MultiplexerError('announced payload size %d exceeds max_payload_size' %
+                                   total_payload_size)
+        self.evict_chunked_buffers()
+        if self.num_chunked_buffers >= self.max_chunked_buffers:
+            raise MultiplexerError('too many concurrent chunked packets')
+        # streams are not buffered, their chunks are accounted for by ingress flow control
+        if not isinstance(packet, PacketStream) and \
+                self.reassembly_size + total_payload_size > self.max_reassembly_size:
+            raise MultiplexerError('reassembly memory budget exceeded')
+        buf = ChunkedBuffer(packet, sequence_id, total_payload_size)
+        self.chunked_buffers[packet.protocol_id][sequence_id] = buf
+        self.num_chunked_buffers += 1
+        self.reassembly_size += buf.reserved_size
+        return buf
+
+    def _remove_chunked_buffer(self, protocol_id, sequence_id):
+        buf = self.chunked_buffers[protocol_id].pop(sequence_id)
+        self.num_chunked_buffers -= 1
+        self.reassembly_size -= buf.reserved_size
+
+    def evict_chunked_buffers(self, max_age=None):
+        """
+        drops incomplete chunked packets which did not receive a frame for max_age seconds.
+        the chunked-n frames of dropped packets which arrive later are discarded.
+        """
+        max_age = self.chunked_buffer_timeout if max_age is None else max_age
+        now = time.time()
+        deadline = now - max_age
+        evicted = self.evicted_chunked_buffers
+        # the remote stopped sending the evicted packets as well
+        for key in [k for k, (_, last_update) in evicted.items() if last_update < deadline]:
+            del evicted[key]
+        if not self.num_chunked_buffers:
+            return
+        for protocol_id, chunkbuf in self.chunked_buffers.items():
+            for sequence_id, buf in list(chunkbuf.items()):
+                if buf.last_update < deadline:
+                    self._remove_chunked_buffer(protocol_id, sequence_id)
+                    evicted[(protocol_id, sequence_id)] = [buf.total_payload_size - buf.size, now]
+                    if len(evicted) > self.max_chunked_buffers:
+                        evicted.popitem(last=False)
+                    if buf.is_stream:
+                        buf.packet.close(MultiplexerError('chunked packet dropped'))
+
+    def _drop_evicted(self, protocol_id, sequence_id, chunked_0, body_size):
+        "True if the frame is a chunked-n frame of an evicted packet"
+        evicted = self.evicted_chunked_buffers
+        if not evicted:
+            return False
+        key = (protocol_id, sequence_id)
+        record = evicted.pop(key, None)
+        if record is None:
+            # normal and chunked-n frames can't be told apart, so the records are dropped
+            # once the sequence ids moved on by a quarter of their range, long before
+            # the ids are reused by new packets
+            for k in list(evicted):
+                if k[0] == protocol_id and 2**14 <= (sequence_id - k[1]) % 2**16 < 2**15:
+                    del evicted[k]
+            return False
+        remaining = record[0]
+        if chunked_0 or body_size > remaining:
+            return False  # a new packet with the same sequence_id
+        if body_size < remaining:
+            evicted[key] = [remaining - body_size, time.time()]
+        return True
+
+    def delay_chunked_buffer_eviction(self, seconds):
+        "adds seconds to the age limit of the incomplete chunked packets"
+        for chunkbuf in self.chunked_buffers.values():
+            for buf in chunkbuf.values():
+                buf.last_update += seconds
+
     def decode(self, data=''):
+        "decodes all complete frames in the buffer, returns the completed packets"
         if data:
             self._decode_buffer.extend(data)
-        if not self._cached_decode_header:
-            if len(self._decode_buffer) < Frame.header_size + Frame.mac_size:
-                return []
-            else:
-                self._cached_decode_header = self.decode_header(memoryview(self._decode_buffer))
+        packets = []
+        while True:
+            if not self._cached_decode_header:
+                if len(self._decode_buffer) < Frame.header_size + Frame.mac_size:
+                    break
+                self._cached_decode_header = self.decode_header(self._decode_buffer.view())
                 assert isinstance(self._cached_decode_header, bytes)
 
-        body_size = struct.unpack('>I', b'\x00' + self._cached_decode_header[:3])[0]
-        required_len = Frame.header_size + Frame.mac_size + ceil16(body_size) + Frame.mac_size
-        if len(self._decode_buffer) >= required_len:
-            packet = self.decode_body(memoryview(self._decode_buffer), self._cached_decode_header)
+            body_size = struct.unpack('>I', b'\x00' + self._cached_decode_header[:3])[0]
+            required_len = Frame.header_size + Frame.mac_size + ceil16(body_size) + Frame.mac_size
+            if len(self._decode_buffer) < required_len:
+                break
+            packet = self.decode_body(self._decode_buffer, self._cached_decode_header)
             self._cached_decode_header = None
-            self._decode_buffer = self._decode_buffer[required_len:]
-            if packet:
-                return [packet] + self.decode()
-            else:
-                return self.decode()
-        return []
+            self._decode_buffer.consume(required_len)
+            if packet is not None:
+                packets.append(packet)
+        return packets
@@ -1,16 +1,42 @@
+import time
 import gevent
-from .multiplexer import Multiplexer, Packet
+import gevent.event
+from .multiplexer import Multiplexer, MultiplexerError, Packet
 from .rlpxcipher import RLPxSession
 from .crypto import ECCx
 
 
 class MultiplexedSession(Multiplexer):
-    def __init__(self, privkey, hello_packet, remote_pubkey=None):
+
+    _flush_timer = None  # pending flush of frames held back by bandwidth caps
+    _flushing = False  # True while frames are cut and encrypted, see _flush
+    on_error = None  # optional callable(MultiplexerError) for errors of flushes, else raised
+    handshake_pool = None  # optional HandshakeWorkerPool running the handshake crypto
+
+    # egress backpressure: not writable once egress_bytes reaches the high watermark,
+    # writable again after it drained to the low watermark
+    egress_high_watermark = 1024**2
+    egress_low_watermark = 256 * 1024
+
+    # ingress backpressure: not readable once ingress_bytes reaches the high watermark,
+    # readable again after the packets were handled down to the low watermark
+    ingress_high_watermark = 1024**2
+    ingress_low_watermark = 256 * 1024
+    _read_paused_at = None  # time reads were paused, see _update_readable
+
+    def __init__(self, privkey, hello_packet, remote_pubkey=None, ecc=None):
         self.is_initiator = bool(remote_pubkey)
         self.hello_packet = hello_packet
         self.message_queue = gevent.queue.Queue()  # wire msg egress queue
+        self.message_queue_bytes = 0  # size of the messages in message_queue and not yet sent
+        self.writable = gevent.event.Event()
+        self.writable.set()
         self.packet_queue = gevent.queue.Queue()  # packet ingress queue
-        ecc = ECCx(raw_privkey=privkey)
+        self.ingress_bytes = 0  # payload size of decoded packets not yet handled
+        self.readable = gevent.event.Event()
+        self.readable.set()
+        # ecc of the node's static key can be shared by all sessions
+        ecc = ecc or ECCx(raw_privkey=privkey)
         self.rlpx_session = RLPxSession(
             ecc, is_initiator=bool(remote_pubkey))
         self._remote_pubkey = remote_pubkey
@@ -23,6 +49,63 @@ class MultiplexedSession(Multiplexer):
         # only authenticated and ready after successfully authenticated hello packet
         return self.rlpx_session.is_ready
 
+    @property
+    def egress_bytes(self):
+        "bytes queued for sending, framed or encrypted"
+        return self.num_queued_bytes + self.message_queue_bytes
+
+    @property
+    def is_writable(self):
+        return self.writable.is_set()
+
+    def _update_writable(self):
+        if self.egress_bytes >= self.egress_high_watermark:
+            self.writable.clear()
+        elif self.egress_bytes <= self.egress_low_watermark:
+            self.writable.set()
+
+    def _put_message(self, msg):
+        self.message_queue_bytes += len(msg)
+        self.message_queue.put(msg)
+        self._update_writable()
+
+    def message_sent(self, size):
+        "to be called once size bytes of the messages taken from message_queue were sent"
+        self.message_queue_bytes -= size
+        if self.num_active_protocols:
+            self._flush()
+        else:
+            self._update_writable()
+
+    @property
+    def is_readable(self):
+        return self.readable.is_set()
+
+    def _update_readable(self):
+        # chunked packets don't age while our own backpressure holds back their frames
+        if self.ingress_bytes >= self.ingress_high_watermark:
+            if self._read_paused_at is None:
+                self._read_paused_at = time.time()
+            self.readable.clear()
+        elif self.ingress_bytes <= self.ingress_low_watermark:
+            if self._read_paused_at is not None:
+                self.delay_chunked_buffer_eviction(time.time() - self._read_paused_at)
+                self._read_paused_at = None
+            self.readable.set()
+
+    def evict_chunked_buffers(self, max_age=None):
+        if self._read_paused_at is None:
+            Multiplexer.evict_chunked_buffers(self, max_age)
+
+    def _stream_buffered(self, size):
+        self.ingress_bytes += size
+        self._update_readable()
+
+    def packet_handled(self, packet):
+        "to be called once a packet taken from packet_queue was handled"
+        self.ingress_bytes -= len(packet)
+        self._update_readable()
+
     @property
     def remote_pubkey(self):
         "if responder not be available until first message is received"
@@ -35,24 +118,25 @@ class MultiplexedSession(Multiplexer):
     def _send_init_msg(self):
         auth_msg = self.rlpx_session.create_auth_message(self._remote_pubkey)
         auth_msg_ct = self.rlpx_session.encrypt_auth_message(auth_msg)
-        self.message_queue.put(auth_msg_ct)
+        self._put_message(auth_msg_ct)
 
     def _add_message_during_handshake(self, msg):
         assert not self.is_ready
+        msg = bytes(msg)  # the ecies functions don't take bytearrays
         session = self.rlpx_session
         if self.is_initiator:
             # expecting auth ack message
-            rest = session.decode_auth_ack_message(msg)
-            session.setup_cipher()
+            rest = self._run_handshake_step(session.decode_auth_ack_message, msg)
+            self._run_handshake_step(session.setup_cipher)
             if len(rest) > 0:  # add remains (hello) to queue
                 self._add_message_post_handshake(rest)
         else:
             # expecting auth_init
-            rest = session.decode_authentication(msg)
+            rest = self._run_handshake_step(session.decode_authentication, msg)
             auth_ack_msg = session.create_auth_ack_message()
             auth_ack_msg_ct = session.encrypt_auth_ack_message(auth_ack_msg)
-            self.message_queue.put(auth_ack_msg_ct)
-            session.setup_cipher()
+            self._put_message(auth_ack_msg_ct)
+            self._run_handshake_step(session.setup_cipher)
             if len(rest) > 0:
                 self._add_message_post_handshake(rest)
         self.add_message = self._add_message_post_handshake
@@ -61,17 +145,68 @@ class MultiplexedSession(Multiplexer):
         assert session.is_ready
         self.add_packet(self.hello_packet)
 
+    def _run_handshake_step(self, func, *args):
+        "runs func on the handshake_pool if there is one, yielding until it is done"
+        if self.handshake_pool:
+            return self.handshake_pool.apply(func, *args)
+        return func(*args)
+
     add_message = _add_message_during_handshake  # on_ready set to _add_message_post_handshake
 
     def _add_message_post_handshake(self, msg):
         "decodes msg and adds decoded packets to queue"
         for packet in self.decode(msg):
+            self.ingress_bytes += len(packet)
             self.packet_queue.put(packet)
+        self._update_readable()
 
     def add_packet(self, packet):
         "encodes a packet and adds the message(s) to the msg queue"
         assert isinstance(packet, Packet)
         assert self.is_ready  # don't send anything until handshake is finished
         Multiplexer.add_packet(self, packet)
-        for f in self.pop_all_frames():
-            self.message_queue.put(f.as_bytes())
+        self._flush()
+
+    def _flush(self):
+        """
+        frames the queued packets. MultiplexerErrors, e.g. of a failed stream source,
+        are passed to on_error, as the remote can't complete the packet anymore.
+
+        reading a stream source may yield to other greenlets, which may flush too.
+        only one flush runs at a time, so frames are cut and encrypted in order.
+        the running flush also frames the packets added in the meantime.
+        """
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            self._flush_frames()
+        except MultiplexerError as e:
+            if not self.on_error:
+                raise
+            self.on_error(e)
+        finally:
+            self._flushing = False
+
+    def _flush_frames(self):
+        # frames are only taken from the queues while the message queue is below the
+        # high watermark, so payloads of streamed packets are read just before they are sent
+        while self.message_queue_bytes < self.egress_high_watermark:
+            frames = self.pop_frames()
+            if not frames:
+                break
+            self._put_message(self.rlpx_session.encrypt_frames([(f.header, f.body) for f in frames]))
+        # frames of protocols exceeding their max_bandwidth are sent later
+        delay = self.scheduler.delay(self)
+        if delay is not None and not self._flush_timer:
+            self._flush_timer = gevent.spawn_later(delay, self._delayed_flush)
+        self._update_writable()
+
+    def _delayed_flush(self):
+        self._flush_timer = None
+        self._flush()
+
+    def stop(self):
+        if self._flush_timer:
+            self._flush_timer.kill()
+            self._flush_timer = None
@@ -0,0 +1,118 @@
+"""
+Columnar store of node ids for vectorized distance queries, requires numpy.
+
+The 256 bit ids are kept as four uint64 columns, most significant word first.
+The xor distances of all ids to a target are computed at once and compared or
+sorted column by column, which orders them like the integer distances.
+"""
+import numpy
+
+num_words = 4
+word_mask = 2 ** 64 - 1
+
+
+def id_to_words(id):
+    return [(id >> shift) & word_mask for shift in (192, 128, 64, 0)]
+
+
+class NodeIdStore(object):
+
+    "the ids of a set of nodes, kept in sync with the buckets by RoutingTable"
+
+    def __init__(self, capacity=1024):
+        self.ids = numpy.zeros((capacity, num_words), dtype=numpy.uint64)
+        self.nodes = []  # node of each row of ids
+        self._rows = dict()  # pubkey -> row
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node.pubkey in self._rows
+
+    def add(self, node):
+        "adds node or replaces the node with the same pubkey"
+        row = self._rows.get(node.pubkey)
+        if row is None:
+            row = len(self.nodes)
+            if row == len(self.ids):  # grow
+                self.ids = numpy.concatenate((self.ids, numpy.zeros_like(self.ids)))
+            self.nodes.append(node)
+            self._rows[node.pubkey] = row
+        else:
+            self.nodes[row] = node
+        self.ids[row] = numpy.array(id_to_words(node.id), dtype=numpy.uint64)
+
+    def remove(self, pubkey):
+        row = self._rows.pop(pubkey, None)
+        if row is None:
+            return
+        last = len(self.nodes) - 1
+        if row != last:  # move the last row into the gap
+            self.ids[row] = self.ids[last]
+            self.nodes[row] = self.nodes[last]
+            self._rows[self.nodes[row].pubkey] = row
+        self.nodes.pop()
+
+    def distances(self, id):
+        "returns the xor distances of all nodes to id as array of shape (len(self), 4)"
+        return self.ids[:len(self.nodes)] ^ numpy.array(id_to_words(id), dtype=numpy.uint64)
+
+    @staticmethod
+    def _argsort(distances):
+        return numpy.lexsort(distances.T[::-1])  # the last key is the primary one
+
+    def within_distance(self, id, distance):
+        "returns the nodes within distance of id, closest first"
+        distance = min(distance, 2 ** (64 * num_words) - 1)
+        distances = self.distances(id)
+        within = numpy.zeros(len(distances), dtype=bool)
+        equal = numpy.ones(len(distances), dtype=bool)  # equal in all words compared so far
+        for column, word in enumerate(id_to_words(distance)):
+            word = numpy.uint64(word)
+            within |= equal & (distances[:, column] < word)
+            equal &= distances[:, column] == word
+        rows = numpy.flatnonzero(within | equal)
+        rows = rows[self._argsort(distances[rows])]
+        return [self.nodes[i] for i in rows]
+
+    def closest(self, id, k):
+        "returns the k nodes closest to id, closest first"
+        distances = self.distances(id)
+        rows = numpy.arange(len(distances))
+        if 0 < k < len(distances):
+            # the k closest are among the nodes with a top word of at most the k-th smallest one
+            kth = numpy.partition(distances[:, 0], k - 1)[k - 1]
+            rows = numpy.flatnonzero(distances[:, 0] <= kth)
+        rows = rows[self._argsort(distances[rows])][:k]
+        return [self.nodes[i] for i in rows]
+
+    def closest_many(self, ids, k):
+        """
+        returns the k closest nodes for each of ids, closest first.
+        all targets are handled at once: the top words of the distances, an array of
+        shape (len(ids), len(self)), are partitioned along the node axis, the full
+        distances are only computed and sorted for the candidates.
+        """
+        targets = numpy.array([id_to_words(id) for id in ids], dtype=numpy.uint64)
+        num_nodes = len(self.nodes)
+        k = min(k, num_nodes)
+        if k <= 0 or not len(targets):
+            return [[] for id in ids]
+        ids = self.ids[:num_nodes]
+        if k < num_nodes:
+            # as in closest, the k closest have a top word of at most the k-th smallest one.
+            # the m smallest top words of each target include all of these candidates
+            top = ids[:, 0] ^ targets[:, :1]
+            rows = numpy.argpartition(top, k - 1, axis=1)
+            kth = numpy.take_along_axis(top, rows[:, k - 1:k], axis=1)
+            m = (top <= kth).sum(axis=1).max()
+            if m > k:  # top words equal to the k-th one
+                rows = numpy.argpartition(top, m - 1, axis=1)
+            rows = rows[:, :m]
+        else:
+            rows = numpy.broadcast_to(numpy.arange(num_nodes), (len(targets), num_nodes))
+        distances = ids[rows] ^ targets[:, numpy.newaxis]  # shape (len(ids), m, 4)
+        order = numpy.lexsort(distances.transpose(2, 0, 1)[::-1], axis=-1)[:, :k]
+        rows = numpy.take_along_axis(rows, order, axis=1)
+        return [[self.nodes[i] for i in target_rows] for target_rows in rows]
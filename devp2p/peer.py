@@ -1,14 +1,15 @@
 import time
 import errno
 import gevent
+import gevent.pool
 import operator
 from collections import OrderedDict
 from .protocol import BaseProtocol
 from .p2p_protocol import P2PProtocol
 from .service import WiredService
-from .multiplexer import MultiplexerError, Packet
+from .multiplexer import MultiplexerError, Packet, PacketStream
 from .muxsession import MultiplexedSession
-from .crypto import ECIESDecryptionError
+from .crypto import ECIESDecryptionError, NodeIdentity
 from devp2p import slogging
 import gevent.socket
 from devp2p import rlpxcipher
@@ -30,6 +31,7 @@ class Peer(gevent.Greenlet):
     wait_read_timeout = 0.001
     dumb_remote_timeout = 10.0
     compatible_p2p_version = 5
+    max_egress_batch_size = 64 * 1024  # max bytes written to the socket at once
 
     def __init__(self, peermanager, connection, remote_pubkey=None):
         super(Peer, self).__init__()
@@ -41,10 +43,31 @@ class Peer(gevent.Greenlet):
         self.protocols = OrderedDict()
         log.debug('peer init', peer=self)
 
+        # messages are coalesced into a reused send buffer and written at once
+        self.max_egress_batch_size = self.config['p2p'].get('max_egress_batch_size',
+                                                            self.max_egress_batch_size)
+        self._send_buffer = bytearray(self.max_egress_batch_size)
+        self._pending_message = None  # did not fit into the last batch
+
         # create multiplexed encrypted session
-        privkey = decode_hex(self.config['node']['privkey_hex'])
+        node_identity = peermanager.node_identity or NodeIdentity(
+            decode_hex(self.config['node']['privkey_hex']))
         hello_packet = P2PProtocol.get_hello_packet(self)
-        self.mux = MultiplexedSession(privkey, hello_packet, remote_pubkey=remote_pubkey)
+        self.mux = MultiplexedSession(node_identity.raw_privkey, hello_packet,
+                                      remote_pubkey=remote_pubkey, ecc=node_identity.ecc)
+        self.mux.stream_filter = self._is_streaming_command
+        self.mux.on_error = self._on_multiplexer_error
+        self.mux.handshake_pool = getattr(peermanager, 'handshake_pool', None)
+        for name in ('egress_high_watermark', 'egress_low_watermark',
+                     'ingress_high_watermark', 'ingress_low_watermark'):
+            if name in self.config['p2p']:
+                setattr(self.mux, name, self.config['p2p'][name])
+        assert self.mux.egress_low_watermark < self.mux.egress_high_watermark
+        assert self.mux.ingress_low_watermark < self.mux.ingress_high_watermark
+
+        # ingress flow control stats
+        self.num_read_pauses = 0  # times reading stopped as decoded packets backed up
+        self.read_paused_time = 0.  # seconds spent waiting for packets to be handled
         self.remote_pubkey = remote_pubkey
         self.remote_capabilities = None
 
@@ -57,6 +80,7 @@ class Peer(gevent.Greenlet):
         self.safe_to_read.set()
 
         self.greenlets = dict()
+        self.greenlets['streams'] = gevent.pool.Group()  # handlers of PacketStreams
 
         # Stop peer if hello not received in self.dumb_remote_timeout seconds
         self.greenlets['dumb_checker'] = gevent.spawn_later(self.dumb_remote_timeout, self.check_if_dumb_remote)
@@ -109,7 +133,8 @@ class Peer(gevent.Greenlet):
         assert protocol_class not in self.protocols
         log.debug('registering protocol', protocol=protocol.name, peer=self)
         self.protocols[protocol_class] = protocol
-        self.mux.add_protocol(protocol.protocol_id)
+        self.mux.add_protocol(protocol.protocol_id, weight=protocol.weight,
+                              max_bandwidth=protocol.max_bandwidth)
         protocol.start()
 
     def has_protocol(self, protocol):
@@ -172,6 +197,15 @@ class Peer(gevent.Greenlet):
 
     # sending p2p messages
 
+    @property
+    def is_writable(self):
+        "False while the queued egress bytes are above the watermarks, see MultiplexedSession"
+        return self.mux.is_writable
+
+    def wait_writable(self, timeout=None):
+        "blocks until the peer is writable, returns False on timeout or if the peer stopped"
+        return self.mux.writable.wait(timeout) and not self.is_stopped
+
     def send_packet(self, packet):
         for i, protocol in enumerate(self.protocols.values()):
             if packet.protocol_id == protocol.protocol_id:
@@ -206,6 +240,13 @@ class Peer(gevent.Greenlet):
                 return protocol, packet.cmd_id
         raise UnknownCommandError('no protocol for protocol id %s' % packet.protocol_id)
 
+    def _is_streaming_command(self, protocol_id, cmd_id):
+        try:
+            protocol, cmd_id = self.protocol_cmd_id_from_packet(Packet(protocol_id, cmd_id))
+        except UnknownCommandError:
+            return False
+        return cmd_id in protocol.streaming_cmd_ids
+
     def _handle_packet(self, packet):
         assert isinstance(packet, Packet)
         try:
@@ -236,23 +277,85 @@ class Peer(gevent.Greenlet):
             self.stop()
         self.safe_to_read.set()
 
+    def _next_egress_batch(self):
+        """
+        blocks until a message is available and coalesces it with all messages ready
+        to be sent, up to max_egress_batch_size bytes, into the send buffer
+        """
+        queue = self.mux.message_queue
+        msg = self._pending_message or queue.get()
+        self._pending_message = None
+        if len(msg) > len(self._send_buffer):  # e.g. window size larger than batch size
+            return memoryview(msg)  # sent on its own
+        buf = memoryview(self._send_buffer)
+        size = 0
+        while True:
+            buf[size:size + len(msg)] = msg
+            size += len(msg)
+            if queue.empty():
+                break
+            msg = queue.get_nowait()
+            if size + len(msg) > len(buf):
+                self._pending_message = msg
+                break
+        return buf[:size]
+
     def _run_egress_message(self):
         while not self.is_stopped:
-            self.send(self.mux.message_queue.get())
+            data = self._next_egress_batch()
+            self.send(data)
+            self.mux.message_sent(len(data))  # frames more packets, errors go to on_error
+
+    def _on_multiplexer_error(self, error):
+        log.debug('multiplexer error', peer=self, error=error)
+        self.report_error('multiplexer error')
+        self.stop()
 
     def _run_decoded_packets(self):
         # handle decoded packets
         while not self.is_stopped:
-            self._handle_packet(self.mux.packet_queue.get())  # get_packet blocks
+            packet = self.mux.packet_queue.get()  # get_packet blocks
+            if isinstance(packet, PacketStream):
+                # handled on its own greenlet, so the packets decoded behind the stream
+                # are handled meanwhile and can't stop the reads of its frames
+                self.greenlets['streams'].spawn(self._handle_stream, packet)
+                continue
+            self._handle_packet(packet)
+            self.mux.packet_handled(packet)
+
+    def _handle_stream(self, stream):
+        try:
+            self._handle_packet(stream)
+        finally:
+            stream.discard()  # release the chunks the handler did not consume
+            self.mux.packet_handled(stream)
+
+    def _run_evict_chunked_buffers(self):
+        # drops chunked packets the remote stopped sending, even if no other frames arrive
+        while not self.is_stopped:
+            gevent.sleep(self.mux.chunked_buffer_timeout / 2.)
+            self.mux.evict_chunked_buffers()
+
+    def _wait_readable(self):
+        "pause reading (and let TCP flow control push back) until decoded packets are handled"
+        if self.mux.is_readable:
+            return
+        log.debug('pausing reads', peer=self, ingress_bytes=self.mux.ingress_bytes)
+        self.num_read_pauses += 1
+        st = time.time()
+        self.mux.readable.wait()
+        self.read_paused_time += time.time() - st
 
     def _run_ingress_message(self):
         log.debug('peer starting main loop')
         assert not self.connection.closed, "connection is closed"
         self.greenlets['decoder'] = gevent.spawn(self._run_decoded_packets)
         self.greenlets['sender'] = gevent.spawn(self._run_egress_message)
+        self.greenlets['evictor'] = gevent.spawn(self._run_evict_chunked_buffers)
 
         while not self.is_stopped:
             self.safe_to_read.wait()
+            self._wait_readable()
             try:
                 gevent.socket.wait_read(self.connection.fileno())
             except gevent.socket.error as e:
@@ -286,9 +389,7 @@ class Peer(gevent.Greenlet):
                     self.report_error('rlpx session error')
                     self.stop()
                 except MultiplexerError as e:
-                    log.debug('multiplexer error', peer=self, error=e)
-                    self.report_error('multiplexer error')
-                    self.stop()
+                    self._on_multiplexer_error(e)
 
     _run = _run_ingress_message
 
@@ -297,6 +398,9 @@ class Peer(gevent.Greenlet):
             try:
                 self.is_stopped = True
                 log.debug('peer stopped', peer=self)
+                self.mux.stop()
+                self.mux.writable.set()  # release senders waiting for the peer
+                self.mux.readable.set()
                 for g in self.greenlets.values():
                     try:
                         g.kill()
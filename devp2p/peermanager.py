@@ -4,6 +4,7 @@ import socket
 import atexit
 import time
 import re
+from collections import deque
 from gevent.server import StreamServer
 from gevent.socket import create_connection, timeout
 from .service import WiredService
@@ -12,9 +13,10 @@ from .p2p_protocol import P2PProtocol
 from .upnp import add_portmap, remove_portmap
 from devp2p import kademlia
 from .peer import Peer
+from .muxsession import MultiplexedSession
+from .workerpool import HandshakeWorkerPool
 from devp2p import crypto
 from devp2p import utils
-from rlp.utils import decode_hex
 
 from devp2p import slogging
 log = slogging.get_logger('p2p.peermgr')
@@ -45,28 +47,58 @@ class PeerManager(WiredService):
     required_services = []
     wire_protocol = P2PProtocol
     nat_upnp = None
+    max_deferred_broadcasts = 64  # per congested peer, the oldest are dropped on overflow
     default_config = dict(p2p=dict(bootstrap_nodes=[],
                                    min_peers=5,
                                    max_peers=10,
                                    listen_port=30303,
-                                   listen_host='0.0.0.0'),
+                                   listen_host='0.0.0.0',
+                                   max_egress_batch_size=Peer.max_egress_batch_size,
+                                   egress_high_watermark=MultiplexedSession.egress_high_watermark,
+                                   egress_low_watermark=MultiplexedSession.egress_low_watermark,
+                                   ingress_high_watermark=MultiplexedSession.ingress_high_watermark,
+                                   ingress_low_watermark=MultiplexedSession.ingress_low_watermark,
+                                   ephemeral_key_pool_size=crypto.EphemeralKeyPool.size,
+                                   handshake_workers=0,
+                                   max_queued_handshakes=HandshakeWorkerPool.max_queued,
+                                   ecdh_cache_size=crypto.ECCx.ecdh_cache_size,
+                                   ecdh_cache_ttl=crypto.ECCx.ecdh_cache_ttl,
+                                   max_deferred_broadcasts=max_deferred_broadcasts),
                           log_disconnects=False,
                           node=dict(privkey_hex=''))
 
     connect_timeout = 2.
     connect_loop_delay = 0.1
     discovery_delay = 0.5
+    node_identity = None  # crypto.NodeIdentity shared by discovery and the peers
 
     def __init__(self, app):
         log.info('PeerManager init')
         WiredService.__init__(self, app)
         self.peers = []
         self.errors = PeerErrors() if self.config['log_disconnects'] else PeerErrorsBase()
+        self.max_deferred_broadcasts = self.config['p2p'].get('max_deferred_broadcasts',
+                                                              self.max_deferred_broadcasts)
+        self.deferred_broadcasts = dict()  # peer: deque of (func, args, kargs)
 
         # setup nodeid based on privkey
+        self.node_identity = crypto.NodeIdentity.of_app(app)
         if 'id' not in self.config['p2p']:
-            self.config['node']['id'] = crypto.privtopub(
-                decode_hex(self.config['node']['privkey_hex']))
+            self.config['node']['id'] = self.node_identity.raw_pubkey
+
+        # cache of the ECDH secrets with the static keys of remote nodes. the cache is
+        # process-wide, so with several PeerManagers the one created last configures it
+        size = self.config['p2p'].get('ecdh_cache_size', crypto.ECCx.ecdh_cache_size)
+        ttl = self.config['p2p'].get('ecdh_cache_ttl', crypto.ECCx.ecdh_cache_ttl)
+        if (size, ttl) != (crypto.ECCx.ecdh_cache_size, crypto.ECCx.ecdh_cache_ttl):
+            crypto.ECCx.setup_ecdh_cache(size, ttl)
+
+        # optionally run the handshake crypto on worker threads
+        self.handshake_pool = None
+        if self.config['p2p'].get('handshake_workers'):
+            self.handshake_pool = HandshakeWorkerPool(
+                self.config['p2p']['handshake_workers'],
+                self.config['p2p'].get('max_queued_handshakes'))
 
         self.listen_addr = (self.config['p2p']['listen_host'], self.config['p2p']['listen_port'])
         self.server = StreamServer(self.listen_addr, handle=self._on_new_connection)
@@ -90,12 +122,22 @@ class PeerManager(WiredService):
         return [s for s in self.app.services.values() if isinstance(s, WiredService)]
 
     def broadcast(self, protocol, command_name, args=[], kargs={},
-                  num_peers=None, exclude_peers=[]):
+                  num_peers=None, exclude_peers=[], congested='send'):
+        """
+        congested: how to handle peers which are not writable (see Peer.is_writable)
+            'send': send anyway
+            'skip': do not send to congested peers
+            'defer': send once the peer is writable again, up to max_deferred_broadcasts
+                     per peer, dropping the oldest ones
+        """
         log.debug('broadcasting', protcol=protocol, command=command_name,
                   num_peers=num_peers, exclude_peers=exclude_peers)
         assert num_peers is None or num_peers > 0
+        assert congested in ('send', 'skip', 'defer')
         peers_with_proto = [p for p in self.peers
                             if protocol in p.protocols and p not in exclude_peers]
+        if congested == 'skip':
+            peers_with_proto = [p for p in peers_with_proto if p.is_writable]
 
         if not peers_with_proto:
             log.debug('no peers with proto found', protos=[p.protocols for p in self.peers])
@@ -103,12 +145,34 @@ class PeerManager(WiredService):
         for peer in random.sample(peers_with_proto, min(num_peers, len(peers_with_proto))):
             log.debug('broadcasting to', proto=peer.protocols[protocol])
             func = getattr(peer.protocols[protocol], 'send_' + command_name)
+            if congested == 'defer' and not peer.is_writable:
+                log.debug('deferring broadcast to congested peer', peer=peer)
+                self._defer_broadcast(peer, func, args, kargs)
+                continue
             func(*args, **kargs)
             # sequential uploads
             # wait until the message is out, before initiating next
             peer.safe_to_read.wait()
             log.debug('broadcasting done', ts=time.time())
 
+    def _defer_broadcast(self, peer, func, args, kargs):
+        queue = self.deferred_broadcasts.get(peer)
+        if queue is None:
+            queue = self.deferred_broadcasts[peer] = deque(maxlen=self.max_deferred_broadcasts)
+            gevent.spawn(self._send_deferred_broadcasts, peer, queue)
+        if len(queue) == queue.maxlen:
+            log.debug('dropping deferred broadcast', peer=peer)
+        queue.append((func, args, kargs))
+
+    def _send_deferred_broadcasts(self, peer, queue):
+        "sends the queued broadcasts while the peer is writable, one greenlet per peer"
+        try:
+            while queue and peer.wait_writable():
+                func, args, kargs = queue.popleft()
+                func(*args, **kargs)
+        finally:
+            del self.deferred_broadcasts[peer]
+
     def _start_peer(self, connection, address, remote_pubkey=None):
         # create peer
         peer = Peer(self, connection, remote_pubkey=remote_pubkey)
@@ -165,6 +229,11 @@ class PeerManager(WiredService):
         log.info('starting listener', addr=self.listen_addr)
         self.server.set_handle(self._on_new_connection)
         self.server.start()
+        # pregenerate ephemeral keys for handshakes. the pool is process-wide,
+        # so with several PeerManagers the one started last sets its size
+        crypto.ephemeral_keys.size = self.config['p2p'].get('ephemeral_key_pool_size',
+                                                            crypto.EphemeralKeyPool.size)
+        crypto.ephemeral_keys.start()
         super(PeerManager, self).start()
         gevent.spawn_later(0.001, self._bootstrap, self.config['p2p']['bootstrap_nodes'])
         gevent.spawn_later(1, self._discovery_loop)
@@ -209,8 +278,7 @@ class PeerManager(WiredService):
                         gevent.sleep(self.discovery_delay)
                         continue
                     log.debug('connecting random', node=node)
-                    local_pubkey = crypto.privtopub(decode_hex(self.config['node']['privkey_hex']))
-                    if node.pubkey == local_pubkey:
+                    if node.pubkey == self.node_identity.raw_pubkey:
                         continue
                     if node.pubkey in [p.remote_pubkey for p in self.peers]:
                         continue
@@ -232,6 +300,8 @@ class PeerManager(WiredService):
         self.server.stop()
         for peer in self.peers:
             peer.stop()
+        if self.handshake_pool:
+            self.handshake_pool.stop()
         super(PeerManager, self).stop()
 
 
@@ -1,7 +1,7 @@
 import gevent
 import rlp
 from rlp import sedes
-from .multiplexer import Packet
+from .multiplexer import Packet, PacketStream, StreamSource
 from .service import WiredService
 from devp2p import slogging
 log = slogging.get_logger('protocol')
@@ -39,6 +39,9 @@ class BaseProtocol(gevent.Greenlet):
     name = ''
     version = 0
     max_cmd_id = 0  # reserved cmd space
+    weight = 1  # egress bandwidth share relative to the other protocols of the peer
+    max_bandwidth = None  # optional egress cap in bytes per second
+    blocking_send = False  # if True, send_X blocks while the peer is not writable
 
     class command(object):
 
@@ -48,15 +51,18 @@ class BaseProtocol(gevent.Greenlet):
             - list(arg_name, rlp.sedes.type), ...)  # for structs
             - sedes.CountableList(sedes.type)       # for lists with uniform item type
         - if you want non-strict decoding, define decode_strict = False
+        - if you want to process large packets while they arrive, define streaming = True
         optionally implement
         - create
         - receive
+        - receive_stream (streaming commands only)
 
         default receive implementation, call callbacks with (proto_instance, data_dict)
         """
         cmd_id = 0
         structure = []  # [(arg_name, rlp.sedes.type), ...]
         decode_strict = True
+        streaming = False
 
         def create(self, proto, *args, **kargs):
             "optionally implement create"
@@ -72,6 +78,17 @@ class BaseProtocol(gevent.Greenlet):
                 else:
                     cb(proto, **data)
 
+        def receive_stream(self, proto, chunks):
+            """
+            optionally implement for streaming commands.
+            chunks yields the raw (rlp encoded) payload frame by frame as it arrives.
+            runs on its own greenlet, while the packets which follow are handled.
+            chunks not consumed when it returns are dropped.
+            the default implementation decodes the joined payload and calls receive.
+            """
+            payload = b''.join(chunks)
+            self.receive(proto, self.decode_payload(payload))
+
         # no need to redefine the following ##################################
 
         def __init__(self):
@@ -92,6 +109,8 @@ class BaseProtocol(gevent.Greenlet):
         @classmethod
         def decode_payload(cls, rlp_data):
             # log.debug('decoding rlp', size=len(rlp_data))
+            if isinstance(rlp_data, memoryview):  # payload of a decoded packet
+                rlp_data = rlp_data.tobytes()
             if isinstance(cls.structure, sedes.CountableList):
                 decoder = cls.structure
             else:
@@ -134,7 +153,14 @@ class BaseProtocol(gevent.Greenlet):
             def receive(packet):
                 "decode rlp, create dict, call receive"
                 assert isinstance(packet, Packet)
-                instance.receive(proto=self, data=klass.decode_payload(packet.payload))
+                if klass.streaming:
+                    payload = packet.payload
+                    if isinstance(payload, memoryview):  # chunks are bytes
+                        payload = payload.tobytes()
+                    chunks = packet if isinstance(packet, PacketStream) else [payload]
+                    instance.receive_stream(proto=self, chunks=chunks)
+                else:
+                    instance.receive(proto=self, data=klass.decode_payload(packet.payload))
 
             def create(*args, **kargs):
                 "get data, rlp encode, return packet"
@@ -145,6 +171,9 @@ class BaseProtocol(gevent.Greenlet):
             def send(*args, **kargs):
                 "create and send packet"
                 packet = create(*args, **kargs)
+                if self.blocking_send and not self.peer.wait_writable():
+                    log.debug('peer stopped, not sending', proto=self, cmd=klass.__name__)
+                    return
                 self.send_packet(packet)
 
             return receive, create, send, instance.receive_callbacks
@@ -157,6 +186,7 @@ class BaseProtocol(gevent.Greenlet):
             setattr(self, 'send_' + klass.__name__, send)
 
         self.cmd_by_id = dict((klass.cmd_id, klass.__name__) for klass in klasses)
+        self.streaming_cmd_ids = set(klass.cmd_id for klass in klasses if klass.streaming)
 
     def receive_packet(self, packet):
         cmd_name = self.cmd_by_id[packet.cmd_id]
@@ -167,6 +197,26 @@ class BaseProtocol(gevent.Greenlet):
             log.debug('protocol exception, stopping', error=e, peer=self.peer)
             self.stop()
 
+    def send_stream(self, cmd_name, source, size):
+        """
+        sends command cmd_name with a payload of size bytes which is read lazily
+        from source (an iterator of byte strings, a file object or an mmap)
+        while the frames of the packet are sent.
+        source must provide the rlp encoded payload of the command.
+        """
+        klass = getattr(self.__class__, cmd_name)
+        assert isinstance(klass, type) and issubclass(klass, self.command)
+        packet = Packet(self.protocol_id, klass.cmd_id, payload=StreamSource(source, size))
+        if self.blocking_send and not self.peer.wait_writable():
+            log.debug('peer stopped, not sending', proto=self, cmd=cmd_name)
+            return
+        self.send_packet(packet)
+
+    @property
+    def is_writable(self):
+        "False if the peer's egress buffers are congested, see Peer.is_writable"
+        return self.peer.is_writable
+
     def send_packet(self, packet):
         self.peer.send_packet(packet)
 
@@ -2,12 +2,16 @@
 import random
 import struct
 import os
+import ctypes
+from binascii import hexlify, unhexlify
 import rlp
 from rlp import sedes
-from rlp.utils import safe_ord, str_to_bytes, ascii_chr
+from rlp.utils import safe_ord, ascii_chr
 from devp2p.crypto import sha3
 from Crypto.Hash import keccak
 from devp2p.crypto import ECCx
+from devp2p.crypto import ephemeral_keys
+from devp2p.crypto import is_valid_pubkey
 from devp2p.crypto import ecdsa_recover
 from devp2p.crypto import ecdsa_verify
 import pyelliptic
@@ -19,13 +23,68 @@ sha3_256 = lambda x: keccak.new(digest_bits=256, update_after_digest=True, data=
 def sxor(s1, s2):
     "string xor"
     assert len(s1) == len(s2)
-    return b''.join(ascii_chr(safe_ord(a) ^ safe_ord(b)) for a, b in zip(s1, s2))
+    if len(s1) == 16:  # mac seeds
+        a, b = struct.unpack('>QQ', s1), struct.unpack('>QQ', s2)
+        return struct.pack('>QQ', a[0] ^ b[0], a[1] ^ b[1])
+    if not s1:
+        return b''
+    x = int(hexlify(s1), 16) ^ int(hexlify(s2), 16)
+    return unhexlify(b'%0*x' % (2 * len(s1), x))
+
+
+def cipher_update_into(cipher, data, offset, size, out, out_offset=0):
+    "runs size bytes of the bytearray data at offset through a pyelliptic.Cipher into out"
+    if not size:
+        return
+    src = (ctypes.c_char * size).from_buffer(data, offset)
+    dst = (ctypes.c_char * size).from_buffer(out, out_offset)
+    written = ctypes.c_int(0)
+    if pyelliptic.OpenSSL.EVP_CipherUpdate(cipher.ctx, dst, ctypes.byref(written),
+                                           src, size) == 0:
+        raise RLPxSessionError('EVP_CipherUpdate failed')
+    assert written.value == size
+
+
+def is_eip8_message(ciphertext):
+    """
+    detects the format of a handshake message without decrypting it.
+
+    legacy messages are ECIES ciphertexts, which start with 0x04 || ephemeral-pubk.
+    EIP-8 messages are prefixed with their 2 byte size. Only if the first and third
+    byte are both 0x04, the legacy ephemeral-pubk is checked to be on the curve.
+    """
+    if ciphertext[:1] != b'\x04':
+        return True
+    if ciphertext[2:3] != b'\x04':
+        return False
+    return not is_valid_pubkey(ciphertext[1:65])
 
 
 def ceil16(x):
     return x if x % 16 == 0 else x + 16 - (x % 16)
 
 
+class FrameMAC(object):
+
+    """
+    keccak256 state of the ingress or egress mac. The digest is cached until the next
+    update, as each frame starts with the digest its predecessor ended with.
+    """
+
+    def __init__(self, keccak):
+        self._keccak = keccak
+        self._digest = None
+
+    def update(self, data):
+        self._digest = None
+        self._keccak.update(data)
+
+    def digest(self):
+        if self._digest is None:
+            self._digest = self._keccak.digest()
+        return self._digest
+
+
 class RLPxSessionError(Exception): pass
 class AuthenticationError(RLPxSessionError): pass
 class InvalidKeyError(RLPxSessionError): pass
@@ -56,72 +115,86 @@ class RLPxSession(object):
     def __init__(self, ecc, is_initiator=False, ephemeral_privkey=None):
         self.ecc = ecc
         self.is_initiator = is_initiator
-        self.ephemeral_ecc = ECCx(raw_privkey=ephemeral_privkey)
+        if ephemeral_privkey:
+            self.ephemeral_ecc = ECCx(raw_privkey=ephemeral_privkey)
+        else:
+            self.ephemeral_ecc = ephemeral_keys.get()
 
     ### frame handling
 
+    def _update_mac(self, mac, seed=None):
+        """
+        mac.update(aes(mac-secret, mac.digest) ^ seed).digest, truncated to 16 bytes.
+        the seed of frame macs is the digest itself, which is used if seed is None.
+        """
+        digest = mac.digest()[:16]
+        mac.update(sxor(self.mac_enc(digest), digest if seed is None else seed))
+        return mac.digest()[:16]
+
     def encrypt(self, header, frame):
         assert self.is_ready is True
         assert len(header) == 16
         assert len(frame) % 16 == 0
 
-        def aes(data=''):
-            return self.aes_enc.update(data)
-
-        def mac(data=b''):
-            data = str_to_bytes(data)
-            self.egress_mac.update(data)
-            return self.egress_mac.digest()
-
         # header
-        header_ciphertext = aes(header)
+        header_ciphertext = self.aes_enc.update(header)
         assert len(header_ciphertext) == 16
         # egress-mac.update(aes(mac-secret,egress-mac) ^ header-ciphertext).digest
-        header_mac = mac(sxor(self.mac_enc(mac()[:16]), header_ciphertext))[:16]
+        header_mac = self._update_mac(self.egress_mac, header_ciphertext)
 
         # frame
-        frame_ciphertext = aes(frame)
+        frame_ciphertext = self.aes_enc.update(frame)
         assert len(frame_ciphertext) == len(frame)
         # egress-mac.update(aes(mac-secret,egress-mac) ^
         # left128(egress-mac.update(frame-ciphertext).digest))
-        fmac_seed = mac(frame_ciphertext)
-        frame_mac = mac(sxor(self.mac_enc(mac()[:16]), fmac_seed[:16]))[:16]
+        self.egress_mac.update(frame_ciphertext)
+        frame_mac = self._update_mac(self.egress_mac)
 
         return header_ciphertext + header_mac + frame_ciphertext + frame_mac
 
+    def encrypt_frames(self, frames):
+        """
+        encrypts a list of (header, frame) tuples, returns the concatenated wire data
+        as bytearray.
+
+        AES-CTR is a stream cipher, so all frames are encrypted with a single call.
+        The MACs only depend on the ciphertexts and are computed afterwards.
+        """
+        assert self.is_ready is True
+        ciphertext = self.aes_enc.update(b''.join(x for f in frames for x in f))
+        assert len(ciphertext) == sum(len(h) + len(f) for h, f in frames)
+        egress_mac, update_mac = self.egress_mac, self._update_mac
+        out = bytearray()
+        pos = 0
+        for header, frame in frames:
+            assert len(header) == 16
+            assert len(frame) % 16 == 0
+            header_ciphertext = ciphertext[pos:pos + 16]
+            frame_ciphertext = ciphertext[pos + 16:pos + 16 + len(frame)]
+            pos += 16 + len(frame)
+            out += header_ciphertext
+            out += update_mac(egress_mac, header_ciphertext)
+            out += frame_ciphertext
+            egress_mac.update(frame_ciphertext)
+            out += update_mac(egress_mac)
+        return out
+
     def decrypt_header(self, data):
         assert self.is_ready is True
         assert len(data) == 32
 
-        def aes(data=''):
-            return self.aes_dec.update(data)
-
-        def mac(data=b''):
-            data = str_to_bytes(data)
-            self.ingress_mac.update(data)
-            return self.ingress_mac.digest()
-
         header_ciphertext = data[:16]
         header_mac = data[16:32]
 
         # ingress-mac.update(aes(mac-secret,ingress-mac) ^ header-ciphertext).digest
-        expected_header_mac = mac(sxor(self.mac_enc(mac()[:16]), header_ciphertext))[:16]
-        # expected_header_mac = self.updateMAC(self.ingress_mac, header_ciphertext)
+        expected_header_mac = self._update_mac(self.ingress_mac, header_ciphertext)
         if not expected_header_mac == header_mac:
             raise AuthenticationError('invalid header mac')
-        return aes(header_ciphertext)
+        return self.aes_dec.update(header_ciphertext)
 
     def decrypt_body(self, data, body_size):
         assert self.is_ready is True
 
-        def aes(data=''):
-            return self.aes_dec.update(data)
-
-        def mac(data=b''):
-            data = str_to_bytes(data)
-            self.ingress_mac.update(data)
-            return self.ingress_mac.digest()
-
         # frame-size: 3-byte integer size of frame, big endian encoded (excludes padding)
         # frame relates to body w/o padding w/o mac
 
@@ -137,11 +210,37 @@ class RLPxSession(object):
 
         # ingres-mac.update(aes(mac-secret,ingres-mac) ^
         # left128(ingres-mac.update(frame-ciphertext).digest))
-        fmac_seed = mac(frame_ciphertext)
-        expected_frame_mac = mac(sxor(self.mac_enc(mac()[:16]), fmac_seed[:16]))[:16]
+        self.ingress_mac.update(frame_ciphertext)
+        expected_frame_mac = self._update_mac(self.ingress_mac)
         if not frame_mac == expected_frame_mac:
             raise AuthenticationError('invalid frame mac')
-        return aes(frame_ciphertext)[:body_size]
+        return self.aes_dec.update(frame_ciphertext)[:body_size]
+
+    def decrypt_body_into(self, data, offset, body_size, out, out_offset=0):
+        """
+        like decrypt_body, but the frame body is read at offset of the bytearray data and
+        authenticated in place, the body_size bytes of the body are decrypted directly into
+        the bytearray out at out_offset (which may be data itself).
+        returns the number of bytes read (body, padding and mac)
+        """
+        assert self.is_ready is True
+        read_size = ceil16(body_size)
+        if not len(data) >= offset + read_size + 16:
+            raise FormatError('insufficient body length')
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        view = memoryview(data)
+        self.ingress_mac.update(view[offset:offset + read_size])
+        expected_frame_mac = self._update_mac(self.ingress_mac)
+        if not view[offset + read_size:offset + read_size + 16].tobytes() == expected_frame_mac:
+            raise AuthenticationError('invalid frame mac')
+        if out is data and out_offset == offset:  # the padding may be overwritten too
+            cipher_update_into(self.aes_dec, data, offset, read_size, data, offset)
+            return read_size + 16
+        cipher_update_into(self.aes_dec, data, offset, body_size, out, out_offset)
+        if read_size > body_size:  # keep the key stream in sync
+            self.aes_dec.update(bytes(data[offset + body_size:offset + read_size]))
+        return read_size + 16
 
     def decrypt(self, data):
         header = self.decrypt_header(data[:32])
@@ -172,7 +271,7 @@ class RLPxSession(object):
             raise InvalidKeyError('invalid remote pubkey')
         self.remote_pubkey = remote_pubkey
 
-        ecdh_shared_secret = self.ecc.get_ecdh_key(remote_pubkey)
+        ecdh_shared_secret = self.ecc.get_cached_ecdh_key(remote_pubkey)
         token = ecdh_shared_secret
         flag = 0x0
         self.initiator_nonce = nonce or sha3(ienc(random.randint(0, 2 ** 256 - 1)))
@@ -204,11 +303,21 @@ class RLPxSession(object):
             sedes.BigEndianInt()                        # version
         ], strict=False)
 
-    def encrypt_auth_message(self, auth_message, remote_pubkey=None):
+    def encrypt_auth_message(self, auth_message, remote_pubkey=None, eip8=False):
         assert self.is_initiator
         remote_pubkey = remote_pubkey or self.remote_pubkey
-        self.auth_init = self.ecc.ecies_encrypt(auth_message, remote_pubkey)
-        assert len(self.auth_init) == 307
+        if eip8:
+            # S || H(ephemeral-pubk) || pubk || nonce || 0x0 as EIP-8 rlp list
+            data = rlp.encode((auth_message[:65], auth_message[65 + 32:65 + 32 + 64],
+                               auth_message[65 + 32 + 64:65 + 32 + 64 + 32],
+                               supported_rlpx_version), sedes=self.eip8_auth_sedes)
+            data += os.urandom(random.randint(100, 250))
+            prefix = struct.pack('>H', len(data) + self.ecc.ecies_encrypt_overhead_length)
+            self.auth_init = prefix + self.ecc.ecies_encrypt(data, remote_pubkey,
+                                                             shared_mac_data=prefix)
+        else:
+            self.auth_init = self.ecc.ecies_encrypt(auth_message, remote_pubkey)
+            assert len(self.auth_init) == 307
         return self.auth_init
 
     def decode_authentication(self, ciphertext):
@@ -223,15 +332,15 @@ class RLPxSession(object):
         assert not self.is_initiator
         if len(ciphertext) < 307:
             raise FormatError("Ciphertext too short")
-        try:
-            (size, sig, initiator_pubkey, nonce, version) = self.decode_auth_plain(ciphertext)
-        except AuthenticationError:
+        if is_eip8_message(ciphertext):
             (size, sig, initiator_pubkey, nonce, version) = self.decode_auth_eip8(ciphertext)
             self.got_eip8_auth = True
+        else:
+            (size, sig, initiator_pubkey, nonce, version) = self.decode_auth_plain(ciphertext)
         self.auth_init = ciphertext[:size]
         # recover initiator ephemeral pubkey from sig
         #     S(ephemeral-privk, ecdh-shared-secret ^ nonce)
-        token = self.ecc.get_ecdh_key(initiator_pubkey)
+        token = self.ecc.get_cached_ecdh_key(initiator_pubkey)
         self.remote_ephemeral_pubkey = ecdsa_recover(sxor(token, nonce), sig)
         if not self.ecc.is_valid_key(self.remote_ephemeral_pubkey):
             raise InvalidKeyError('invalid remote ephemeral pubkey')
@@ -321,11 +430,11 @@ class RLPxSession(object):
     def decode_auth_ack_message(self, ciphertext):
         assert self.is_initiator
         assert len(ciphertext) >= 210
-        try:
-            (size, eph_pubkey, nonce, version) = self.decode_ack_plain(ciphertext)
-        except AuthenticationError:
+        if is_eip8_message(ciphertext):
             (size, eph_pubkey, nonce, version) = self.decode_ack_eip8(ciphertext)
             self.got_eip8_ack = True
+        else:
+            (size, eph_pubkey, nonce, version) = self.decode_ack_plain(ciphertext)
         self.auth_ack = ciphertext[:size]
         self.remote_ephemeral_pubkey = eph_pubkey[:64]
         self.responder_nonce = nonce
@@ -354,7 +463,8 @@ class RLPxSession(object):
         decode EIP-8 ack message format
         """
         size = struct.unpack('>H', ciphertext[:2])[0] + 2
-        assert len(ciphertext) == size
+        if len(ciphertext) < size:
+            raise FormatError("Message shorter than specified size")
         try:
             message = self.ecc.ecies_decrypt(ciphertext[2:size], shared_mac_data=ciphertext[:2])
         except RuntimeError as e:
@@ -396,9 +506,9 @@ class RLPxSession(object):
 
         # setup sha3 instances for the MACs
         # egress-mac = sha3.update(mac-secret ^ recipient-nonce || auth-sent-init)
-        mac1 = sha3_256(sxor(self.mac_secret, self.responder_nonce) + self.auth_init)
+        mac1 = FrameMAC(sha3_256(sxor(self.mac_secret, self.responder_nonce) + self.auth_init))
         # ingress-mac = sha3.update(mac-secret ^ initiator-nonce || auth-recvd-ack)
-        mac2 = sha3_256(sxor(self.mac_secret, self.initiator_nonce) + self.auth_ack)
+        mac2 = FrameMAC(sha3_256(sxor(self.mac_secret, self.initiator_nonce) + self.auth_ack))
 
         if self.is_initiator:
             self.egress_mac, self.ingress_mac = mac1, mac2
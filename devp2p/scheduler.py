@@ -0,0 +1,143 @@
+"""
+Egress schedulers for the Multiplexer.
+
+A scheduler decides which protocol sends next and how many bytes it may send.
+It is passed the Multiplexer and dequeues frames via
+Multiplexer.pop_frames_for_protocol, which keeps the priority/normal/chunked
+queue semantics of each protocol.
+"""
+import time
+
+
+class EgressScheduler(object):
+
+    """
+    Base class for egress schedulers.
+
+    Protocols are registered with a weight (relative share of the bandwidth) and an
+    optional bandwidth cap in bytes per second.
+    """
+
+    def __init__(self):
+        self.weights = dict()  # protocol_id : weight
+        self.buckets = dict()  # protocol_id : TokenBucket (only capped protocols)
+
+    def add_protocol(self, protocol_id, weight=1, max_bandwidth=None):
+        assert weight > 0
+        self.weights[protocol_id] = weight
+        if max_bandwidth:
+            self.buckets[protocol_id] = TokenBucket(max_bandwidth)
+
+    def is_throttled(self, protocol_id):
+        bucket = self.buckets.get(protocol_id)
+        return bool(bucket and bucket.is_empty)
+
+    def consume(self, protocol_id, frames):
+        "account frames sent by protocol_id, returns the number of bytes"
+        size = sum(f.frame_size() for f in frames)
+        if protocol_id in self.buckets:
+            self.buckets[protocol_id].consume(size)
+        return size
+
+    def delay(self, mux):
+        """
+        seconds until a throttled protocol may send again,
+        None if no protocol with queued frames is throttled
+        """
+        delays = [self.buckets[p].delay for p in mux.iter_active_protocols()
+                  if self.is_throttled(p)]
+        return min(delays) if delays else None
+
+    def pop_frames(self, mux):
+        "returns the next frames to be sent"
+        raise NotImplementedError
+
+
+class RoundRobinScheduler(EgressScheduler):
+
+    """
+    Every active protocol sends up to the protocol window size per turn,
+    the weights are ignored.
+    """
+
+    def pop_frames(self, mux):
+        for p in mux.iter_active_protocols():
+            if self.is_throttled(p):
+                continue
+            frames = mux.pop_frames_for_protocol(p)
+            if frames:
+                self.consume(p, frames)
+                return frames
+        return []
+
+
+class DeficitRoundRobinScheduler(EgressScheduler):
+
+    """
+    Weighted deficit round robin.
+
+    On each turn an active protocol is credited weight * protocol window size bytes
+    and may send frames up to its accumulated credit (deficit).
+    Unused credit carries over, so protocols with large frames get their share too,
+    but it is dropped once the protocol has nothing left to send.
+    """
+
+    def __init__(self):
+        super(DeficitRoundRobinScheduler, self).__init__()
+        self.deficits = dict()  # protocol_id : bytes
+
+    def add_protocol(self, protocol_id, weight=1, max_bandwidth=None):
+        super(DeficitRoundRobinScheduler, self).add_protocol(protocol_id, weight, max_bandwidth)
+        self.deficits[protocol_id] = 0
+
+    def pop_frames(self, mux):
+        while mux.num_active_protocols:
+            num_throttled = 0
+            for p in mux.iter_active_protocols():
+                if self.is_throttled(p):
+                    num_throttled += 1
+                    continue
+                quantum = self.weights[p] * mux.protocol_window_size()
+                # frames are at most max_window_size, so the deficit does not need to grow beyond
+                deficit = min(self.deficits[p] + quantum, max(quantum, mux.max_window_size))
+                frames = mux.pop_frames_for_protocol(p, deficit)
+                deficit -= self.consume(p, frames)
+                self.deficits[p] = deficit if mux.is_active_protocol(p) else 0
+                if frames:
+                    return frames
+            if num_throttled == mux.num_active_protocols:
+                break
+        return []
+
+
+class TokenBucket(object):
+
+    """
+    Limits the average rate to `rate` bytes per second with bursts of up to one second.
+    Sending is allowed as long as the bucket is not empty, the last send may overdraw it.
+    """
+
+    def __init__(self, rate):
+        assert rate > 0
+        self.rate = rate
+        self.tokens = rate
+        self.last_refill = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    @property
+    def is_empty(self):
+        self.refill()
+        return self.tokens <= 0
+
+    @property
+    def delay(self):
+        "seconds until the bucket is not empty"
+        self.refill()
+        return max(0, -self.tokens / float(self.rate))
+
+    def consume(self, size):
+        self.tokens -= size
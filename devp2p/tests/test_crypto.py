@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 from devp2p import crypto
-from rlp.utils import decode_hex
+from rlp.utils import decode_hex, encode_hex
 import random
 import pytest
+import gevent
+import bitcoin
 
 
 def get_ecc(secret=''):
@@ -109,6 +111,96 @@ def recover_1kb(times=1000):
 def test_recover2():
     recover_1kb(times=1)
 
+
+def test_ephemeral_key_pool():
+    pool = crypto.EphemeralKeyPool(size=3)
+    key = pool.get()  # empty, generated on the spot
+    assert pool.num_misses == 1
+    assert len(key.raw_pubkey) == 64 and len(key.raw_privkey) == 32
+    gevent.sleep(0.1)  # refilled in the background
+    assert len(pool.keys) == 3
+    keys = [pool.get() for i in range(3)]
+    assert pool.num_hits == 3
+    assert len(set(k.raw_privkey for k in keys + [key])) == 4
+    pool.stop()
+
+    pool = crypto.EphemeralKeyPool(size=0)
+    pool.get()
+    gevent.sleep(0.01)
+    assert not pool.keys
+
+
+@pytest.yield_fixture
+def ecdh_cache():
+    """
+    Rolls back the process-wide ECDH cache after the test.
+    """
+    ecc = crypto.ECCx
+    backup = ecc.ecdh_cache, ecc.ecdh_cache_size, ecc.ecdh_cache_ttl
+    yield ecc
+    ecc.ecdh_cache, ecc.ecdh_cache_size, ecc.ecdh_cache_ttl = backup
+
+
+def test_ecdh_cache(ecdh_cache):
+    crypto.ECCx.setup_ecdh_cache(size=2, ttl=60)
+    alice, bob, carol = get_ecc('alice'), get_ecc('bob'), get_ecc('carol')
+    cache = crypto.ECCx.ecdh_cache
+    secret = alice.get_cached_ecdh_key(bob.raw_pubkey)
+    assert secret == alice.get_ecdh_key(bob.raw_pubkey) == bob.get_ecdh_key(alice.raw_pubkey)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    # shared by all instances with the same private key
+    assert get_ecc('alice').get_cached_ecdh_key(bob.raw_pubkey) == secret
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert bob.get_cached_ecdh_key(alice.raw_pubkey) == secret
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # bounded size
+    alice.get_cached_ecdh_key(carol.raw_pubkey)
+    alice.get_cached_ecdh_key(carol.raw_pubkey)
+    assert len(cache.data) == 2 and cache.evictions == 1
+
+    # expired entries are recomputed
+    crypto.ECCx.setup_ecdh_cache(ttl=0.01)
+    alice.get_cached_ecdh_key(bob.raw_pubkey)
+    gevent.sleep(0.02)
+    assert alice.get_cached_ecdh_key(bob.raw_pubkey) == secret
+    assert crypto.ECCx.ecdh_cache.misses == 2
+
+    # and used from the worker threads of handshakes
+    from devp2p.workerpool import HandshakeWorkerPool
+    crypto.ECCx.setup_ecdh_cache(ttl=60)
+    alice.get_cached_ecdh_key(bob.raw_pubkey)
+    pool = HandshakeWorkerPool(size=2)
+    assert pool.apply(alice.get_cached_ecdh_key, bob.raw_pubkey) == secret
+    assert crypto.ECCx.ecdh_cache.hits == 1
+    pool.stop()
+
+    # size 0 disables the cache
+    crypto.ECCx.setup_ecdh_cache(size=0)
+    assert crypto.ECCx.ecdh_cache is None
+    assert alice.get_cached_ecdh_key(bob.raw_pubkey) == secret
+
+
+def test_node_identity():
+    priv = crypto.mk_privkey('test')
+    identity = crypto.NodeIdentity(priv)
+    legacy_pub = bitcoin.encode_pubkey(bitcoin.privtopub(priv), 'bin_electrum')
+    assert identity.raw_pubkey == crypto.privtopub(priv) == legacy_pub
+    assert identity.ecc.raw_pubkey == identity.raw_pubkey
+    assert identity.ecc is identity.ecc
+    msghash = crypto.sha3(b'msg')
+    assert crypto.ecdsa_recover(msghash, identity.sign(msghash)) == identity.raw_pubkey
+
+    class AppMock(object):
+        config = dict(node=dict(privkey_hex=encode_hex(priv)))
+
+    app = AppMock()
+    assert crypto.NodeIdentity.of_app(app) is crypto.NodeIdentity.of_app(app)
+    app.config['node']['privkey_hex'] = encode_hex(crypto.mk_privkey('other'))
+    assert crypto.NodeIdentity.of_app(app).raw_pubkey == crypto.privtopub(crypto.mk_privkey('other'))
+
+
 if __name__ == '__main__':
     import time
     st = time.time()
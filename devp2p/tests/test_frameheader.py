@@ -0,0 +1,70 @@
+import random
+import struct
+import pytest
+import rlp
+from devp2p import frameheader
+from devp2p.frameheader import header_data_sedes
+
+random.seed(42)
+
+
+def rlp_header_data(*values):
+    return rlp.encode(list(values), sedes=header_data_sedes)
+
+
+def rlp_header(body_size, *values):
+    header = struct.pack('>I', body_size)[1:] + rlp_header_data(*values)
+    return header + b'\x00' * (16 - len(header))
+
+
+def test_encode_int():
+    for i in range(2**16):
+        assert frameheader.encode_int(i) == rlp.encode(i)
+    for i in (2**16, 2**24 - 1, 2**24, 2**32 - 1):
+        assert frameheader.encode_int(i) == rlp.encode(i)
+    for i in range(10000):
+        v = random.randint(2**16, 2**32 - 1)
+        assert frameheader.encode_int(v) == rlp.encode(v)
+
+
+def test_whole_range():
+    # every protocol_id and sequence_id, combined with all lengths of the other values
+    samples = (0, 1, 127, 128, 255, 256, 2**16 - 1)
+    totals = (0, 1, 127, 128, 255, 256, 2**16 - 1, 2**16, 2**24 - 1, 2**24, 2**32 - 1)
+    for i in range(2**16):
+        other = samples[i % len(samples)]
+        total = totals[i % len(totals)]
+        for values in ((i,), (i, other), (other, i), (i, other, total), (other, i, total)):
+            header = frameheader.encode_header(i, *values)
+            assert frameheader.decode_header_data(header[3:]) == values
+            if i % 61 == 0:
+                assert header == rlp_header(i, *values)
+
+
+def test_decode_invalid():
+    invalid = [b'',
+               b'\x80' + b'\x00' * 12,  # no list
+               b'\xcf\x01\x02',  # list exceeds data
+               b'\xc2\x81\x01' + b'\x00' * 10,  # non canonical single byte
+               b'\xc3\x82\x00\x01' + b'\x00' * 9,  # leading zero
+               b'\xc3\xc2\x01\x01' + b'\x00' * 9,  # nested list
+               b'\xc2\x83\x01\x01' + b'\x00' * 10,  # item exceeds list
+               ]
+    for data in invalid:
+        with pytest.raises(Exception):  # pyrlp raises TypeError for nested lists
+            rlp.decode(data, sedes=header_data_sedes, strict=False)
+        with pytest.raises(rlp.DecodingError):
+            frameheader.decode_header_data(data)
+
+
+def test_decode_random():
+    # random header-data is either rejected or decoded like pyrlp does
+    for i in range(20000):
+        data = bytes(bytearray(random.randint(0, 255) for _ in range(13)))
+        if i % 2:
+            data = b'\xc3' + data[1:]
+        try:
+            result = frameheader.decode_header_data(data)
+        except rlp.DecodingError:
+            continue
+        assert result == rlp.decode(data, sedes=header_data_sedes, strict=False)
@@ -3,6 +3,7 @@ from devp2p import kademlia
 import random
 from devp2p.utils import int_to_big_endian
 import math
+import operator
 import json
 
 random.seed(42)
@@ -139,6 +140,113 @@ def test_neighbours():
         assert node_a == routing.neighbours(node_b)[0]
 
 
+def legacy_depth(bucket):
+    "KBucket.depth before it was computed from the id range"
+    def to_binary(x):  # left padded bit representation
+        b = bin(x)[2:]
+        return '0' * (kademlia.k_id_size - len(b)) + b
+
+    if len(bucket.nodes) < 2:
+        return kademlia.k_id_size
+
+    bits = [to_binary(n.id) for n in bucket.nodes]
+    for i in range(kademlia.k_id_size):
+        if len(set(b[:i] for b in bits)) != 1:
+            return i - 1
+    raise Exception
+
+
+def test_depth():
+    # random sequences of adds and removes of ids which share a prefix of random length
+    id_size = kademlia.k_id_size
+    for i in range(200):
+        free_bits = random.randint(1, id_size)
+        prefix = random.getrandbits(id_size) >> free_bits << free_bits
+        nodes = [fake_node_from_id(prefix | random.getrandbits(free_bits)) for j in range(24)]
+        bucket = kademlia.KBucket(0, kademlia.k_max_node_id)
+        for j in range(60):
+            node = random.choice(nodes)
+            if random.random() < 0.6:
+                bucket.add_node(node)
+            else:
+                bucket.remove_node(node)
+            try:
+                expected = legacy_depth(bucket)
+            except Exception:  # raised if the ids are equal or only differ in the last bit
+                expected = id_size - (len(set(n.id for n in bucket.nodes)) - 1)
+            assert bucket.depth == expected >= id_size - free_bits
+
+
+def test_log_distance_routing_table():
+    routing = kademlia.LogDistanceRoutingTable(random_node())
+    nodes = [random_node() for i in range(1000)]
+    for node in nodes:
+        eviction_candidate = routing.add_node(node)
+        bucket = routing.bucket_by_node(node)
+        if eviction_candidate:
+            assert bucket.is_full and eviction_candidate == bucket.head
+            assert node not in routing
+        else:
+            assert node in routing and bucket.tail == node
+
+    # buckets hold the nodes at one log distance, ordered by their disjoint id ranges.
+    # only the distances of seen nodes have a bucket
+    distances = set((n.id ^ routing.this_node.id).bit_length() for n in nodes)
+    assert len(routing.buckets) == len(distances) < kademlia.k_id_size + 1
+    max_id = -1
+    for b in routing.buckets:
+        assert b.start > max_id
+        max_id = b.end
+        distance = (b.start ^ routing.this_node.id).bit_length()
+        assert distance in distances
+        assert (b.end ^ routing.this_node.id).bit_length() == distance
+        assert all((n.id ^ routing.this_node.id).bit_length() == distance for n in b.nodes)
+    assert len(routing) == len(list(routing)) == sum(node in routing for node in nodes)
+
+    node = next(iter(routing))
+    routing.remove_node(node)
+    assert node not in routing
+    assert routing.add_node(node) is None
+
+
+def test_neighbours_closest():
+    for table_class in (kademlia.RoutingTable, kademlia.LogDistanceRoutingTable):
+        routing = table_class(random_node())
+        nodes = [random_node() for i in range(2000)]
+        for node in nodes:
+            routing.add_node(node)
+        for i in range(50):
+            targetid = random.choice((kademlia.random_nodeid(), random.choice(nodes).id))
+            k = random.choice((1, 3, kademlia.k_bucket_size, 100))
+            expected = sorted(routing, key=operator.methodcaller('id_distance', targetid))[:k]
+            assert routing.neighbours(targetid, k) == expected
+
+
+def test_index():
+    for table_class in (kademlia.RoutingTable, kademlia.LogDistanceRoutingTable):
+        routing = table_class(random_node())
+        nodes = [random_node() for i in range(1000)]
+        for i in range(3000):
+            node = random.choice(nodes)
+            if random.random() < 0.8:
+                routing.add_node(node)
+            else:
+                routing.remove_node(node)
+        # in sync with the buckets, also after splits
+        in_buckets = dict((n.pubkey, (n, b)) for b in routing.buckets for n in b.nodes)
+        assert routing._index == in_buckets
+        assert len(routing) == len(in_buckets)
+        for node in nodes:
+            assert (node in routing) == (node.pubkey in in_buckets)
+            assert routing.get_node(node.pubkey) is in_buckets.get(node.pubkey, (None,))[0]
+
+        # the node object added last is returned
+        node = next(iter(routing))
+        same = kademlia.Node(node.pubkey)
+        assert routing.add_node(same) is None
+        assert routing.get_node(node.pubkey) is same
+
+
 def test_wellformedness():
     """
     fixme: come up with a definition for RLPx
@@ -394,6 +394,17 @@ def test_ping_adds_sender():
     p.wire.empty()
 
 
+def test_pong_updates_address():
+    p = get_wired_protocol()
+    node = random_node()
+    p.recv_ping(node, 'some id')
+    p.wire.empty()
+    remote = kademlia.Node(node.pubkey)
+    remote.address = 'new address'
+    p.recv_pong(remote, 'unexpected')
+    assert p.routing.get_node(node.pubkey).address == 'new address'
+
+
 def test_two():
     print("")
     one = get_wired_protocol()
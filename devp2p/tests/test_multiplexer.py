@@ -1,4 +1,7 @@
-from devp2p.multiplexer import Multiplexer, Packet, Frame, DeserializationError
+import pytest
+from devp2p.multiplexer import Multiplexer, Packet, Frame, DeserializationError, MultiplexerError
+from devp2p.multiplexer import PacketStream, StreamSource
+from devp2p.scheduler import RoundRobinScheduler
 
 
 def test_frame():
@@ -57,6 +60,31 @@ def test_chunked():
     assert len(packets) == 1
 
 
+def test_chunked_full_frames():
+    mux = Multiplexer()
+    mux.add_protocol(0)
+    window_size = 1024
+    max_body_size = window_size - Frame.header_size - 2 * Frame.mac_size
+    payload = bytes(bytearray(i % 251 for i in range(3 * window_size + 5)))
+    packet = Packet(0, cmd_id=3, payload=payload)
+    frames = Frame(0, 3, payload, sequence_id=0, window_size=window_size).frames
+    assert len(frames) == 4
+    assert frames[0].is_chunked_0 and all(f.is_chunked_n for f in frames[1:])
+    # all frames but the last carry a full body slice without padding
+    for f in frames[:-1]:
+        assert f.body_size() == f.body_size(padded=True) == max_body_size
+        assert len(f.body) == max_body_size
+        assert f.frame_size() == window_size
+    assert frames[-1].body_size() < max_body_size
+    assert frames[0].body == frames[0].enc_cmd_id + payload[:max_body_size - 1]
+    assert b''.join(f.payload.tobytes() for f in frames) == payload
+
+    packets = mux.decode(b''.join(f.as_bytes() for f in frames))
+    assert packets == [packet]
+    assert packets[0].payload == payload
+    assert len(mux._decode_buffer) == 0
+
+
 def test_chunked_big():
     import time
     mux = Multiplexer()
@@ -119,6 +147,28 @@ def test_remain():
     assert exception_raised
 
 
+def test_decode_many():
+    mux = Multiplexer()
+    p0 = 0
+    mux.add_protocol(p0)
+
+    # many small packets decoded from a single read
+    packet0 = Packet(p0, cmd_id=0, payload=b'x' * 10)
+    num_packets = 20000
+    frame = Frame(p0, 0, packet0.payload, sequence_id=None,
+                  window_size=mux.max_window_size).as_bytes()
+    message = frame * num_packets
+    packets = mux.decode(message + frame[:20])
+    assert len(packets) == num_packets
+    assert packets[-1] == packet0
+    assert len(mux._decode_buffer) == 20
+
+    # remainder is completed by the next read
+    packets = mux.decode(frame[20:])
+    assert packets == [packet0]
+    assert len(mux._decode_buffer) == 0
+
+
 def test_multiplexer():
     mux = Multiplexer()
     p0, p1, p2 = 0, 1, 2
@@ -126,11 +176,6 @@ def test_multiplexer():
     mux.add_protocol(p1)
     mux.add_protocol(p2)
 
-    assert mux.next_protocol == p0
-    assert mux.next_protocol == p1
-    assert mux.next_protocol == p2
-    assert mux.next_protocol == p0
-
     assert mux.pop_frames() == []
     assert mux.num_active_protocols == 0
 
@@ -184,8 +229,7 @@ def test_multiplexer():
     mux.add_packet(packet3)
     mux.add_packet(packet3)
     mux.add_packet(packet3)
-    assert mux.next_protocol == p0
-    # thus next with data is p1 w/ packet3
+    # p1 became active first, thus it is served first w/ packet3
     message = mux.pop_all_frames_as_bytes()
     packets = mux.decode(message)
     assert packets == [packet3, packet2, packet0, packet3, packet3, packet1]
@@ -202,6 +246,341 @@ def test_multiplexer():
     assert len(mux._decode_buffer) == len(tail)
 
 
+def test_active_protocols():
+    mux = Multiplexer()
+    protocols = list(range(4))
+    for p in protocols:
+        mux.add_protocol(p)
+
+    def num_active():
+        return sum(1 for p in protocols
+                   if sum(q.qsize() for q in mux.queues[p].values()))
+
+    mux.add_packet(Packet(1, cmd_id=0, payload=b'\x00' * mux.max_window_size * 3))
+    mux.add_packet(Packet(3, cmd_id=0, payload=b'x' * 10, prioritize=True))
+    mux.add_packet(Packet(3, cmd_id=0, payload=b'x' * 10))
+    assert mux.num_active_protocols == num_active() == 2
+    assert mux.is_active_protocol(1) and mux.is_active_protocol(3)
+    assert not mux.is_active_protocol(0)
+    while mux.pop_frames():
+        assert mux.num_active_protocols == num_active()
+    assert mux.num_active_protocols == 0
+    assert not any(mux.is_active_protocol(p) for p in protocols)
+
+
+def test_active_protocol_ring():
+    mux = Multiplexer()
+    assert mux.pop_frames() == []
+    for p in range(100):
+        mux.add_protocol(p)
+    for p in (7, 3, 50):
+        mux.add_packet(Packet(p, cmd_id=0, payload=b'x' * 10))
+    # only the active protocols are visited, in the order they became active
+    assert list(mux.iter_active_protocols()) == [7, 3, 50]
+    assert list(mux.iter_active_protocols()) == [7, 3, 50]
+    # the served protocol moves to the end of the ring
+    assert next(mux.iter_active_protocols()) == 7
+    assert list(mux.iter_active_protocols()) == [3, 50, 7]
+    mux.pop_frames_for_protocol(50)  # drains it
+    assert list(mux.iter_active_protocols()) == [3, 7]
+    mux.add_packet(Packet(50, cmd_id=0, payload=b'x' * 10))
+    assert list(mux.iter_active_protocols()) == [3, 7, 50]
+    assert [f.protocol_id for f in mux.pop_all_frames()] == [3, 7, 50]
+    assert list(mux.iter_active_protocols()) == []
+
+
+def sent_bytes_by_protocol(mux, num_pops):
+    sent = dict((p, 0) for p in mux.queues)
+    for i in range(num_pops):
+        for f in mux.pop_frames():
+            sent[f.protocol_id] += f.frame_size()
+    return sent
+
+
+def test_weighted_scheduler():
+    mux = Multiplexer()
+    mux.add_protocol(0, weight=1)
+    mux.add_protocol(1, weight=3)
+    for i in range(200):
+        mux.add_packet(Packet(0, cmd_id=0, payload=b'x' * 1000))
+        mux.add_packet(Packet(1, cmd_id=0, payload=b'x' * (100 if i % 2 else 5000)))
+    sent = sent_bytes_by_protocol(mux, 40)
+    assert 2.5 < sent[1] / float(sent[0]) < 3.5
+
+    # weights are ignored by the round robin scheduler
+    mux = Multiplexer(scheduler=RoundRobinScheduler())
+    mux.add_protocol(0, weight=1)
+    mux.add_protocol(1, weight=3)
+    for i in range(200):
+        mux.add_packet(Packet(0, cmd_id=0, payload=b'x' * 1000))
+        mux.add_packet(Packet(1, cmd_id=0, payload=b'x' * 1000))
+    sent = sent_bytes_by_protocol(mux, 40)
+    assert sent[0] == sent[1]
+
+
+def test_deficit_overdraw():
+    mux = Multiplexer()
+    for p in range(16):
+        mux.add_protocol(p)
+        for i in range(20):
+            mux.add_packet(Packet(p, cmd_id=0, payload=b'x' * 400))
+    quantum = mux.protocol_window_size()
+    assert quantum == 512
+    # a priority frame of twice the quantum is sent first in the turn
+    mux.add_packet(Packet(0, cmd_id=1, payload=b'x' * 975, prioritize=True))
+    frames = mux.pop_frames()
+    assert [f.frame_size() for f in frames] == [2 * quantum]
+    assert mux.scheduler.deficits[0] == -quantum
+    # no credit left, nothing is sent
+    assert mux.pop_frames_for_protocol(0, 0) == []
+    sent = sent_bytes_by_protocol(mux, 15)
+    assert sent[0] == 0
+    # the next turn only pays back the overdraft, the turn goes on to protocol 1
+    frames = mux.pop_frames()
+    assert set(f.protocol_id for f in frames) == set([1])
+    assert mux.scheduler.deficits[0] == 0
+
+
+def test_bandwidth_cap():
+    mux = Multiplexer()
+    max_bandwidth = 20 * 1024
+    mux.add_protocol(0)
+    mux.add_protocol(1, max_bandwidth=max_bandwidth)
+    for i in range(20):
+        mux.add_packet(Packet(0, cmd_id=0, payload=b'x' * 5000))
+        mux.add_packet(Packet(1, cmd_id=0, payload=b'x' * 5000))
+    assert mux.scheduler.delay(mux) is None
+    frames = mux.pop_all_frames()
+    sent = sum(f.frame_size() for f in frames if f.protocol_id == 1)
+    assert max_bandwidth <= sent < max_bandwidth + mux.max_window_size
+    # uncapped protocol sent everything
+    assert not mux.is_active_protocol(0)
+    assert mux.num_active_protocols == 1
+    assert 0 < mux.scheduler.delay(mux) < 1
+
+
+def chunked_frames(num_protocols, payload_size):
+    "returns the interleaved frames of one chunked packet per protocol"
+    mux = Multiplexer()
+    for p in range(num_protocols):
+        mux.add_protocol(p)
+        mux.add_packet(Packet(p, cmd_id=0, payload=b'\x00' * payload_size))
+    return [f.as_bytes() for f in mux.pop_all_frames()]
+
+
+def receiver(num_protocols, **limits):
+    mux = Multiplexer()
+    for p in range(num_protocols):
+        mux.add_protocol(p)
+    for k, v in limits.items():
+        setattr(mux, k, v)
+    return mux
+
+
+def decode_all(mux, messages):
+    return [packet for m in messages for packet in mux.decode(m)]
+
+
+def test_reassembly_limits():
+    size = 5 * Multiplexer.max_window_size
+    messages = chunked_frames(3, size)
+    mux = receiver(3)
+    assert len(decode_all(mux, messages)) == 3
+    assert mux.num_chunked_buffers == mux.reassembly_size == 0
+
+    with pytest.raises(MultiplexerError):
+        decode_all(receiver(3, max_payload_size=size - 1), messages)
+    with pytest.raises(MultiplexerError):
+        decode_all(receiver(3, max_chunked_buffers=2), messages)
+    with pytest.raises(MultiplexerError):
+        decode_all(receiver(3, max_reassembly_size=3 * size - 1), messages)
+    mux = receiver(3, max_reassembly_size=3 * size)
+    assert len(decode_all(mux, messages)) == 3
+
+
+def test_reassembly_eviction():
+    size = 5 * Multiplexer.max_window_size
+    messages = chunked_frames(1, size)
+    mux = receiver(1)
+    assert not decode_all(mux, messages[:2])
+    assert mux.num_chunked_buffers == 1
+    assert mux.reassembly_size == size
+    mux.evict_chunked_buffers()  # not stale yet
+    assert mux.num_chunked_buffers == 1
+    mux.evict_chunked_buffers(max_age=0)
+    assert mux.num_chunked_buffers == mux.reassembly_size == 0
+    # the remaining frames of the dropped packet are discarded
+    assert list(mux.evicted_chunked_buffers) == [(0, 0)]
+    assert decode_all(mux, messages[2:]) == []
+    assert not mux.evicted_chunked_buffers
+    # and the next packets of the protocol are decoded
+    assert len(decode_all(mux, chunked_frames(1, size))) == 1
+
+    # records of evicted packets expire if no more frames arrive
+    assert not decode_all(mux, messages[:2])
+    mux.evict_chunked_buffers(max_age=0)
+    assert list(mux.evicted_chunked_buffers) == [(0, 0)]
+    mux.evict_chunked_buffers()
+    assert list(mux.evicted_chunked_buffers) == [(0, 0)]
+    mux.evict_chunked_buffers(max_age=-1)
+    assert not mux.evicted_chunked_buffers
+
+    # or once the sequence ids moved on, so reused ids aren't mistaken for leftovers
+    assert not decode_all(mux, messages[:2])
+    mux.evict_chunked_buffers(max_age=0)
+    mux._drop_evicted(0, 2**14 - 1, False, 1)
+    assert list(mux.evicted_chunked_buffers) == [(0, 0)]
+    mux._drop_evicted(0, 2**14, False, 1)
+    assert not mux.evicted_chunked_buffers
+
+
+def test_packet_stream():
+    size = 5 * Multiplexer.max_window_size
+    sender = Multiplexer()
+    sender.add_protocol(0)
+    payload = bytes(bytearray(i % 256 for i in range(size)))
+    sender.add_packet(Packet(0, cmd_id=3, payload=payload))
+    sender.add_packet(Packet(0, cmd_id=4, payload=payload))
+    messages = [f.as_bytes() for f in sender.pop_all_frames()]
+
+    mux = receiver(1, stream_filter=lambda protocol_id, cmd_id: cmd_id == 3)
+    # the stream is returned with its first frame
+    packets = mux.decode(messages[0])
+    assert len(packets) == 1
+    stream = packets[0]
+    assert isinstance(stream, PacketStream)
+    assert stream.cmd_id == 3 and stream.total_payload_size == size
+    assert mux.reassembly_size == 0
+
+    # other commands are reassembled
+    packets = decode_all(mux, messages[1:])
+    assert len(packets) == 1
+    assert not isinstance(packets[0], PacketStream)
+    assert packets[0].payload == payload
+    chunks = list(stream)
+    assert len(chunks) == len(messages) // 2
+    assert b''.join(chunks) == payload
+
+    # dropped streams raise
+    mux = receiver(1, stream_filter=lambda protocol_id, cmd_id: True)
+    stream = mux.decode(messages[0])[0]
+    mux.evict_chunked_buffers(max_age=0)
+    with pytest.raises(MultiplexerError):
+        list(stream)
+
+
+def test_stream_source():
+    import io
+    import mmap
+    import tempfile
+    size = 5 * Multiplexer.max_window_size + 123
+    payload = bytes(bytearray(i % 256 for i in range(size)))
+    read = []
+
+    def chunks():
+        for i in range(0, size, 1000):
+            read.append(i)
+            yield payload[i:i + 1000]
+
+    tmp = tempfile.TemporaryFile()
+    tmp.write(payload)
+    tmp.flush()
+    sources = [chunks(), io.BytesIO(payload), mmap.mmap(tmp.fileno(), size)]
+
+    for source in sources:
+        sender = Multiplexer()
+        sender.add_protocol(0)
+        sender.add_packet(Packet(0, cmd_id=3, payload=StreamSource(source, size)))
+        assert sender.num_active_protocols == 1
+        if source is sources[0]:
+            assert not read  # nothing is read until frames are popped
+        frames = sender.pop_frames()
+        assert len(frames) == 1
+        assert frames[0].frame_size() == sender.max_window_size
+        if source is sources[0]:
+            assert len(read) * 1000 < 2 * sender.max_window_size
+        frames.extend(sender.pop_all_frames())
+        assert sender.num_active_protocols == 0
+        packets = decode_all(receiver(1), [f.as_bytes() for f in frames])
+        assert len(packets) == 1
+        assert packets[0].cmd_id == 3
+        assert packets[0].payload == payload
+
+    # sources must provide the declared size
+    sender = Multiplexer()
+    sender.add_protocol(0)
+    sender.add_packet(Packet(0, cmd_id=3, payload=StreamSource(io.BytesIO(payload), size + 1)))
+    with pytest.raises(MultiplexerError):
+        sender.pop_all_frames()
+
+    # as must sources failing with other errors
+    def failing():
+        yield b'abc'
+        raise IOError('read failed')
+    sender = Multiplexer()
+    sender.add_protocol(0)
+    sender.add_packet(Packet(0, cmd_id=3, payload=StreamSource(failing(), size)))
+    with pytest.raises(MultiplexerError):
+        sender.pop_all_frames()
+
+    # small streams are sent as normal frames
+    sender.add_packet(Packet(0, cmd_id=3, payload=StreamSource([b'abc', b'd'], 4)))
+    frames = sender.pop_all_frames()
+    assert len(frames) == 1 and frames[0].is_normal
+    assert receiver(1).decode(frames[0].as_bytes())[0].payload == b'abcd'
+
+    # and empty ones
+    sender.add_packet(Packet(0, cmd_id=3, payload=StreamSource([], 0)))
+    frames = sender.pop_all_frames()
+    assert len(frames) == 1 and frames[0].is_normal
+    assert receiver(1).decode(frames[0].as_bytes())[0].payload == b''
+
+
+def test_just_in_time_framing():
+    mux = Multiplexer()
+    mux.add_protocol(0)
+    mux.add_protocol(1)
+    # framed at the window size when it is sent, not when it was added
+    packet = Packet(0, cmd_id=0, payload=b'\x00' * 6000)
+    mux.add_packet(packet)
+    assert mux.queues[0]['normal'].qsize() == 1
+    assert mux.num_queued_bytes == 6000
+    mux.add_packet(Packet(1, cmd_id=0, payload=b'\x00' * 100 * 1024))
+    assert mux.queues[1]['chunked'].qsize() == 1  # not one entry per frame
+    assert mux.protocol_window_size() == mux.max_window_size // 2
+    frames = mux.pop_frames_for_protocol(0)
+    assert len(frames) == 1 and frames[0].is_chunked_0
+    assert frames[0].frame_size() <= mux.max_window_size // 2
+    assert mux.num_queued_bytes < 6000 + 100 * 1024
+    frames.extend(mux.pop_frames_for_protocol(0))
+    assert len(frames) == 2
+    assert not mux.is_active_protocol(0)
+    assert mux.decode(b''.join(f.as_bytes() for f in frames)) == [packet]
+
+    # priority packets are never chunked
+    for p in range(2, 16):
+        mux.add_protocol(p)
+        mux.add_packet(Packet(p, cmd_id=0, payload=b'\x00'))
+    assert mux.protocol_window_size() < mux.max_priority_frame_size
+    mux.add_packet(Packet(0, cmd_id=0, payload=b'\x00' * 900, prioritize=True))
+    frames = mux.pop_frames_for_protocol(0, max_size=mux.max_window_size)
+    assert len(frames) == 1 and frames[0].is_normal
+    mux.pop_all_frames()
+    assert mux.num_queued_bytes == 0
+
+    # and sent with a protocol window size smaller than the frame
+    mux = Multiplexer(scheduler=RoundRobinScheduler())
+    for p in range(16):
+        mux.add_protocol(p)
+        mux.add_packet(Packet(p, cmd_id=0, payload=b'\x00' * 1000))
+    mux.add_packet(Packet(0, cmd_id=1, payload=b'\x00' * 900, prioritize=True))
+    assert mux.protocol_window_size() == 512
+    frames = [f for i in range(16) for f in mux.pop_frames()]  # one round
+    assert mux.num_active_protocols == 16
+    prio = [f for f in frames if f.protocol_id == 0 and f.cmd_id == 1]
+    assert len(prio) == 1 and prio[0].frame_size() > 512
+
+
 def test_rlpx_alpha():
     """
     protocol_id: 0
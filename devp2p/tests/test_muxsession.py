@@ -6,6 +6,10 @@ from devp2p.rlpxcipher import RLPxSession
 from devp2p.p2p_protocol import P2PProtocol
 from devp2p.service import WiredService
 from devp2p.app import BaseApp
+from devp2p.workerpool import HandshakeWorkerPool, HandshakeQueueFullError
+import threading
+import gevent
+import pytest
 
 
 class PeerMock(object):
@@ -86,3 +90,244 @@ def test_session():
     pong_packet = initiator.packet_queue.get_nowait()
     assert isinstance(pong_packet, Packet)
     data = proto.pong.decode_payload(pong_packet.payload)
+
+
+def connected_sessions(handshake_pool=None):
+    "returns initiator and responder after the handshake, all messages delivered"
+    proto = P2PProtocol(peer=PeerMock(), service=WiredService(BaseApp()))
+    hello_packet = proto.create_hello()
+    responder_privkey = mk_privkey(b'secret1')
+    responder = MultiplexedSession(responder_privkey, hello_packet=hello_packet)
+    initiator = MultiplexedSession(mk_privkey(b'secret2'), hello_packet=hello_packet,
+                                   remote_pubkey=privtopub(responder_privkey))
+    for session in (initiator, responder):
+        session.add_protocol(0)
+        session.handshake_pool = handshake_pool
+    responder.add_message(initiator.message_queue.get_nowait())
+    ack_msg = responder.message_queue.get_nowait()
+    initiator.add_message(ack_msg + responder.message_queue.get_nowait())  # with hello
+    responder.add_message(initiator.message_queue.get_nowait())
+    for session in (initiator, responder):
+        session.message_sent(session.message_queue_bytes)
+    assert initiator.is_ready and responder.is_ready
+    return initiator, responder
+
+
+def test_egress_watermarks():
+    session, _ = connected_sessions()
+    session.egress_high_watermark = 3000
+    session.egress_low_watermark = 1000
+    assert session.egress_bytes == 0
+    assert session.is_writable
+
+    for i in range(3):
+        assert session.is_writable
+        session.add_packet(Packet(0, cmd_id=0, payload=b'\x00' * 1000))
+    assert session.egress_bytes == sum(len(m) for m in session.message_queue.queue)
+    assert session.egress_bytes > 3000
+    assert not session.is_writable
+
+    # writable again once drained to the low watermark
+    while session.egress_bytes > 1000:
+        assert not session.is_writable
+        session.message_sent(len(session.message_queue.get_nowait()))
+    assert session.is_writable
+
+
+def test_ingress_watermarks():
+    initiator, responder = connected_sessions()
+    responder.ingress_high_watermark = 3000
+    responder.ingress_low_watermark = 1000
+    responder.packet_handled(responder.packet_queue.get_nowait())  # hello
+    assert responder.ingress_bytes == 0
+    assert responder.is_readable
+
+    for i in range(3):
+        assert responder.is_readable
+        initiator.add_packet(Packet(0, cmd_id=0, payload=b'\x00' * 1000))
+        responder.add_message(initiator.message_queue.get_nowait())
+    assert responder.ingress_bytes == 3000
+    assert not responder.is_readable
+
+    responder.packet_handled(responder.packet_queue.get_nowait())
+    assert not responder.is_readable
+    responder.packet_handled(responder.packet_queue.get_nowait())
+    assert responder.is_readable
+
+
+def test_stream_ingress_accounting():
+    initiator, responder = connected_sessions()
+    responder.packet_handled(responder.packet_queue.get_nowait())  # hello
+    responder.stream_filter = lambda protocol_id, cmd_id: True
+    initiator.add_packet(Packet(0, cmd_id=0, payload=b'\x00' * 5 * initiator.max_window_size))
+    while not initiator.message_queue.empty():
+        responder.add_message(initiator.message_queue.get_nowait())
+    stream = responder.packet_queue.get_nowait()
+    assert responder.ingress_bytes == 5 * initiator.max_window_size
+    for chunk in stream:
+        pass
+    assert responder.ingress_bytes == 0
+
+
+def test_no_eviction_while_paused():
+    initiator, responder = connected_sessions()
+    responder.packet_handled(responder.packet_queue.get_nowait())  # hello
+    responder.ingress_high_watermark = 3000
+    responder.ingress_low_watermark = 1000
+    initiator.add_packet(Packet(0, cmd_id=0, payload=b'\x00' * 3000))
+    initiator.add_packet(Packet(0, cmd_id=0, payload=b'\x00' * 5 * initiator.max_window_size))
+    while not responder.num_chunked_buffers:
+        responder.add_message(initiator.message_queue.get_nowait())
+    assert not responder.is_readable
+    # frames held back by our own backpressure don't make the packet stale
+    buf, = responder.chunked_buffers[0].values()
+    last_update = buf.last_update
+    responder.evict_chunked_buffers(max_age=0)
+    assert responder.num_chunked_buffers == 1
+    gevent.sleep(0.01)
+    responder.packet_handled(responder.packet_queue.get_nowait())
+    assert responder.is_readable
+    assert buf.last_update >= last_update + 0.01
+    gevent.sleep(0.01)
+    responder.evict_chunked_buffers(max_age=0.005)
+    assert responder.num_chunked_buffers == 0
+
+
+def test_stream_send():
+    from devp2p.multiplexer import StreamSource
+    initiator, responder = connected_sessions()
+    initiator.egress_high_watermark = 64 * 1024
+    initiator.egress_low_watermark = 16 * 1024
+    size = 1024**2
+    read = []
+
+    def chunks():
+        for i in range(size // 1024):
+            read.append(i)
+            yield b'\x00' * 1024
+
+    initiator.add_packet(Packet(0, cmd_id=0, payload=StreamSource(chunks(), size)))
+    # frames are only cut while the message queue has room
+    assert initiator.message_queue_bytes >= initiator.egress_high_watermark
+    assert len(read) * 1024 < initiator.egress_high_watermark + initiator.max_window_size
+    packets = []
+    while not initiator.message_queue.empty():
+        msg = initiator.message_queue.get_nowait()
+        initiator.message_sent(len(msg))
+        assert initiator.message_queue_bytes <= \
+            initiator.egress_high_watermark + initiator.max_window_size
+        packets.extend(responder.decode(msg))
+    assert len(read) == size // 1024
+    assert len(packets) == 1
+    assert packets[0].payload == b'\x00' * size
+
+
+def test_concurrent_flush():
+    from devp2p.multiplexer import StreamSource
+    initiator, responder = connected_sessions()
+    size = 256 * 1024
+
+    def chunks():  # yields to other greenlets while it is read, e.g. from a socket
+        for i in range(size // 1024):
+            gevent.sleep(0)
+            yield b'\x01' * 1024
+
+    stream_packet = Packet(0, cmd_id=0, payload=StreamSource(chunks(), size))
+    sender = gevent.spawn(initiator.add_packet, stream_packet)
+    gevent.sleep(0)
+    assert not sender.ready()  # reading the source
+    # flushes while the source is read don't cut frames of their own
+    packet = Packet(0, cmd_id=1, payload=b'x' * 100)
+    initiator.add_packet(packet)
+    initiator.message_sent(0)
+    sender.get()
+    assert initiator.num_active_protocols == 0  # all framed by the running flush
+    packets = []
+    while not initiator.message_queue.empty():
+        msg = initiator.message_queue.get_nowait()
+        initiator.message_sent(len(msg))
+        packets.extend(responder.decode(msg))
+    assert len(packets) == 2
+    assert packets[0] == packet
+    assert packets[1].payload == b'\x01' * size
+
+
+def test_delayed_flush_error():
+    from devp2p.multiplexer import MultiplexerError, StreamSource
+    initiator, responder = connected_sessions()
+    initiator.add_protocol(1, max_bandwidth=64 * 1024)
+    errors = []
+    initiator.on_error = errors.append
+
+    def chunks():  # fails after 100 KB of the declared 1 MB
+        for i in range(100):
+            yield b'\x00' * 1024
+
+    initiator.add_packet(Packet(1, cmd_id=0, payload=StreamSource(chunks(), 1024**2)))
+    assert initiator._flush_timer and not errors
+    gevent.sleep(0.5)
+    assert len(errors) == 1 and isinstance(errors[0], MultiplexerError)
+
+    # the timer is killed when the session stops
+    initiator.add_packet(Packet(1, cmd_id=0, payload=b'\x00' * 100 * 1024))
+    timer = initiator._flush_timer
+    initiator.stop()
+    assert timer.dead and not initiator._flush_timer
+
+
+def test_flush_error():
+    from devp2p.multiplexer import MultiplexerError, StreamSource
+
+    def chunks(size):  # fails after size bytes of the declared 1 MB
+        for i in range(size // 1024):
+            yield b'\x00' * 1024
+        raise IOError('read failed')
+
+    # while the packet is added
+    initiator, responder = connected_sessions()
+    with pytest.raises(MultiplexerError):
+        initiator.add_packet(Packet(0, cmd_id=0, payload=StreamSource(chunks(10240), 1024**2)))
+    initiator, responder = connected_sessions()
+    errors = []
+    initiator.on_error = errors.append
+    initiator.add_packet(Packet(0, cmd_id=0, payload=StreamSource(chunks(10240), 1024**2)))
+    assert len(errors) == 1 and isinstance(errors[0], MultiplexerError)
+
+    # or once sent messages make room for more frames
+    initiator, responder = connected_sessions()
+    initiator.egress_high_watermark = 64 * 1024
+    initiator.egress_low_watermark = 16 * 1024
+    initiator.on_error = errors.append
+    initiator.add_packet(Packet(0, cmd_id=0, payload=StreamSource(chunks(200 * 1024), 1024**2)))
+    assert len(errors) == 1
+    while not initiator.message_queue.empty():
+        initiator.message_sent(len(initiator.message_queue.get_nowait()))
+    assert len(errors) == 2 and isinstance(errors[1], MultiplexerError)
+
+
+def test_handshake_pool():
+    pool = HandshakeWorkerPool(size=2)
+    ticks = []
+
+    def ticker():
+        while True:
+            ticks.append(1)
+            gevent.sleep(0)
+    ticker = gevent.spawn(ticker)
+    initiator, responder = connected_sessions(handshake_pool=pool)
+    assert ticks  # the hub was not blocked by the handshake
+    ticker.kill()
+    assert pool.num_queued == 0
+
+    # the handshake is rejected once max_queued steps are waiting
+    pool = HandshakeWorkerPool(size=1, max_queued=1)
+    release = threading.Event()
+    blocked = gevent.spawn(pool.apply, release.wait)
+    gevent.sleep(0.01)
+    with pytest.raises(HandshakeQueueFullError):
+        connected_sessions(handshake_pool=pool)
+    assert pool.num_rejected == 1
+    release.set()
+    blocked.join()
+    assert pool.num_queued == 0
+    pool.stop()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import operator
+import random
+import pytest
+from devp2p import kademlia
+from devp2p.tests.test_kademlia import random_node, fake_node_from_id
+
+NodeIdStore = pytest.importorskip('devp2p.nodeidstore').NodeIdStore  # requires numpy
+
+random.seed(42)
+
+
+class IdStoreRoutingTable(kademlia.RoutingTable):
+    use_id_store = True
+
+
+def by_distance(nodes, id):
+    return sorted(nodes, key=operator.methodcaller('id_distance', id))
+
+
+def test_store():
+    store = NodeIdStore(capacity=4)
+    nodes = [random_node() for i in range(100)]
+    # ids with equal words, differing in a single word only
+    base = nodes[0].id
+    nodes += [fake_node_from_id(base ^ (1 << shift)) for shift in (0, 63, 64, 127, 128, 255)]
+    for node in nodes:
+        store.add(node)
+    assert len(store) == len(nodes)
+    for i in range(20):
+        id = random.choice((kademlia.random_nodeid(), base, random.choice(nodes).id))
+        distances = store.distances(id)
+        for node, words in zip(store.nodes, distances):
+            assert sum(int(w) << s for w, s in zip(words, (192, 128, 64, 0))) == node.id ^ id
+        expected = by_distance(nodes, id)
+        assert store.closest(id, 16) == expected[:16]
+        assert store.closest(id, 1000) == expected
+        assert store.closest_many([id, base], 3) == [expected[:3], by_distance(nodes, base)[:3]]
+        distance = expected[random.randrange(len(expected))].id_distance(id)
+        assert store.within_distance(id, distance) == [n for n in expected
+                                                       if n.id_distance(id) <= distance]
+    assert store.within_distance(base, 2 ** 300) == by_distance(nodes, base)
+
+    ids = [kademlia.random_nodeid() for i in range(10)] + [base, nodes[-1].id]
+    for k in (1, 3, 16, len(nodes), 1000):
+        assert store.closest_many(ids, k) == [by_distance(nodes, t)[:k] for t in ids]
+    assert store.closest_many([], 3) == []
+    assert store.closest_many(ids, 0) == [[]] * len(ids)
+
+    # removal moves the last row, replacing keeps the row
+    for node in nodes[:50]:
+        store.remove(node.pubkey)
+    store.remove(nodes[0].pubkey)
+    replacement = kademlia.Node(nodes[-1].pubkey)
+    store.add(replacement)
+    assert len(store) == len(nodes) - 50
+    assert store.closest(base, 1000) == by_distance([replacement] + nodes[50:-1], base)
+
+
+def test_routing_table_id_store():
+    routing = IdStoreRoutingTable(random_node())
+    nodes = [random_node() for i in range(2000)]
+    for i in range(5000):
+        node = random.choice(nodes)
+        if random.random() < 0.8:
+            routing.add_node(node)
+        else:
+            routing.remove_node(node)
+    assert sorted(routing.id_store.nodes) == sorted(routing)
+    for node in routing:
+        assert routing.id_store.nodes[routing.id_store._rows[node.pubkey]] is node
+
+    for i in range(20):
+        id = kademlia.random_nodeid()
+        distance = kademlia.k_max_node_id >> random.randint(0, 10)
+        assert routing.neighbours_within_distance(id, distance) == by_distance(
+            [n for n in routing if n.id_distance(id) <= distance], id)
+        assert routing.id_store.closest(id, 16) == routing.neighbours(id)
@@ -1,9 +1,10 @@
 from devp2p.p2p_protocol import P2PProtocol
 from devp2p.service import WiredService
 from devp2p.app import BaseApp
-from devp2p.multiplexer import Packet
+from devp2p.multiplexer import Multiplexer, Packet
 from devp2p.utils import remove_chars
 import pytest
+import rlp
 from rlp.utils import decode_hex
 # notify peer of successfulll handshake!
 # so other protocols get registered
@@ -118,3 +119,83 @@ def test_callback():
     assert not peer.packets
     assert len(r) == 1
     assert r[0] == dict()
+
+
+def test_streaming_command():
+    from devp2p.protocol import BaseProtocol
+    from devp2p.multiplexer import PacketStream
+    received = []
+
+    class StreamingProtocol(BaseProtocol):
+
+        class chunks(BaseProtocol.command):
+            cmd_id = 0
+            structure = [('data', rlp.sedes.binary)]
+            streaming = True
+
+            def receive_stream(self, proto, chunks):
+                received.append(list(chunks))
+
+        class data(BaseProtocol.command):
+            cmd_id = 1
+            structure = [('data', rlp.sedes.binary)]
+            streaming = True  # default receive_stream decodes the whole payload
+
+    proto = StreamingProtocol(PeerMock(), WiredService(BaseApp()))
+    assert proto.streaming_cmd_ids == set([0, 1])
+    proto.receive_data_callbacks.append(lambda proto, data: received.append(data))
+
+    payload = proto.create_data(data=b'x' * 100).payload
+    stream = PacketStream(proto.protocol_id, 1, len(payload))
+    stream.feed(payload[:10])
+    stream.feed(payload[10:])
+    stream.close()
+    proto.receive_packet(stream)
+    assert received.pop() == b'x' * 100
+
+    stream = PacketStream(proto.protocol_id, 0, len(payload))
+    stream.feed(payload[:10])
+    stream.feed(payload[10:])
+    stream.close()
+    proto.receive_packet(stream)
+    assert received.pop() == [payload[:10], payload[10:]]
+
+    # non-chunked packets are passed as a single chunk
+    proto.receive_packet(proto.create_chunks(data=b'x'))
+    assert received.pop() == [proto.create_chunks(data=b'x').payload]
+
+    # streaming send
+    peer = proto.peer
+    peer.packets = []
+    payload = proto.create_data(data=b'x' * 100).payload
+    proto.send_stream('data', iter([payload[:10], payload[10:]]), len(payload))
+    packet = peer.packets.pop()
+    assert packet.cmd_id == 1
+    assert len(packet) == len(payload)
+    assert packet.payload.read(len(payload)) == payload
+
+    # empty streams are framed too
+    proto.send_stream('data', iter([]), 0)
+    mux = Multiplexer()
+    mux.add_protocol(proto.protocol_id)
+    mux.add_packet(peer.packets.pop())
+    message = mux.pop_all_frames_as_bytes()
+    packets = mux.decode(message)
+    assert len(packets) == 1 and packets[0].payload == b''
+
+
+def test_blocking_send():
+    peer = PeerMock()
+    peer.packets = []
+    proto = P2PProtocol(peer, WiredService(BaseApp()))
+    proto.blocking_send = True
+    peer.wait_writable = lambda timeout=None: True
+    proto.send_ping()
+    assert len(peer.packets) == 1
+
+    # nothing is queued once the peer stopped
+    peer.wait_writable = lambda timeout=None: False
+    proto.send_ping()
+    payload = proto.create_ping().payload
+    proto.send_stream('ping', iter([payload]), len(payload))
+    assert len(peer.packets) == 1
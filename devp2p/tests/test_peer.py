@@ -113,6 +113,7 @@ def test_dumb_peer():
     b_app.stop()
     gevent.sleep(0.1)
 
+
 def test_offset_dispatch():
     """ test offset-based cmd_id translation """
 
@@ -194,6 +195,145 @@ def test_offset_dispatch():
 
     p.stop()
 
+
+def get_mock_peer(**p2p_config):
+    "returns a peer with a mocked peermanager and connection, writes are recorded"
+
+    class MockPeerManager(peermanager.PeerManager):
+        privkey = crypto.sha3(b'a')
+        pubkey = crypto.privtopub(privkey)
+        wired_services = []
+        config = {
+            'client_version_string': 'mock',
+            'p2p': dict(listen_port=3006, **p2p_config),
+            'node': {'privkey_hex': encode_hex(privkey), 'id': encode_hex(pubkey)}}
+
+        def __init__(self):
+            pass
+
+    class MockConnection(object):
+        def __init__(self):
+            self.writes = []
+
+        def getpeername(*_):
+            return "mock"
+
+        def sendall(self, data):
+            self.writes.append(data.tobytes())
+
+    mpm = MockPeerManager()
+    p = peer.Peer(mpm, MockConnection())
+    mpm.peers = [p]
+    return p
+
+
+def test_egress_batch():
+    """ ready messages are coalesced and written with a single sendall """
+    p = get_mock_peer(max_egress_batch_size=100)
+    queue = p.mux.message_queue
+    assert len(p._send_buffer) == 100
+
+    messages = [str_to_bytes(c) * 30 for c in 'abcde']
+    for msg in messages:
+        queue.put(msg)
+    p.send(p._next_egress_batch())
+    p.send(p._next_egress_batch())
+    assert queue.empty()
+    assert p.connection.writes == [b''.join(messages[:3]), b''.join(messages[3:])]
+
+    # messages larger than the batch size are sent in one piece
+    queue.put(b'x' * 250)
+    queue.put(b'y')
+    p.send(p._next_egress_batch())
+    p.send(p._next_egress_batch())
+    assert p.connection.writes[2:] == [b'x' * 250, b'y']
+    assert len(p._send_buffer) == 100
+    assert p.safe_to_read.is_set()
+
+    p.stop()
+
+
+def test_read_pause():
+    """ reading pauses while the handled packets are above the ingress watermarks """
+    p = get_mock_peer(ingress_high_watermark=200, ingress_low_watermark=100)
+    p._wait_readable()
+    assert p.num_read_pauses == 0
+
+    packets = [devp2p.multiplexer.Packet(0, 0, b'\x00' * 100) for i in range(3)]
+    for packet in packets:
+        p.mux.ingress_bytes += len(packet)
+    p.mux._update_readable()
+    assert not p.mux.is_readable
+
+    def handle():
+        for packet in packets[:2]:
+            gevent.sleep(0.05)
+            p.mux.packet_handled(packet)
+    g = gevent.spawn(handle)
+    p._wait_readable()
+    assert p.mux.ingress_bytes == 100
+    assert p.num_read_pauses == 1
+    assert p.read_paused_time >= 0.09
+    g.join()
+    p.stop()
+
+
+def test_stream_interleaved(monkeypatch):
+    """ streams don't block the packets decoded behind them with small ingress watermarks """
+    from devp2p.multiplexer import Packet
+    received = dict(streams=[], notes=[])
+
+    class transfer(devp2p.p2p_protocol.BaseProtocol.command):
+        cmd_id = 4
+        streaming = True
+
+        def receive_stream(self, proto, chunks):
+            if not received['streams']:  # the second stream is not consumed
+                gevent.sleep(0.01)
+                received['streams'].append(b''.join(chunks))
+
+    class note(devp2p.p2p_protocol.BaseProtocol.command):
+        cmd_id = 5
+        structure = [('raw_data', rlp.sedes.binary)]
+
+        def receive(self, proto, data):
+            received['notes'].append(data['raw_data'])
+
+    monkeypatch.setattr(devp2p.p2p_protocol.P2PProtocol, 'transfer', transfer, raising=False)
+    monkeypatch.setattr(devp2p.p2p_protocol.P2PProtocol, 'note', note, raising=False)
+    p = get_mock_peer(ingress_high_watermark=3000, ingress_low_watermark=1000)
+    hello_packet = devp2p.p2p_protocol.P2PProtocol.get_hello_packet(p)
+    remote = devp2p.muxsession.MultiplexedSession(
+        crypto.sha3(b'b'), hello_packet, remote_pubkey=crypto.privtopub(crypto.sha3(b'a')))
+    remote.add_protocol(0)
+    p.mux.add_message(remote.message_queue.get_nowait())
+    remote.add_message(p.mux.message_queue.get_nowait() + p.mux.message_queue.get_nowait())
+    p.mux.add_message(remote.message_queue.get_nowait())
+    p.mux.packet_handled(p.mux.packet_queue.get_nowait())  # hello
+
+    payload = b'\x01' * 40960
+    for i in range(2):
+        remote.add_packet(Packet(0, cmd_id=4, payload=payload))
+        for j in range(10):
+            remote.add_packet(Packet(0, cmd_id=5, payload=rlp.encode([b'\x02' * 1000])))
+
+    def reader():
+        while not remote.message_queue.empty():
+            p._wait_readable()
+            p.mux.add_message(remote.message_queue.get_nowait())
+    decoder = gevent.spawn(p._run_decoded_packets)
+    reader = gevent.spawn(reader)
+    reader.join(timeout=5)
+    assert reader.successful()
+    p.greenlets['streams'].join(timeout=5)
+    assert received['streams'] == [payload]
+    assert len(received['notes']) == 20
+    assert p.mux.ingress_bytes == 0 and p.mux.is_readable
+    assert p.num_read_pauses > 0
+    decoder.kill()
+    p.stop()
+
+
 def connect_go():
     a_config = dict(p2p=dict(listen_host='127.0.0.1', listen_port=3010),
                     node=dict(privkey_hex=encode_hex(crypto.sha3(b'a'))))
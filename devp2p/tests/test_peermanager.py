@@ -44,6 +44,65 @@ def test_app_restart():
     a_app.stop()
     assert a_app.services.peermanager.is_stopped
 
+
+def test_broadcast_congested():
+
+    class PeerMock(object):
+        def __init__(self, name, is_writable):
+            self.name = name
+            self.writable = gevent.event.Event()
+            if is_writable:
+                self.writable.set()
+            self.safe_to_read = gevent.event.Event()
+            self.safe_to_read.set()
+            self.protocols = {devp2p.p2p_protocol.P2PProtocol: self}
+
+        @property
+        def is_writable(self):
+            return self.writable.is_set()
+
+        def wait_writable(self, timeout=None):
+            return self.writable.wait(timeout)
+
+        def send_ping(self):
+            sent.append(self.name)
+
+    class PeerManagerMock(peermanager.PeerManager):
+        def __init__(self):
+            self.peers = [PeerMock('a', True), PeerMock('b', False)]
+            self.deferred_broadcasts = dict()
+
+    pm = PeerManagerMock()
+    sent = []
+    pm.broadcast(devp2p.p2p_protocol.P2PProtocol, 'ping', congested='skip')
+    assert sent == ['a']
+
+    sent = []
+    pm.broadcast(devp2p.p2p_protocol.P2PProtocol, 'ping', congested='defer')
+    gevent.sleep(0.01)
+    assert sent == ['a']
+    pm.peers[1].writable.set()
+    gevent.sleep(0.01)
+    assert sent == ['a', 'b']
+    assert not pm.deferred_broadcasts
+
+    # the deferred broadcasts of a peer are bounded, the oldest are dropped
+    pm.peers[1].writable.clear()
+    pm.max_deferred_broadcasts = 2
+    sent = []
+    for i in range(3):
+        pm.broadcast(devp2p.p2p_protocol.P2PProtocol, 'ping', congested='defer')
+    assert len(pm.deferred_broadcasts[pm.peers[1]]) == 2
+    pm.peers[1].writable.set()
+    gevent.sleep(0.01)
+    assert sent == ['a'] * 3 + ['b'] * 2
+    assert not pm.deferred_broadcasts
+
+    sent = []
+    pm.broadcast(devp2p.p2p_protocol.P2PProtocol, 'ping')
+    assert sorted(sent) == ['a', 'b']
+
+
 if __name__ == '__main__':
     # ethereum -loglevel 5 --bootnodes ''
     import ethereum.slogging
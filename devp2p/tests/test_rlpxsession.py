@@ -1,5 +1,5 @@
-from devp2p.rlpxcipher import RLPxSession, FormatError
-from devp2p.crypto import mk_privkey, ECCx, sha3
+from devp2p.rlpxcipher import RLPxSession, FormatError, is_eip8_message
+from devp2p.crypto import mk_privkey, privtopub, ECCx, sha3
 from devp2p.multiplexer import Multiplexer, Packet
 from devp2p.utils import remove_chars
 from rlp.utils import decode_hex, str_to_bytes
@@ -54,6 +54,26 @@ def test_multiplexing():
     assert packet1 == packets[0]
 
 
+def test_multiplexing_in_place():
+    initiator, responder = test_session()
+    imux = Multiplexer(frame_cipher=initiator)
+    rmux = Multiplexer(frame_cipher=responder)
+    imux.add_protocol(1)
+    rmux.add_protocol(1)
+
+    payloads = [b'', b'\x01' * 15, b'\x02' * 100, sha3(b'x') * 1000]
+    for payload in payloads:
+        imux.add_packet(Packet(1, cmd_id=3, payload=payload))
+    msg = imux.pop_all_frames_as_bytes()
+    packets = []
+    for i in range(0, len(msg), 1000):
+        packets.extend(rmux.decode(msg[i:i + 1000]))
+    assert [p.payload for p in packets] == payloads
+    for packet in packets:
+        assert isinstance(packet.payload, memoryview)
+        assert packet.cmd_id == 3
+
+
 def test_many_sessions():
     for i in range(20):
         test_session()
@@ -216,6 +236,58 @@ def test_auth_ack_is_eip8_for_eip8_auth():
     assert initiator.remote_version == 55
 
 
+def test_single_ecies_decrypt():
+    "the format is detected before decryption, messages are decrypted only once"
+    def counting(ecc):
+        decrypt = ecc.ecies_decrypt
+        calls = []
+
+        def ecies_decrypt(*args, **kargs):
+            calls.append(1)
+            return decrypt(*args, **kargs)
+        ecc.ecies_decrypt = ecies_decrypt
+        return calls
+
+    for handshake in eip8_handshakes:
+        initiator = RLPxSession(ECCx(raw_privkey=eip8_values['key_a']), is_initiator=True)
+        responder = RLPxSession(ECCx(raw_privkey=eip8_values['key_b']))
+        assert is_eip8_message(handshake['auth']) == handshake['eip8_format']
+        assert is_eip8_message(handshake['ack']) == handshake['eip8_format']
+        calls = counting(responder.ecc)
+        responder.decode_authentication(handshake['auth'])
+        assert len(calls) == 1
+        calls = counting(initiator.ecc)
+        initiator.decode_auth_ack_message(handshake['ack'])
+        assert len(calls) == 1
+
+    # legacy message starting with 0x04 || ephemeral-pubk where the pubkey starts with 0x04 too
+    for i in range(10000):
+        pubkey = privtopub(mk_privkey(str_to_bytes(str(i))))
+        if pubkey[1:2] == b'\x04':
+            break
+    assert not is_eip8_message(b'\x04' + pubkey + b'\x00' * (307 - 65))
+    assert is_eip8_message(b'\x01\x04\x04' + pubkey + b'\x00' * 300)
+
+
+def test_eip8_auth_message():
+    initiator = RLPxSession(ECCx(raw_privkey=eip8_values['key_a']), is_initiator=True)
+    responder = RLPxSession(ECCx(raw_privkey=eip8_values['key_b']))
+    auth_msg = initiator.create_auth_message(remote_pubkey=eip8_values['pub_b'])
+    auth_msg_ct = initiator.encrypt_auth_message(auth_msg, eip8=True)
+    assert is_eip8_message(auth_msg_ct)
+    assert responder.decode_authentication(auth_msg_ct + b'rest') == b'rest'
+    assert responder.got_eip8_auth
+    assert responder.remote_pubkey == eip8_values['pub_a']
+    assert responder.remote_ephemeral_pubkey == initiator.ephemeral_ecc.raw_pubkey
+    assert responder.auth_init == auth_msg_ct
+
+    # the ack is answered in EIP-8 format and may be followed by the hello
+    auth_ack_msg_ct = responder.encrypt_auth_ack_message(responder.create_auth_ack_message())
+    assert initiator.decode_auth_ack_message(auth_ack_msg_ct + b'hello') == b'hello'
+    assert initiator.got_eip8_ack
+    assert initiator.auth_ack == auth_ack_msg_ct
+
+
 def test_macs():
     initiator, responder = test_session()
     assert responder.egress_mac.digest() == initiator.ingress_mac.digest()
@@ -299,3 +371,32 @@ def test_body_length():
     except FormatError:
         exception_raised = True
     assert exception_raised
+
+
+def test_encrypt_frames():
+    initiator, responder = test_session()
+    frames = []
+    for i, size in enumerate((0, 16, 64, 1024, 8192)):
+        header = struct.pack('>I', size)[1:] + sha3(str_to_bytes(str(i)))[:16 - 3]
+        frames.append((header, sha3(str_to_bytes(str(i))) * (size // 32) + b'\x01' * (size % 32)))
+
+    # batched frames can be decrypted one by one
+    data = initiator.encrypt_frames(frames)
+    assert isinstance(data, bytearray)  # not copied again
+    data = bytes(data)
+    for header, frame in frames:
+        r = responder.decrypt(data)
+        assert (r['header'], r['frame']) == (header, frame)
+        data = data[r['bytes_read']:]
+    assert not data
+
+    # frames encrypted one by one can be decrypted in place
+    data = bytearray(b''.join(initiator.encrypt(h, f) for h, f in frames))
+    pos = 0
+    for header, frame in frames:
+        assert responder.decrypt_header(bytes(data[pos:pos + 32])) == header
+        read = responder.decrypt_body_into(data, pos + 32, len(frame), data, pos + 32)
+        assert data[pos + 32:pos + 32 + len(frame)] == frame
+        pos += 32 + read
+    assert pos == len(data)
+    assert initiator.egress_mac.digest() == responder.ingress_mac.digest()
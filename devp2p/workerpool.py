@@ -0,0 +1,50 @@
+"""
+Worker threads for the CPU-heavy parts of RLPx handshakes.
+
+ECIES decryption, ECDH, signature recovery and the key derivation run in OpenSSL
+and libsecp256k1, which release the GIL. Running them on a gevent ThreadPool
+lets the calling greenlet yield, so the hub keeps serving established peers
+during a burst of incoming connections. State the steps share with the hub, like
+the ECDH cache of ECCx, is guarded by locks which are not monkey patched by gevent.
+
+A process pool is not offered: the sessions hold OpenSSL contexts (via ctypes)
+which can not be passed to another process.
+"""
+import gevent.threadpool
+from .rlpxcipher import RLPxSessionError
+
+
+class HandshakeQueueFullError(RLPxSessionError):
+
+    "raised if max_queued handshake steps are already running or waiting for a worker"
+    pass
+
+
+class HandshakeWorkerPool(object):
+
+    size = 4
+    max_queued = 64
+
+    def __init__(self, size=None, max_queued=None):
+        if size is not None:
+            self.size = size
+        if max_queued is not None:
+            self.max_queued = max_queued
+        assert self.size > 0 and self.max_queued > 0
+        self.pool = gevent.threadpool.ThreadPool(self.size)
+        self.num_queued = 0  # running or waiting for a worker
+        self.num_rejected = 0
+
+    def apply(self, func, *args):
+        "runs func(*args) in a worker thread, the calling greenlet yields until it is done"
+        if self.num_queued >= self.max_queued:
+            self.num_rejected += 1
+            raise HandshakeQueueFullError('too many queued handshakes')
+        self.num_queued += 1
+        try:
+            return self.pool.apply(func, args)
+        finally:
+            self.num_queued -= 1
+
+    def stop(self):
+        self.pool.kill()
@@ -473,6 +473,13 @@ def main(num_nodes):
     # min_peer settings to test
     min_peer_options = (6,)
 
+    # vectorized neighbours_within_distance, if numpy is available
+    try:
+        import devp2p.nodeidstore
+        devp2p.kademlia.RoutingTable.use_id_store = True
+    except ImportError:
+        pass
+
     print 'running %d simulations' % (len(min_peer_options) * len(klasses))
 
     results = []
@@ -0,0 +1,89 @@
+"""
+Benchmarks for RLPx handshakes.
+
+installation:
+
+    python setup.py develop
+
+usage:
+    python examples/handshake_benchmark.py
+
+reports the handshakes/sec of complete in-process RLPx handshakes (auth, ack and
+key derivation on both sides) with legacy and EIP-8 auth/ack messages.
+The format of the messages is detected before decryption. For comparison the
+handshakes are repeated with the previous trial decryption, which first decrypts
+every message as a legacy message and falls back to EIP-8 on failure.
+"""
+from __future__ import print_function
+import time
+from devp2p.crypto import mk_privkey, ECCx, ecdsa_recover
+from devp2p.rlpxcipher import RLPxSession, AuthenticationError, sxor
+
+initiator_ecc = ECCx(raw_privkey=mk_privkey(b'initiator'))
+responder_ecc = ECCx(raw_privkey=mk_privkey(b'responder'))
+
+
+class TrialDecodingSession(RLPxSession):
+
+    "decodes handshake messages like before the format detection"
+
+    def decode_authentication(self, ciphertext):
+        assert not self.is_initiator
+        try:
+            size, sig, initiator_pubkey, nonce, version = self.decode_auth_plain(ciphertext)
+        except AuthenticationError:
+            size, sig, initiator_pubkey, nonce, version = self.decode_auth_eip8(ciphertext)
+            self.got_eip8_auth = True
+        self.auth_init = ciphertext[:size]
+        token = self.ecc.get_cached_ecdh_key(initiator_pubkey)
+        self.remote_ephemeral_pubkey = ecdsa_recover(sxor(token, nonce), sig)
+        self.initiator_nonce = nonce
+        self.remote_pubkey = initiator_pubkey
+        self.remote_version = version
+        return ciphertext[size:]
+
+    def decode_auth_ack_message(self, ciphertext):
+        assert self.is_initiator
+        try:
+            size, eph_pubkey, nonce, version = self.decode_ack_plain(ciphertext)
+        except AuthenticationError:
+            size, eph_pubkey, nonce, version = self.decode_ack_eip8(ciphertext)
+            self.got_eip8_ack = True
+        self.auth_ack = ciphertext[:size]
+        self.remote_ephemeral_pubkey = eph_pubkey[:64]
+        self.responder_nonce = nonce
+        self.remote_version = version
+        return ciphertext[size:]
+
+
+def handshake(eip8=False, session_class=RLPxSession):
+    initiator = session_class(initiator_ecc, is_initiator=True)
+    responder = session_class(responder_ecc)
+    auth_msg = initiator.create_auth_message(remote_pubkey=responder_ecc.raw_pubkey)
+    responder.decode_authentication(initiator.encrypt_auth_message(auth_msg, eip8=eip8))
+    auth_ack_msg = responder.create_auth_ack_message()
+    initiator.decode_auth_ack_message(responder.encrypt_auth_ack_message(auth_ack_msg))
+    initiator.setup_cipher()
+    responder.setup_cipher()
+    assert responder.got_eip8_auth == initiator.got_eip8_ack == eip8
+
+
+def handshakes_per_sec(min_duration=2., **kargs):
+    num = 0
+    st = time.time()
+    while time.time() - st < min_duration:
+        handshake(**kargs)
+        num += 1
+    return num / (time.time() - st)
+
+
+def main():
+    print('format\tdecoding\thandshakes/sec')
+    for eip8 in (False, True):
+        for name, session_class in (('detect', RLPxSession), ('trial', TrialDecodingSession)):
+            print('%s\t%s\t%.1f' % ('eip8' if eip8 else 'legacy', name,
+                                    handshakes_per_sec(eip8=eip8, session_class=session_class)))
+
+
+if __name__ == '__main__':
+    main()
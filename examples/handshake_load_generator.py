@@ -0,0 +1,319 @@
+"""
+Load generator for RLPx handshakes.
+
+installation:
+
+    python setup.py develop
+
+usage:
+    python examples/handshake_load_generator.py [-n 500] [-c 16] [--workers 2]
+        [--format legacy|eip8] [--tcp | --connect host:port | --listen port] [--json]
+
+drives n initiator MultiplexedSessions, c at a time, against MultiplexedSession
+responders of one node. every initiator has its own static key, so no ECDH secret
+is cached. a handshake is complete once the initiator decoded the hello packet of
+the responder (auth, ack, key derivation on both sides and one frame each way).
+
+transports:
+    default         messages are passed between the sessions in-process
+    --tcp           a responder server on a loopback port of this process
+    --listen port   only runs the responder server (on 127.0.0.1:port)
+    --connect h:p   only runs the initiators, against a server started with --listen
+
+with --workers the responders run their handshake crypto on a HandshakeWorkerPool.
+
+reports for legacy and EIP-8 auth/ack messages the handshakes/sec, the p50/p99/max
+setup latency (from the start of the initiator until it decoded the hello packet)
+and the CPU time per handshake of this process, split into
+
+    ecies       ECIES key derivation, MAC and AES (without the key agreement)
+    ecdh        all ECDH key agreements, static, ephemeral and inside ECIES
+    recover     recovery of the remote ephemeral pubkey from the auth signature
+    sign        signing the auth message
+    validate    pubkey validation
+    kdf         key derivation of the session secrets, MACs and frame ciphers
+    keygen      ephemeral key generation (mostly done by the background key pool)
+    other       the rest: rlp, framing, sessions, the transport and this tool
+
+times are CPU times, measured on the calling thread and exclusive, a nested primitive
+is not counted for the calling one. in-process and with --tcp both sides are counted.
+python 2 has no CPU clock per thread, there the process CPU time is used, so with
+--workers the primitives also include the time of other threads running meanwhile.
+
+with --json one JSON object is printed per line and variant, e.g. to be collected
+and compared between revisions.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from functools import wraps
+import gevent
+import gevent.socket
+from gevent.server import StreamServer
+from devp2p import crypto, rlpxcipher
+from devp2p.crypto import ECCx, NodeIdentity, mk_privkey
+from devp2p.multiplexer import Packet
+from devp2p.muxsession import MultiplexedSession
+from devp2p.rlpxcipher import RLPxSession
+from devp2p.workerpool import HandshakeWorkerPool
+
+hello_packet = Packet(0, cmd_id=0, payload=b'hello')
+
+try:
+    cpu_time = time.thread_time  # python 3.7
+except AttributeError:
+    cpu_time = time.clock  # CPU time of the process
+responder_identity = NodeIdentity(mk_privkey(b'responder'))
+
+
+class Initiator(MultiplexedSession):
+
+    eip8 = False  # send the auth message in the EIP-8 format
+
+    def _send_init_msg(self):
+        auth_msg = self.rlpx_session.create_auth_message(self._remote_pubkey)
+        self._put_message(self.rlpx_session.encrypt_auth_message(auth_msg, eip8=self.eip8))
+
+
+class EIP8Initiator(Initiator):
+    eip8 = True
+
+
+class CPUBreakdown(object):
+
+    "context manager which accumulates the CPU time spent in the handshake crypto"
+
+    categories = ('ecies', 'ecdh', 'recover', 'sign', 'validate', 'kdf', 'keygen')
+    targets = ((ECCx, 'ecies_encrypt', 'ecies'),
+               (ECCx, 'ecies_decrypt', 'ecies'),
+               (ECCx, 'raw_get_ecdh_key', 'ecdh'),
+               (rlpxcipher, 'ecdsa_recover', 'recover'),
+               (ECCx, 'sign', 'sign'),
+               (ECCx, 'is_valid_key', 'validate'),
+               (RLPxSession, 'setup_cipher', 'kdf'),
+               (ECCx, '__init__', 'keygen'))
+
+    def __init__(self):
+        self.times = dict((name, 0.) for name in self.categories)
+        self._local = threading.local()
+        self._originals = []
+
+    def _timed(self, name, func):
+        local, times = self._local, self.times
+
+        @wraps(func)
+        def timed(*args, **kargs):
+            stack = local.__dict__.setdefault('stack', [])
+            stack.append(0.)  # time of nested timed calls
+            st = cpu_time()
+            try:
+                return func(*args, **kargs)
+            finally:
+                elapsed = cpu_time() - st
+                times[name] += elapsed - stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+        return timed
+
+    def __enter__(self):
+        for owner, attr, name in self.targets:
+            original = vars(owner).get(attr)  # None if inherited
+            if isinstance(original, classmethod):
+                wrapped = classmethod(self._timed(name, original.__get__(None, owner).__func__))
+            else:
+                wrapped = self._timed(name, original or getattr(owner, attr))
+            self._originals.append((owner, attr, original))
+            setattr(owner, attr, wrapped)
+        return self
+
+    def __exit__(self, *exc_info):
+        for owner, attr, original in reversed(self._originals):
+            if original is None:
+                delattr(owner, attr)
+            else:
+                setattr(owner, attr, original)
+        self._originals = []
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def new_initiator(initiator_class, identity, remote_pubkey):
+    session = initiator_class(identity.raw_privkey, hello_packet, remote_pubkey=remote_pubkey,
+                              ecc=identity.ecc)
+    session.add_protocol(0)
+    return session
+
+
+def new_responder(handshake_pool=None):
+    session = MultiplexedSession(responder_identity.raw_privkey, hello_packet,
+                                 ecc=responder_identity.ecc)
+    session.add_protocol(0)
+    session.handshake_pool = handshake_pool
+    return session
+
+
+def pop_messages(session):
+    msgs = []
+    while not session.message_queue.empty():
+        msgs.append(bytes(session.message_queue.get_nowait()))  # frames are bytearrays
+        session.message_sent(len(msgs[-1]))
+    return b''.join(msgs)
+
+
+def inproc_handshake(initiator_class, identity, handshake_pool=None):
+    "returns the setup latency"
+    st = time.time()
+    initiator = new_initiator(initiator_class, identity, responder_identity.raw_pubkey)
+    responder = new_responder(handshake_pool)
+    responder.add_message(pop_messages(initiator))  # auth
+    initiator.add_message(pop_messages(responder))  # ack and hello
+    initiator.packet_queue.get_nowait()
+    return time.time() - st
+
+
+def pump(sock, session, done):
+    "exchanges messages between sock and session until done() or the connection is closed"
+    while not done():
+        msgs = pop_messages(session)
+        if msgs:
+            sock.sendall(msgs)
+        data = sock.recv(4096)
+        if not data:
+            break
+        session.add_message(data)
+
+
+def tcp_handshake(address, initiator_class, identity):
+    "returns the setup latency"
+    st = time.time()
+    sock = gevent.socket.create_connection(address)
+    try:
+        initiator = new_initiator(initiator_class, identity, responder_identity.raw_pubkey)
+        pump(sock, initiator, lambda: not initiator.packet_queue.empty())
+        initiator.packet_queue.get_nowait()
+    finally:
+        sock.close()
+    return time.time() - st
+
+
+def start_server(port=0, handshake_pool=None):
+    def handle(sock, address):
+        try:
+            pump(sock, new_responder(handshake_pool), lambda: False)
+        finally:
+            sock.close()
+    server = StreamServer(('127.0.0.1', port), handle, backlog=1024)
+    server.start()
+    return server
+
+
+def run(num_handshakes, concurrency, eip8=False, address=None, handshake_pool=None):
+    "returns the results of num_handshakes handshakes as a dict"
+    initiator_class = EIP8Initiator if eip8 else Initiator
+    identities = [NodeIdentity(mk_privkey(('initiator %s %d' % (eip8, i)).encode()))
+                  for i in range(num_handshakes)]
+    for identity in identities:
+        identity.ecc  # not part of the handshake
+    crypto.ECCx.setup_ecdh_cache()  # drop secrets of previous runs
+    todo = iter(identities)
+    latencies = []
+
+    def initiators():
+        for identity in todo:
+            if address:
+                latencies.append(tcp_handshake(address, initiator_class, identity))
+            else:
+                latencies.append(inproc_handshake(initiator_class, identity, handshake_pool))
+
+    cpu_st = sum(os.times()[:2])
+    st = time.time()
+    with CPUBreakdown() as breakdown:
+        gevent.joinall([gevent.spawn(initiators) for i in range(concurrency)],
+                       raise_error=True)
+    elapsed = time.time() - st
+    cpu = sum(os.times()[:2]) - cpu_st
+    assert len(latencies) == num_handshakes
+
+    def per_handshake_ms(seconds):
+        return round(seconds / num_handshakes * 1000, 3)
+
+    cpu_ms = dict((name, per_handshake_ms(t)) for name, t in breakdown.times.items())
+    cpu_ms['other'] = per_handshake_ms(max(0., cpu - sum(breakdown.times.values())))
+    cpu_ms['total'] = per_handshake_ms(cpu)
+    return dict(format='eip8' if eip8 else 'legacy',
+                handshakes=num_handshakes,
+                concurrency=concurrency,
+                elapsed=round(elapsed, 3),
+                handshakes_per_sec=round(num_handshakes / elapsed, 1),
+                latency_ms=dict(p50=round(percentile(latencies, .5) * 1000, 3),
+                                p99=round(percentile(latencies, .99) * 1000, 3),
+                                max=round(max(latencies) * 1000, 3)),
+                cpu_ms_per_handshake=cpu_ms)
+
+
+def print_result(result):
+    latency, cpu = result['latency_ms'], result['cpu_ms_per_handshake']
+    print('%s\t%s\t%.1f\t%.2f\t%.2f\t%.2f\t%s' % (
+        result['transport'], result['format'], result['handshakes_per_sec'],
+        latency['p50'], latency['p99'], cpu['total'],
+        ' '.join('%s=%.3f' % (name, cpu[name]) for name in CPUBreakdown.categories + ('other',))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RLPx handshake load generator')
+    parser.add_argument('-n', '--handshakes', type=int, default=500)
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='threads of the responder HandshakeWorkerPool')
+    parser.add_argument('--format', choices=('legacy', 'eip8'),
+                        help='only run this variant')
+    parser.add_argument('--json', action='store_true', help='print JSON lines')
+    transport = parser.add_mutually_exclusive_group()
+    transport.add_argument('--tcp', action='store_true')
+    transport.add_argument('--listen', type=int, metavar='PORT')
+    transport.add_argument('--connect', metavar='HOST:PORT')
+    args = parser.parse_args()
+
+    pool = None
+    if args.workers:
+        pool = HandshakeWorkerPool(args.workers, max_queued=max(args.concurrency, 1024))
+    if args.listen is not None:
+        server = start_server(args.listen, pool)
+        print('responder listening on %s:%d' % server.address, file=sys.stderr)
+        server.serve_forever()
+        return
+
+    server, address, transport = None, None, 'inproc'
+    if args.tcp:
+        server = start_server(handshake_pool=pool)
+        address, transport = server.address, 'tcp'
+    elif args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        address, transport = (host, int(port)), 'connect'
+
+    if not args.json:
+        print('transport\tformat\thandshakes/sec\tp50 (ms)\tp99\tcpu/handshake\tbreakdown (ms)')
+    for eip8 in (False, True):
+        if args.format and args.format != ('eip8' if eip8 else 'legacy'):
+            continue
+        result = run(args.handshakes, args.concurrency, eip8, address, pool)
+        result.update(transport=transport, workers=args.workers)
+        if args.json:
+            print(json.dumps(result, sort_keys=True))
+        else:
+            print_result(result)
+    if server:
+        server.stop()
+    if pool:
+        pool.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Latency of an established session during a storm of incoming handshakes.
+
+installation:
+
+    python setup.py develop
+
+usage:
+    python examples/handshake_storm_benchmark.py [num_handshakes]
+
+a greenlet sends a ping between two established sessions every millisecond while
+num_handshakes (default 200) responder sessions process their auth messages at once.
+reports the handshakes/sec and the delay of the pings (p50, p99, max) with the
+handshake crypto run on the hub and on a HandshakeWorkerPool of 1, 2 and 4 threads.
+"""
+from __future__ import print_function
+import sys
+import time
+import gevent
+from devp2p.crypto import mk_privkey, privtopub
+from devp2p.muxsession import MultiplexedSession
+from devp2p.multiplexer import Packet
+from devp2p.workerpool import HandshakeWorkerPool
+
+hello_packet = Packet(0, cmd_id=0, payload=b'hello')
+responder_privkey = mk_privkey(b'responder')
+interval = 0.001
+
+
+def session_pair(handshake_pool=None):
+    "returns (initiator, responder, auth message) before the auth message was received"
+    responder = MultiplexedSession(responder_privkey, hello_packet=hello_packet)
+    initiator = MultiplexedSession(mk_privkey(b'initiator'), hello_packet=hello_packet,
+                                   remote_pubkey=privtopub(responder_privkey))
+    for session in (initiator, responder):
+        session.add_protocol(0)
+        session.handshake_pool = handshake_pool
+    return initiator, responder, initiator.message_queue.get_nowait()
+
+
+def connected_pair():
+    initiator, responder, auth = session_pair()
+    responder.add_message(auth)
+    ack = responder.message_queue.get_nowait()  # followed by the hello
+    initiator.add_message(ack + responder.message_queue.get_nowait())
+    responder.add_message(initiator.message_queue.get_nowait())
+    initiator.packet_queue.get_nowait()
+    responder.packet_queue.get_nowait()
+    return initiator, responder
+
+
+def ping(initiator, responder):
+    initiator.add_packet(Packet(0, cmd_id=2, payload=b'\xc0'))
+    responder.add_message(initiator.message_queue.get_nowait())
+    responder.packet_queue.get_nowait()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def storm(num_handshakes, handshake_pool=None):
+    "returns (handshakes/sec, ping delays)"
+    established = connected_pair()
+    responders = [session_pair(handshake_pool)[1:] for i in range(num_handshakes)]
+    delays = []
+
+    def prober():
+        while True:
+            st = time.time()
+            gevent.sleep(interval)
+            ping(*established)
+            delays.append(time.time() - st - interval)
+
+    probe = gevent.spawn(prober)
+    gevent.sleep(0.05)
+    st = time.time()
+    gevent.joinall([gevent.spawn(r.add_message, auth) for r, auth in responders],
+                   raise_error=True)
+    elapsed = time.time() - st
+    probe.kill()
+    assert all(r.is_ready for r, _ in responders)
+    return num_handshakes / elapsed, delays
+
+
+def main():
+    num_handshakes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print('mode\thandshakes/sec\tping delay p50\tp99\tmax (ms)')
+    for workers in (0, 1, 2, 4):
+        pool = HandshakeWorkerPool(workers, max_queued=num_handshakes) if workers else None
+        rate, delays = storm(num_handshakes, pool)
+        print('%s\t%.0f\t%.1f\t%.1f\t%.1f' % (
+            '%d workers' % workers if workers else 'hub', rate,
+            percentile(delays, .5) * 1000, percentile(delays, .99) * 1000,
+            max(delays) * 1000))
+        if pool:
+            pool.stop()
+
+
+if __name__ == '__main__':
+    main()
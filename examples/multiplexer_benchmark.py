@@ -0,0 +1,178 @@
+"""
+Benchmarks for the multiplexer framing engine.
+
+installation:
+
+    python setup.py develop
+
+usage:
+    python examples/multiplexer_benchmark.py
+
+reports frames/sec of Multiplexer.add_packet and pop_frames for packets with payloads
+between 1 KB and 10 MB at the default window size, and the peak memory allocated
+while a packet is framed and its frames are kept. the payloads of the frames are
+slices of the packet payload and don't copy it. the peak is measured with tracemalloc
+and reported as n/a where it is not available (python2).
+
+also compares frame header encoding/decoding of the frameheader codec with pyrlp
+and measures the scheduling overhead with 1, 4 and 16 registered protocols.
+
+the egress schedulers are compared by their throughput and their fairness for
+weighted protocols sending packets of mixed sizes. fairness is reported as Jain's
+index over the bytes sent per unit of weight (1.0 is perfectly fair).
+"""
+from __future__ import print_function
+import random
+import struct
+import time
+import rlp
+from devp2p import frameheader
+from devp2p.frameheader import header_data_sedes
+from devp2p.multiplexer import Multiplexer, Packet
+from devp2p.scheduler import RoundRobinScheduler, DeficitRoundRobinScheduler
+try:
+    import tracemalloc
+except ImportError:  # python2
+    tracemalloc = None
+
+KB = 1024
+MB = 1024 ** 2
+payload_sizes = (KB, 16 * KB, 256 * KB, MB, 10 * MB)
+
+
+def frame_packet(mux, packet):
+    mux.add_packet(packet)
+    frames = []
+    while mux.num_active_protocols:
+        frames.extend(mux.pop_frames())
+    return frames
+
+
+def peak_memory(mux, packet):
+    "peak bytes allocated while framing the packet and keeping its frames, None if unknown"
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    frames = frame_packet(mux, packet)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del frames  # kept until the peak is read
+    return peak
+
+
+def bench_framing(payload_size, min_duration=1.):
+    mux = Multiplexer()
+    mux.add_protocol(0)
+    packet = Packet(0, cmd_id=0, payload=b'\x00' * payload_size)
+    frames = frame_packet(mux, packet)
+    num_frames, rounds = 0, 0
+    st = time.time()
+    while time.time() - st < min_duration:
+        num_frames += len(frame_packet(mux, packet))
+        rounds += 1
+    elapsed = time.time() - st
+    return dict(payload_size=payload_size, frames_per_packet=len(frames),
+                frames_per_sec=num_frames / elapsed, packets_per_sec=rounds / elapsed,
+                peak_memory=peak_memory(mux, packet))
+
+
+def rlp_encode_header(body_size, *values):
+    header = struct.pack('>I', body_size)[1:] + rlp.encode(list(values), sedes=header_data_sedes)
+    return header + b'\x00' * (16 - len(header))
+
+
+def rlp_decode_header_data(data):
+    return rlp.decode(data, sedes=header_data_sedes, strict=False)
+
+
+def ops_per_sec(func, args_list, min_duration=1.):
+    num_ops = 0
+    st = time.time()
+    while time.time() - st < min_duration:
+        for args in args_list:
+            func(*args)
+        num_ops += len(args_list)
+    return num_ops / (time.time() - st)
+
+
+def bench_header_codec():
+    headers = [(8144, 1, 2), (8144, 1, 300, 10 * MB), (100, 0, 65535)]
+    encoded = [(frameheader.encode_header(*h)[3:],) for h in headers]
+    return [('encode', ops_per_sec(rlp_encode_header, headers),
+             ops_per_sec(frameheader.encode_header, headers)),
+            ('decode', ops_per_sec(rlp_decode_header_data, encoded),
+             ops_per_sec(frameheader.decode_header_data, encoded))]
+
+
+def bench_scheduler(num_protocols, num_packets=2000, payload_size=100, min_duration=1.):
+    "add small packets to all protocols and pop them, returns packets/sec"
+    mux = Multiplexer()
+    for p in range(num_protocols):
+        mux.add_protocol(p)
+    packets = [Packet(i % num_protocols, cmd_id=0, payload=b'\x00' * payload_size)
+               for i in range(num_packets)]
+    num_ops = 0
+    st = time.time()
+    while time.time() - st < min_duration:
+        for packet in packets:
+            mux.add_packet(packet)
+        assert len(mux.pop_all_frames()) == num_packets
+        num_ops += num_packets
+    return num_ops / (time.time() - st)
+
+
+def jain_index(values):
+    return sum(values) ** 2 / float(len(values) * sum(v ** 2 for v in values))
+
+
+def bench_fairness(scheduler_class, weights=(1, 2, 4), packet_sizes=(64, 1000, 20000),
+                   num_packets=300):
+    "returns (bytes sent per protocol, jain index, MB/s) while all protocols are backlogged"
+    random.seed(42)
+    mux = Multiplexer(scheduler=scheduler_class())
+    for p, weight in enumerate(weights):
+        mux.add_protocol(p, weight=weight)
+    for i in range(num_packets):
+        for p in range(len(weights)):
+            size = random.choice(packet_sizes)
+            mux.add_packet(Packet(p, cmd_id=0, payload=b'\x00' * size))
+    sent = [0] * len(weights)
+    st = time.time()
+    while mux.num_active_protocols == len(weights):
+        for f in mux.pop_frames():
+            sent[f.protocol_id] += f.frame_size()
+    elapsed = time.time() - st
+    index = jain_index([s / float(w) for s, w in zip(sent, weights)])
+    return sent, index, sum(sent) / elapsed / MB
+
+
+def main():
+    print('payload\tframes\tframes/sec\tpackets/sec\tpeak memory\tof payload')
+    for size in payload_sizes:
+        r = bench_framing(size)
+        if r['peak_memory'] is None:
+            peak = 'n/a\tn/a'
+        else:
+            peak = '%.1fKB\t%.1f%%' % (r['peak_memory'] / float(KB),
+                                      100. * r['peak_memory'] / r['payload_size'])
+        print('%dKB\t%d\t%.0f\t%.1f\t%s' % (
+            r['payload_size'] // KB, r['frames_per_packet'], r['frames_per_sec'],
+            r['packets_per_sec'], peak))
+
+    print('\nheader\tpyrlp ops/sec\tcodec ops/sec\tspeedup')
+    for name, rlp_ops, codec_ops in bench_header_codec():
+        print('%s\t%.0f\t%.0f\t%.1fx' % (name, rlp_ops, codec_ops, codec_ops / rlp_ops))
+
+    print('\nprotocols\tpackets/sec')
+    for num_protocols in (1, 4, 16):
+        print('%d\t%.0f' % (num_protocols, bench_scheduler(num_protocols)))
+
+    print('\nscheduler\tbytes sent (weights 1:2:4)\tfairness\tMB/s')
+    for klass in (RoundRobinScheduler, DeficitRoundRobinScheduler):
+        sent, index, throughput = bench_fairness(klass)
+        sent = ':'.join(str(x) for x in sent)
+        print('%s\t%s\t%.3f\t%.1f' % (klass.__name__, sent, index, throughput))
+
+
+if __name__ == '__main__':
+    main()
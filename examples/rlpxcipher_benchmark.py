@@ -0,0 +1,238 @@
+"""
+Benchmarks for RLPx frame encryption.
+
+installation:
+
+    python setup.py develop
+
+usage:
+    python examples/rlpxcipher_benchmark.py
+
+reports the throughput in MB/s of sealing and opening 64 B, 1 KB and 8 KB frames
+with the previous per-frame implementation (byte-wise xor, one closure per call),
+RLPxSession.encrypt/decrypt, and the batched RLPxSession.encrypt_frames with frames
+opened in place by RLPxSession.decrypt_body_into, as the Multiplexer does.
+
+also reports the ingress throughput of an encrypted Multiplexer decoding packets
+of 1 KB to 1 MB which are fed in 64 KB reads.
+
+the memory allocated to open frames is measured in a fresh process for each
+implementation: 16 MB of 1 KB frames are opened and the payloads are kept, as the
+receiver of the packets would. the growth of the resident set size (linux only) is
+reported, for the in place implementation it only consists of the payload views.
+"""
+from __future__ import print_function
+import gc
+import os
+import resource
+import struct
+import subprocess
+import sys
+import time
+from rlp.utils import ascii_chr, safe_ord
+from devp2p.crypto import mk_privkey, ECCx
+from devp2p.rlpxcipher import RLPxSession, ceil16
+from devp2p.multiplexer import Multiplexer, Packet
+
+KB = 1024
+MB = 1024 ** 2
+frame_sizes = (64, KB, 8 * KB)
+
+
+def session_pair():
+    initiator = RLPxSession(ECCx(raw_privkey=mk_privkey(b'secret1')), is_initiator=True)
+    responder = RLPxSession(ECCx(raw_privkey=mk_privkey(b'secret2')))
+    auth_msg = initiator.create_auth_message(remote_pubkey=responder.ecc.raw_pubkey)
+    responder.decode_authentication(initiator.encrypt_auth_message(auth_msg))
+    auth_ack_msg = responder.create_auth_ack_message()
+    initiator.decode_auth_ack_message(responder.encrypt_auth_ack_message(auth_ack_msg))
+    initiator.setup_cipher()
+    responder.setup_cipher()
+    return initiator, responder
+
+
+def legacy_sxor(s1, s2):
+    return b''.join(ascii_chr(safe_ord(a) ^ safe_ord(b)) for a, b in zip(s1, s2))
+
+
+def legacy_encrypt(session, header, frame):
+    def aes(data=''):
+        return session.aes_enc.update(data)
+
+    def mac(data=b''):
+        session.egress_mac.update(data)
+        return session.egress_mac.digest()
+
+    header_ciphertext = aes(header)
+    header_mac = mac(legacy_sxor(session.mac_enc(mac()[:16]), header_ciphertext))[:16]
+    frame_ciphertext = aes(frame)
+    fmac_seed = mac(frame_ciphertext)
+    frame_mac = mac(legacy_sxor(session.mac_enc(mac()[:16]), fmac_seed[:16]))[:16]
+    return header_ciphertext + header_mac + frame_ciphertext + frame_mac
+
+
+def legacy_decrypt(session, data):
+    def aes(data=''):
+        return session.aes_dec.update(data)
+
+    def mac(data=b''):
+        session.ingress_mac.update(data)
+        return session.ingress_mac.digest()
+
+    header_ciphertext = data[:16]
+    header_mac = mac(legacy_sxor(session.mac_enc(mac()[:16]), header_ciphertext))[:16]
+    assert header_mac == data[16:32]
+    header = aes(header_ciphertext)
+    body_size = struct.unpack(b'>I', b'\x00' + header[:3])[0]
+    read_size = ceil16(body_size)
+    frame_ciphertext = data[32:32 + read_size]
+    fmac_seed = mac(frame_ciphertext)
+    frame_mac = mac(legacy_sxor(session.mac_enc(mac()[:16]), fmac_seed[:16]))[:16]
+    assert frame_mac == data[32 + read_size:32 + read_size + 16]
+    return header, aes(frame_ciphertext)[:body_size], 32 + read_size + 16
+
+
+def make_frames(frame_size, num_frames):
+    header = struct.pack('>I', frame_size)[1:] + b'\xc2\x80\x80' + b'\x00' * 10
+    return [(header, b'\x00' * frame_size)] * num_frames
+
+
+def split(data, frame_size, decrypt):
+    "decrypts data frame by frame"
+    wire_size = 32 + ceil16(frame_size) + 16
+    for pos in range(0, len(data), wire_size):
+        decrypt(data[pos:pos + wire_size])
+
+
+def decrypt_in_place(session, data):
+    "decrypts all frames of the bytearray data in place"
+    pos = 0
+    while pos < len(data):
+        header = session.decrypt_header(bytes(data[pos:pos + 32]))
+        body_size = struct.unpack(b'>I', b'\x00' + header[:3])[0]
+        pos += 32 + session.decrypt_body_into(data, pos + 32, body_size, data, pos + 32)
+
+
+def open_frames(name, session, data, frame_size):
+    "opens all frames of data, returns their payloads"
+    wire_size = 32 + ceil16(frame_size) + 16
+    positions = range(0, len(data), wire_size)
+    if name == 'legacy':
+        return [legacy_decrypt(session, data[pos:pos + wire_size])[1] for pos in positions]
+    if name == 'per frame':
+        return [session.decrypt(data[pos:pos + wire_size])['frame'] for pos in positions]
+    decrypt_in_place(session, data)
+    view = memoryview(data)
+    return [view[pos + 32:pos + 32 + frame_size] for pos in positions]
+
+
+def resident_size():
+    "current resident set size in bytes"
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def open_memory(name, frame_size=KB, num_bytes=16 * MB):
+    "returns the growth of the resident set size while opening and keeping the frames"
+    initiator, responder = session_pair()
+    data = initiator.encrypt_frames(make_frames(frame_size, num_bytes // frame_size))
+    if name != 'batched':
+        data = bytes(data)
+    gc.collect()
+    before = resident_size()
+    payloads = open_frames(name, responder, data, frame_size)
+    assert len(payloads) == num_bytes // frame_size
+    return resident_size() - before
+
+
+def throughput(func, num_bytes, min_duration=1.):
+    "returns MB/s"
+    rounds = 0
+    st = time.time()
+    while time.time() - st < min_duration:
+        func()
+        rounds += 1
+    return rounds * num_bytes / (time.time() - st) / MB
+
+
+def bench(frame_size, batch_bytes=256 * KB):
+    """
+    returns [(name, encrypt MB/s, decrypt MB/s)]
+    each round seals batch_bytes of payload, the receiving session then opens
+    everything that was sealed, so both sides process the same stream.
+    """
+    frames = make_frames(frame_size, max(1, batch_bytes // frame_size))
+    num_bytes = frame_size * len(frames)
+    results = []
+    for name, encrypt, decrypt in (
+            ('legacy',
+             lambda s: b''.join(legacy_encrypt(s, h, f) for h, f in frames),
+             lambda s, d: split(d, frame_size, lambda x: legacy_decrypt(s, x))),
+            ('per frame',
+             lambda s: b''.join(s.encrypt(h, f) for h, f in frames),
+             lambda s, d: split(d, frame_size, s.decrypt)),
+            ('batched',
+             lambda s: s.encrypt_frames(frames),
+             decrypt_in_place)):
+        initiator, responder = session_pair()
+        sealed = []
+        enc = throughput(lambda: sealed.append(encrypt(initiator)), num_bytes)
+        st = time.time()
+        for data in sealed:
+            decrypt(responder, data)
+        dec = len(sealed) * num_bytes / (time.time() - st) / MB
+        results.append((name, enc, dec))
+    return results
+
+
+def bench_ingress(payload_size, batch_bytes=MB, read_size=64 * KB):
+    "returns MB/s of decoded payload"
+    initiator, responder = session_pair()
+    imux, rmux = Multiplexer(frame_cipher=initiator), Multiplexer(frame_cipher=responder)
+    imux.add_protocol(0)
+    rmux.add_protocol(0)
+    packet = Packet(0, cmd_id=0, payload=b'\x00' * payload_size)
+    num_packets = max(1, batch_bytes // payload_size)
+    num_bytes, elapsed = 0, 0.
+    while elapsed < 1.:
+        for i in range(num_packets):
+            imux.add_packet(packet)
+        msg = imux.pop_all_frames_as_bytes()
+        st = time.time()
+        num_decoded = 0
+        for i in range(0, len(msg), read_size):
+            num_decoded += len(rmux.decode(msg[i:i + read_size]))
+        elapsed += time.time() - st
+        assert num_decoded == num_packets
+        num_bytes += num_packets * payload_size
+    return num_bytes / elapsed / MB
+
+
+def main():
+    print('frame size\timplementation\tencrypt MB/s\tdecrypt MB/s')
+    for size in frame_sizes:
+        for name, enc, dec in bench(size):
+            print('%dB\t%s\t%.1f\t%.1f' % (size, name, enc, dec))
+
+    print('\npayload\tingress MB/s')
+    for size in (KB, 64 * KB, MB):
+        print('%dKB\t%.1f' % (size // KB, bench_ingress(size)))
+
+    print('\nimplementation\tmemory to open and keep 16 MB of 1 KB frames')
+    for name in ('legacy', 'per frame', 'batched'):
+        # in a fresh process which returns large freed blocks to the system at once,
+        # so they are not reused by the payloads unnoticed
+        env = dict(os.environ, MALLOC_MMAP_THRESHOLD_=str(64 * KB))
+        try:
+            command = [sys.executable, __file__, '--memory', name]
+            size = int(subprocess.check_output(command, env=env))
+            print('%s\t%.1fMB' % (name, size / float(MB)))
+        except (subprocess.CalledProcessError, OSError):
+            print('%s\tn/a' % name)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--memory']:
+        print(open_memory(sys.argv[2]))
+    else:
+        main()
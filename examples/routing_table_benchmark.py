@@ -0,0 +1,165 @@
+"""
+Benchmarks for the kademlia routing tables.
+
+installation:
+
+    python setup.py develop
+
+usage:
+    python examples/routing_table_benchmark.py [max_nodes]
+
+inserts 1k, 10k and 100k (up to max_nodes) random nodes into a RoutingTable and
+a LogDistanceRoutingTable and reports the rates of add_node, of membership
+lookups of inserted nodes and of neighbours queries for random ids, along with
+the number of nodes and buckets the tables ended up with. the neighbours queries
+are also run with the previous RoutingTable.neighbours, which sorted all buckets
+by the distance of their midpoint and the first 2k nodes found in that order.
+
+also reports the rate of inserts into a populated RoutingTable, where most
+buckets are full and add_node needs their depth, with KBucket.depth computed
+from the id range of the bucket and with the previous implementation which
+compared the binary string representations of all ids.
+
+if numpy is installed, the queries/sec of a NodeIdStore of 1k to 100k nodes are
+compared with python loops over the nodes: nodes within a distance covering
+1/1024 of the id space and the 16 closest nodes to random ids. also reports
+add_node rates of a RoutingTable with and without the id store.
+"""
+from __future__ import print_function
+import operator
+import random
+import sys
+import time
+from devp2p.kademlia import Node, KBucket, RoutingTable, LogDistanceRoutingTable
+from devp2p.kademlia import k_id_size, k_max_node_id, random_nodeid
+from devp2p.utils import int_to_big_endian
+try:
+    from devp2p.nodeidstore import NodeIdStore
+except ImportError:  # numpy is optional
+    NodeIdStore = None
+
+random.seed(42)
+table_classes = (RoutingTable, LogDistanceRoutingTable)
+
+
+def random_node():
+    pubkey = int_to_big_endian(random.getrandbits(512))
+    return Node(b'\x00' * (64 - len(pubkey)) + pubkey)
+
+
+def rate(func, args):
+    "returns calls/sec of func for each of args"
+    st = time.time()
+    for arg in args:
+        func(arg)
+    return len(args) / (time.time() - st)
+
+
+def legacy_neighbours(table, id, k=16):
+    nodes = []
+    for bucket in table.buckets_by_id_distance(id):
+        for n in bucket.nodes_by_id_distance(id):
+            nodes.append(n)
+            if len(nodes) == k * 2:
+                break
+    return sorted(nodes, key=operator.methodcaller('id_distance', id))[:k]
+
+
+def bench(table_class, this_node, nodes, num_queries=1000):
+    "returns (nodes, buckets, add/sec, lookup/sec, neighbours/sec, legacy neighbours/sec)"
+    table = table_class(this_node)
+    add = rate(table.add_node, nodes)
+    lookup = rate(table.__contains__, random.sample(nodes, num_queries))
+    targets = [random_nodeid() for i in range(num_queries)]
+    neighbours = rate(table.neighbours, targets)
+    legacy = rate(lambda id: legacy_neighbours(table, id), targets)
+    return len(table), len(table.buckets), add, lookup, neighbours, legacy
+
+
+def legacy_depth(self):
+    def to_binary(x):  # left padded bit representation
+        b = bin(x)[2:]
+        return '0' * (k_id_size - len(b)) + b
+
+    if len(self.nodes) < 2:
+        return k_id_size
+
+    bits = [to_binary(n.id) for n in self.nodes]
+    for i in range(k_id_size):
+        if len(set(b[:i] for b in bits)) != 1:
+            return i - 1
+    raise Exception
+
+
+def bench_full_buckets(this_node, nodes, num_inserts=10000):
+    "returns [(depth implementation, inserts/sec, share of inserts into full buckets)]"
+    inserts = [random_node() for i in range(num_inserts)]
+    results = []
+    depth = KBucket.depth
+    for name, implementation in (('id range', depth), ('legacy', property(legacy_depth))):
+        KBucket.depth = implementation
+        table = RoutingTable(this_node)
+        for node in nodes:
+            table.add_node(node)
+        full = sum(table.bucket_by_node(node).is_full for node in inserts)
+        results.append((name, rate(table.add_node, inserts), full / float(num_inserts)))
+    KBucket.depth = depth
+    return results
+
+
+def bench_id_store(nodes, num_queries=100):
+    "returns (within distance/sec, python, closest/sec, python)"
+    store = NodeIdStore()
+    for node in nodes:
+        store.add(node)
+    targets = [random_nodeid() for i in range(num_queries)]
+    distance = k_max_node_id >> 10
+
+    def by_distance(id):
+        return operator.methodcaller('id_distance', id)
+
+    return (rate(lambda id: store.within_distance(id, distance), targets),
+            rate(lambda id: sorted((n for n in nodes if n.id_distance(id) <= distance),
+                                   key=by_distance(id)), targets),
+            rate(lambda id: store.closest(id, 16), targets),
+            rate(lambda id: sorted(nodes, key=by_distance(id))[:16], targets))
+
+
+def main():
+    max_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    this_node = random_node()
+    print('inserted\ttable\tnodes\tbuckets\tadd/sec\tlookup/sec\tneighbours/sec\t(legacy)')
+    for num_nodes in (1000, 10000, 100000):
+        if num_nodes > max_nodes:
+            break
+        nodes = [random_node() for i in range(num_nodes)]
+        for table_class in table_classes:
+            print('%d\t%s\t%d\t%d\t%.0f\t%.0f\t%.0f\t%.0f' % (
+                (num_nodes, table_class.__name__) + bench(table_class, this_node, nodes)))
+
+    print('\nfull bucket inserts into a RoutingTable of 10000 nodes')
+    print('depth\tinserts/sec\tinto full buckets')
+    nodes = [random_node() for i in range(10000)]
+    for name, inserts, full in bench_full_buckets(this_node, nodes):
+        print('%s\t%.0f\t%.0f%%' % (name, inserts, full * 100))
+
+    if NodeIdStore is None:
+        print('\nnumpy is not installed, skipping the id store')
+        return
+    print('\nnodes\twithin distance/sec\t(python)\tclosest/sec\t(python)')
+    for num_nodes in (1000, 10000, 100000):
+        if num_nodes > max_nodes:
+            break
+        nodes = [random_node() for i in range(num_nodes)]
+        print('%d\t%.0f\t%.0f\t%.0f\t%.0f' % ((num_nodes,) + bench_id_store(nodes)))
+
+    print('\nid store\tadd/sec (RoutingTable, 10000 inserts)')
+    nodes = [random_node() for i in range(10000)]
+    for use_id_store in (False, True):
+        RoutingTable.use_id_store = use_id_store
+        print('%s\t%.0f' % (use_id_store, rate(RoutingTable(this_node).add_node, nodes)))
+    RoutingTable.use_id_store = False
+
+
+if __name__ == '__main__':
+    main()